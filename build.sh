@@ -2,4 +2,5 @@
 
 
 gcc -O3 -shared -fPIC ./utils/FFT.c -o ./lib/libfft.so
-gcc -O3 -shared -fPIC ./utils/img.c -o ./lib/libimg.so -lpng -lz -ljpeg
+gcc -O3 -shared -fPIC ./utils/img.c -o ./lib/libimg.so -lpng -lz -ljpeg -lm
+gcc -O3 -shared -fPIC ./utils/tone.c -o ./lib/libtone.so -lm
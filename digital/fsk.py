@@ -1,58 +1,470 @@
 #!/usr/bin/env python3
 
-import sys
+import array
 import ctypes
-from ctypes import POINTER, c_double, c_int, c_int32
 import logging
+import sys
+import wave
+from ctypes import POINTER, c_double, c_int, c_int16, c_long, c_ubyte, c_void_p
+
 logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.WARNING)
+
+# Bell 202: 1200 baud, mark (1) 1200 Hz, space (0) 2200 Hz
+BAUD = 1200
+MARK_HZ = 1200
+SPACE_HZ = 2200
+
+# HDLC flag, sent between and around frames without bit stuffing
+FLAG = 0x7E
+
+# Bits of every byte value, LSB first as they go on the air
+BYTE_BITS = [tuple((v >> i) & 1 for i in range(8)) for v in range(256)]
+
+# Bit values 0 and 1 to the digits "0" and "1"
+ASCII_BITS = bytes.maketrans(b"\x00\x01", b"01")
+
+
+def nrzi(bits, level=1):
+    # NRZI as used by AX.25: a 0 changes the tone, a 1 keeps it. Returns the
+    # line levels and the level to carry on from.
+    out = bytearray(len(bits))
+    for i, bit in enumerate(bits):
+        if not bit:
+            level ^= 1
+        out[i] = level
+    return out, level
+
+
+def nrzi_table():
+    # Line levels of every byte value sent from either level, with the
+    # level after it: NRZI of a raw byte stream is then one lookup per byte
+    table = []
+    for level in (0, 1):
+        table.append([nrzi(BYTE_BITS[v], level) for v in range(256)])
+    return table
+
+
+NRZI_BYTES = nrzi_table()
+
+
+def nrzi_bytes(data, level=1):
+    # nrzi() of the bits of data, LSB first
+    out = bytearray()
+    for b in data:
+        levels, level = NRZI_BYTES[level][b]
+        out += levels
+    return out, level
+
 
+def stuff(bits, ones=0):
+    # HDLC bit stuffing: a 0 after every run of five 1s. ones is the run
+    # the bits continue; returns the stuffed bits and the run after them.
+    out = []
+    for bit in bits:
+        out.append(bit)
+        ones = ones + 1 if bit else 0
+        if ones == 5:
+            out.append(0)
+            ones = 0
+    return out, ones
 
-class FSKEncoder():
-	def __init__(self):
-		self.phase = 0.0
-        self.clock = 0.0
+
+def stuff_table():
+    # Stuffed, NRZI encoded line levels of every byte value, for every
+    # (run of 1s, level) a byte can start from, with the state after it
+    table = {}
+    for ones in range(5):
+        for level in (0, 1):
+            row = []
+            for v in range(256):
+                bits, run = stuff(BYTE_BITS[v], ones)
+                levels, after = nrzi(bits, level)
+                row.append((levels, run, after))
+            table[ones, level] = row
+    return table
+
+
+STUFF_BYTES = stuff_table()
+
+
+def crc_table():
+    # CRC-16/X.25 of every byte value, for a byte at a time
+    table = []
+    for v in range(256):
+        crc = v
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8408 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC_TABLE = crc_table()
+
+
+def fcs(data):
+    # CRC-16/X.25 frame check sequence, sent LSB first
+    crc = 0xFFFF
+    for b in data:
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ b) & 0xFF]
+    return crc ^ 0xFFFF
+
+
+def hdlc_levels(payload, level=1, preamble=32, postamble=2):
+    # NRZI line levels of one HDLC frame: opening flags, stuffed payload
+    # and FCS, closing flags. Returns the levels and the level after them.
+    crc = fcs(payload)
+    out, level = nrzi_bytes(bytes([FLAG]) * preamble, level)
+    ones = 0
+    for b in bytes(payload) + bytes([crc & 0xFF, crc >> 8]):
+        levels, ones, level = STUFF_BYTES[ones, level][b]
+        out += levels
+    levels, level = nrzi_bytes(bytes([FLAG]) * postamble, level)
+    return out + levels, level
+
+
+class FSKEncoder:
+    def __init__(self, f=None, wav=True, samp_rate=44100):
+        self.phase = 0.0
+        self.sent = 0
         self.last_sample = 0
         self.SR = samp_rate
         self.A = 32767
         self.file = f
+        self.wav = wav
+        self.level = 1
+
+        logger.info(f"Using sample rate {self.SR} Hz")
+
+        self.baud = BAUD
+        self.mark_hz = MARK_HZ
+        self.space_hz = SPACE_HZ
 
-        logger.info(f'Using sample rate {self.SR} Hz')
+        if self.file and self.wav:
+            logger.info("Writing output as WAV")
+            self.file.setparams((1, 2, self.SR, 0, "NONE", "Uncompressed"))
 
-        self.baud = 1200
-        self.mark_hz = 1200
-        self.space_hz = 2200
+        self.load_libtone()
 
+    def load_libtone(self):
+        lib = ctypes.CDLL("../lib/libtone.so")
+        lib.synth_bits.argtypes = [
+            POINTER(c_int16),
+            POINTER(c_ubyte),
+            c_long,
+            c_long,
+            POINTER(c_double),
+            c_long,
+            c_long,
+            c_double,
+            c_double,
+            c_int,
+        ]
+        lib.synth_bits.restype = c_long
+        self.lib = lib
+
+    def bit_end(self, k):
+        # End sample of bit k of the stream, rounded half up from the exact
+        # (k + 1) * SR / baud so long runs do not drift
+        return (2 * (k + 1) * self.SR + self.baud) // (2 * self.baud)
+
+    def synth(self, levels):
+        # Samples of line levels (1 mark, 0 space) from the current position,
+        # phase continuous with what was sent before
+        levels = bytearray(levels)
+        n = len(levels)
+        if not n:
+            return array.array("h")
+
+        end = self.bit_end(self.sent + n - 1)
+        b = array.array("h", bytes(2 * (end - self.last_sample)))
+        ph = c_double(self.phase)
+        self.lib.synth_bits(
+            (c_int16 * len(b)).from_buffer(b),
+            (c_ubyte * n).from_buffer(levels),
+            n,
+            self.sent,
+            ph,
+            self.SR,
+            self.baud,
+            self.mark_hz,
+            self.space_hz,
+            self.A,
+        )
+        self.phase = ph.value
+        self.sent += n
+        self.last_sample = end
+        return b
+
+    def write(self, b):
+        if not self.wav:
+            self.file.write(b.tobytes())
+        else:
+            self.file.writeframes(b.tobytes())
+
+    def send_bits(self, bits, encode_nrzi=True):
+        # Data bits, NRZI encoded on the way unless they already are levels
+        if encode_nrzi:
+            bits, self.level = nrzi(bits, self.level)
+        self.write(self.synth(bits))
+
+    def encode(self, data, encode_nrzi=True, block=1 << 14):
+        # A raw byte stream, LSB first, rendered block bytes at a time
+        for i in range(0, len(data), block):
+            chunk = data[i : i + block]
+            if encode_nrzi:
+                levels, self.level = nrzi_bytes(chunk, self.level)
+            else:
+                levels = [bit for b in chunk for bit in BYTE_BITS[b]]
+            self.write(self.synth(levels))
+
+    def encode_frame(self, payload, preamble=32, postamble=2):
+        # One HDLC frame (flags, stuffed payload, FCS), NRZI encoded
+        levels, self.level = hdlc_levels(payload, self.level, preamble, postamble)
+        self.write(self.synth(levels))
 
-	def encode(self):
-		pass
+    def __del__(self):
+        if self.file:
+            self.file.close()
 
 
+class FSKDecoder:
+    # Longest HDLC frame accepted, in bytes
+    max_frame = 4096
 
-class FSKDecoder():
-	def __init__(self):
-		pass
+    def __init__(self, samp_rate=44100, nrzi=True, min_amp=1000):
+        self.SR = samp_rate
+        self.baud = BAUD
+        self.mark_hz = MARK_HZ
+        self.space_hz = SPACE_HZ
+
+        # Raw byte packing and HDLC deframing state, carried across chunks
+        self.pending = bytearray()
+        self.frame = []
+        self.ones = 0
 
+        self.load_libfft()
+        self.demod_state = self.lib.fsk_create(
+            self.SR, self.baud, self.mark_hz, self.space_hz, int(nrzi), min_amp
+        )
+        if not self.demod_state:
+            raise RuntimeError("Failed to create FSK demodulator")
 
     def load_libfft(self):
-        lib = ctypes.CDLL('../lib/libfft.so')
-        lib.goertzel.argtypes = [POINTER(c_double), c_double, c_double, c_int]
-        lib.goertzel.restype = c_int32
-        # lib.hann.argtypes = [POINTER(c_double), c_int]
-        # lib.hann.restype = None
-        # lib.filter.argtypes = [POINTER(c_double), POINTER(c_double), c_int]
-        # lib.filter.restype = None
+        lib = ctypes.CDLL("../lib/libfft.so")
+        lib.fsk_create.argtypes = [
+            c_double,
+            c_double,
+            c_double,
+            c_double,
+            c_int,
+            c_double,
+        ]
+        lib.fsk_create.restype = c_void_p
+        lib.fsk_destroy.argtypes = [c_void_p]
+        lib.fsk_destroy.restype = None
+        lib.fsk_run.argtypes = [c_void_p, POINTER(c_int16), c_long, POINTER(c_ubyte)]
+        lib.fsk_run.restype = c_long
+        lib.fsk_flush.argtypes = [c_void_p, POINTER(c_ubyte)]
+        lib.fsk_flush.restype = c_long
+        lib.pcm_to_s16.argtypes = [
+            POINTER(c_ubyte),
+            c_long,
+            c_int,
+            c_int,
+            c_int,
+            POINTER(c_int16),
+        ]
+        lib.pcm_to_s16.restype = None
         self.lib = lib
 
+    def demod(self, samples):
+        # Data bits (line levels without NRZI) of the next 16-bit samples
+        samples = array.array("h", samples)
+        n = len(samples)
+        out = bytearray(2 * n * self.baud // self.SR + 2)
+        if not n:
+            return out
+
+        bits = self.lib.fsk_run(
+            self.demod_state,
+            (c_int16 * n).from_buffer(samples),
+            n,
+            (c_ubyte * len(out)).from_buffer(out),
+        )
+        return out[:bits]
+
+    def flush(self):
+        # The last bit of the input, if the PLL had not sampled it yet
+        out = bytearray(1)
+        bits = self.lib.fsk_flush(self.demod_state, (c_ubyte * 1).from_buffer(out))
+        return out[:bits]
+
+    def pack(self, bits):
+        # Raw byte stream, LSB first from the first bit; a partial byte is
+        # kept for the next call
+        bits = self.pending + bytearray(bits)
+        n = len(bits) - len(bits) % 8
+        self.pending = bits[n:]
+        if not n:
+            return b""
+
+        # Bit i is worth 2^i in the little-endian stream, so the reversed
+        # bits read as one base-2 number are the whole stream at once
+        digits = bits[n - 1 :: -1].translate(ASCII_BITS)
+        return int(digits, 2).to_bytes(n // 8, "little")
+
+    def deframe(self, bits):
+        # Payloads of the HDLC frames that end in these bits and pass the
+        # FCS check: flags delimit frames, a 0 after five 1s is stuffing and
+        # seven 1s abort the frame
+        frames = []
+        for bit in bits:
+            if bit:
+                self.ones += 1
+                if self.ones > 6:
+                    self.frame = []
+                    continue
+                self.frame.append(1)
+                continue
+
+            if self.ones == 6:
+                # Flag: what came before it, less its own 0111111, is a frame
+                body = self.frame[:-7]
+                if len(body) >= 24 and len(body) % 8 == 0:
+                    data = bytearray()
+                    for i in range(0, len(body), 8):
+                        data.append(sum(b << k for k, b in enumerate(body[i : i + 8])))
+                    if fcs(data[:-2]) == data[-2] | data[-1] << 8:
+                        frames.append(bytes(data[:-2]))
+                self.frame = []
+            elif self.ones != 5:
+                self.frame.append(0)
+                if len(self.frame) > 8 * self.max_frame:
+                    self.frame = []
+            self.ones = 0
 
-	def decode(self):
-		pass
+        return frames
 
+    def to_s16(self, data, b, ch):
+        if ch == 1 and b == 2:
+            return array.array("h", data)
 
+        n = len(data) // (b * ch)
+        pcm = array.array("h", bytes(2 * n))
+        if n:
+            self.lib.pcm_to_s16(
+                (c_ubyte * len(data)).from_buffer_copy(data),
+                n,
+                b,
+                ch,
+                -1,
+                (c_int16 * n).from_buffer(pcm),
+            )
+        return pcm
 
-if __name__ == '__main__':
+    def decode(self, f, hdlc=False, chunk=1 << 16):
+        # Decode a WAV file object chunk by chunk, yielding the raw byte
+        # stream or the payload of every good HDLC frame. Anything but
+        # 16-bit mono is converted to it, multi-channel input is downmixed.
+        ch, b = f.getnchannels(), f.getsampwidth()
+        while True:
+            data = f.readframes(chunk)
+            if data:
+                bits = self.demod(self.to_s16(data, b, ch))
+            else:
+                bits = self.flush()
+
+            if hdlc:
+                yield from self.deframe(bits)
+            else:
+                yield self.pack(bits)
+
+            if not data:
+                break
+
+    def __del__(self):
+        if getattr(self, "demod_state", None):
+            self.lib.fsk_destroy(self.demod_state)
+            self.demod_state = None
+
+
+def encode(in_path, out_path, sr, wav, frame_len=0):
+    # Whole file as a raw bit stream, or cut into HDLC frames of up to
+    # frame_len bytes
+    if wav:
+        f = wave.open(out_path, "wb")
+    else:
+        f = open(out_path, "wb")
+
+    e = FSKEncoder(f, wav, sr)
+    with open(in_path, "rb") as src:
+        data = src.read()
+
+    if frame_len:
+        for i in range(0, len(data), frame_len):
+            e.encode_frame(data[i : i + frame_len])
+    else:
+        e.encode(data)
+
+    logger.info(f"Wrote {e.sent} bits, {e.last_sample} samples")
+    e.__del__()
+    e.file = None
+    return True
+
+
+def decode(in_path, out_path, hdlc=False):
+    # Demodulated byte stream, or the payloads of the good frames back to
+    # back, written to out_path
+    f = wave.open(in_path, "rb")
+    d = FSKDecoder(f.getframerate())
+    frames = 0
+    with open(out_path, "wb") as out:
+        for data in d.decode(f, hdlc):
+            out.write(data)
+            frames += 1
+
+    if hdlc:
+        logger.info(f"{frames} good frames")
+    f.close()
+    return True
+
+
+if __name__ == "__main__":
     args = sys.argv[1:]
     if len(args) < 2:
+        print("Usage:\n\t./fsk.py --encode IN --out OUT [--sr SR] [--raw] [--hdlc LEN]")
+        print("\t./fsk.py --decode IN.wav --out OUT [--hdlc LEN]")
         sys.exit(1)
 
+    func = None
+    in_path = None
+    out_path = None
+    sr = 44100
+    wav = True
+    frame_len = 0
+    for arg in args:
+        if arg in ["--encode", "--decode"]:
+            func = arg
+            in_path = args[args.index(arg) + 1]
+        elif arg == "--out":
+            out_path = args[args.index(arg) + 1]
+        elif arg == "--sr":
+            sr = int(args[args.index(arg) + 1])
+        elif arg == "--raw":
+            wav = False
+        elif arg == "--hdlc":
+            frame_len = int(args[args.index(arg) + 1])
+
+    if in_path and out_path:
+        if func == "--encode":
+            logger.info(f"Encoding {in_path}...")
+            if encode(in_path, out_path, sr, wav, frame_len):
+                logger.info(f"Wrote output to {out_path}")
+
+        elif func == "--decode":
+            logger.info(f"Decoding {in_path}...")
+            if decode(in_path, out_path, frame_len > 0):
+                logger.info(f"Wrote output to {out_path}")
 
-    logger.info('Done.')
+    logger.info("Done.")
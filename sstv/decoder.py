@@ -1,15 +1,94 @@
+import array
 import ctypes
 import logging
 import math
-import statistics
+import mmap
 import struct
+import time
 import wave
-from ctypes import POINTER, c_double, c_int, c_int32
+from concurrent.futures import ProcessPoolExecutor
+from ctypes import (
+    POINTER,
+    c_double,
+    c_int,
+    c_int16,
+    c_int32,
+    c_long,
+    c_ubyte,
+    c_void_p,
+)
+from multiprocessing import shared_memory
 
 from encoder import *
 
 logger = logging.getLogger(__name__)
 
+# Per-segment frequency estimators, see utils/segments.c
+MODE = 0
+MEDIAN = 1
+MEAN = 2
+
+# Lowest VIS confidence at which a code that cannot be read still counts as
+# a transmission, decoded as the mode given on the command line
+FALLBACK_CONF = 0.2
+
+# Streaming decoder states
+SILENCE = 0
+VOX = 1
+HEADER = 2
+VIS = 3
+IMAGE = 4
+
+
+class Track:
+    # Frequency track with one entry per hop samples, entry j covering the
+    # absolute samples [t0 + j * hop, t0 + (j + 1) * hop). A track of
+    # N-sample windows starting at sample s has t0 = s + center(N, hop), so
+    # every entry covers the middle of its window.
+    def __init__(self, t0, hop, freqs):
+        self.t0 = t0
+        self.hop = hop
+        self.freqs = (
+            freqs if isinstance(freqs, array.array) else array.array("d", freqs)
+        )
+
+    def __len__(self):
+        return len(self.freqs)
+
+    @property
+    def end(self):
+        return self.t0 + len(self.freqs) * self.hop
+
+    def frame(self, i):
+        # Track entry holding sample i
+        return (i - self.t0) // self.hop
+
+    @staticmethod
+    def center(N, hop):
+        return (N - hop) // 2
+
+
+# Worker side of Decoder.decode_region: one decoder per worker process,
+# reading the PCM shared by the parent
+chunk_decoder = None
+
+
+def decode_chunk(
+    shm_name, slen, sr, encoder, mode, start, first, count, N, hop, period
+):
+    global chunk_decoder
+    d = chunk_decoder
+    if not d or d.shm.name != shm_name:
+        d = Decoder(None, None, None, sr)
+        d.shm = shared_memory.SharedMemory(name=shm_name)
+        d.pcm_samples = d.shm.buf[: 2 * slen].cast("h")
+        d.slen = slen
+        chunk_decoder = d
+
+    encoder = encoder(mode=mode, sr=sr)
+    rows = d.decode_span(encoder, start, first, count, N, hop, period)
+    return [bytes(row) for row in rows]
+
 
 class Decoder:
     modes = {
@@ -46,10 +125,16 @@ class Decoder:
         self.sr = samp_rate
         self.encoding = encoding
         self.mode = mode
-        self.pcm_samples = []
+        self.pcm_samples = memoryview(array.array("h"))
         self.slen = 0
+        self.plans = {}
+        self.banks = {}
+        self.jobs = 1
+        self.clock_error = 0.0
+        self.fax_start = None
 
         self.load_libfft()
+        self.stream_reset()
 
     def load_libfft(self):
         lib = ctypes.CDLL("../lib/libfft.so")
@@ -74,154 +159,387 @@ class Decoder:
         lib.fft_mag_pwr.restype = c_double
         lib.mag_log.argtypes = [POINTER(c_double), c_int]
         lib.mag_log.restype = None
+        lib.pcm_to_s16.argtypes = [
+            POINTER(c_ubyte),
+            c_long,
+            c_int,
+            c_int,
+            c_int,
+            POINTER(c_int16),
+        ]
+        lib.pcm_to_s16.restype = None
+        lib.fft_plan_create.argtypes = [c_int]
+        lib.fft_plan_create.restype = c_void_p
+        lib.fft_plan_destroy.argtypes = [c_void_p]
+        lib.fft_plan_destroy.restype = None
+        lib.stft_track.argtypes = [
+            c_void_p,
+            POINTER(c_int16),
+            c_long,
+            c_long,
+            c_long,
+            c_int,
+            c_double,
+            POINTER(c_double),
+        ]
+        lib.stft_track.restype = c_long
+        lib.gbank_create.argtypes = [POINTER(c_double), c_int, c_double, c_int]
+        lib.gbank_create.restype = c_void_p
+        lib.gbank_destroy.argtypes = [c_void_p]
+        lib.gbank_destroy.restype = None
+        for run in [lib.gbank_run, lib.gbank_slide]:
+            run.argtypes = [
+                c_void_p,
+                POINTER(c_int16),
+                c_long,
+                c_long,
+                c_long,
+                c_int,
+                POINTER(c_double),
+            ]
+            run.restype = c_long
+        lib.track_segments.argtypes = [
+            POINTER(c_double),
+            c_long,
+            c_long,
+            c_int,
+            POINTER(c_long),
+            POINTER(c_long),
+            c_long,
+            c_int,
+            c_double,
+            POINTER(c_double),
+        ]
+        lib.track_segments.restype = None
+        lib.hz_to_lum.argtypes = [POINTER(c_double), c_long, POINTER(c_ubyte)]
+        lib.hz_to_lum.restype = None
+        lib.xcorr.argtypes = [
+            POINTER(c_double),
+            c_long,
+            POINTER(c_double),
+            c_long,
+            POINTER(c_double),
+        ]
+        lib.xcorr.restype = c_long
         self.lib = lib
 
-    def read_wav(self, in_path, chunk_size=4096):
+    def plan(self, N):
+        # Real FFT plan (bit reversal, twiddles, window) built once per size
+        if N not in self.plans:
+            self.plans[N] = self.lib.fft_plan_create(N)
+
+        return self.plans[N]
+
+    def tone_bank(self, freqs, N):
+        # Goertzel coefficients for a set of tones, built once per window size
+        key = (tuple(freqs), N, self.sr)
+        if key not in self.banks:
+            f = array.array("d", freqs)
+            bank = self.lib.gbank_create(
+                (c_double * len(f)).from_buffer(f), len(f), self.sr, N
+            )
+            if not bank:
+                raise RuntimeError("Failed to create tone filter bank")
+            self.banks[key] = bank
+
+        return self.banks[key]
+
+    def tone_mags(self, freqs, start, end, N, hop, sliding=False, limit=None):
+        # Magnitude of every tone in each window, packed frame by frame.
+        # Samples from limit on read as silence.
+        limit = min(self.slen, limit if limit is not None else self.slen)
+        frames = max(0, -(-(end - start) // hop))
+        mags = array.array("d", bytes(8 * frames * len(freqs)))
+        if frames:
+            run = self.lib.gbank_slide if sliding else self.lib.gbank_run
+            res = run(
+                self.tone_bank(freqs, N),
+                self.pcm_buffer(),
+                limit,
+                start,
+                end,
+                hop,
+                (c_double * len(mags)).from_buffer(mags),
+            )
+            if res < 0:
+                raise RuntimeError("Failed to compute tone magnitudes")
+
+        return mags
+
+    def read_wav(self, in_path, channel=None):
+        # Memory-map the recording; 16-bit mono is used in place, anything
+        # else is converted once into a compact 16-bit mono buffer.
+        # channel=None downmixes multi-channel input.
         logger.info("Reading WAV samples...")
-        self.pcm_samples = []
 
-        with wave.open(in_path, "r") as f:
-            sr_ = int(f.getframerate())
-            flen = int(f.getnframes())
-            ch = int(f.getnchannels())
-            b = int(f.getsampwidth())
+        with open(in_path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
 
-            i = 0
-            while i < flen:
-                n = min(chunk_size, flen - i)
-                raw = f.readframes(n)
-                self.pcm_samples.extend(struct.unpack("<" + "h" * n, raw))
-                i += n
+        sr_, ch, b, offset, size = self.wav_layout(mm)
+        flen = size // (ch * b)
+        if sr_ != self.sr:
+            logger.warning(f"Using WAV sample rate {sr_} Hz instead of {self.sr} Hz")
+            self.sr = sr_
 
+        raw = memoryview(mm)[offset : offset + flen * ch * b]
+        if ch == 1 and b == 2:
+            self.pcm_samples = raw.cast("h")
+        else:
+            pcm = array.array("h", bytes(2 * flen))
+            if flen:
+                self.lib.pcm_to_s16(
+                    (c_ubyte * len(raw)).from_buffer(raw),
+                    flen,
+                    b,
+                    ch,
+                    -1 if channel is None else channel,
+                    (c_int16 * flen).from_buffer(pcm),
+                )
+            self.pcm_samples = memoryview(pcm)
+
+        self.wav_map = mm
         self.slen = len(self.pcm_samples)
 
-    def find_window_peak(self, win, N):
-        # Select peak in current window
-        b = [1e-10, None]
-        for j, m in enumerate(win):
-            if m > b[0]:
-                b = m, j
-
-        if b[1]:
-            return self.interpolate_mag(win, b[1], N)
-
-        return -1, -1
+    def wav_layout(self, mm):
+        # (rate, channels, sample width, data offset, data size) of a RIFF WAVE
+        if mm[0:4] != b"RIFF" or mm[8:12] != b"WAVE":
+            raise wave.Error("file does not start with RIFF id")
+
+        fmt = None
+        i = 12
+        while i + 8 <= len(mm):
+            cid = mm[i : i + 4]
+            csize = struct.unpack("<I", mm[i + 4 : i + 8])[0]
+            if cid == b"fmt ":
+                tag, ch, sr_, _, _, bits = struct.unpack("<HHIIHH", mm[i + 8 : i + 24])
+                if tag not in (1, 0xFFFE):
+                    raise wave.Error(f"unknown format: {tag}")
+                fmt = (sr_, ch, (bits + 7) // 8)
+            elif cid == b"data":
+                if not fmt:
+                    raise wave.Error("data chunk before fmt chunk")
+                # Clamp to what is on disk, e.g. for a capture still being written
+                return (*fmt, i + 8, min(csize, len(mm) - i - 8))
+
+            i += 8 + csize + (csize & 1)
+
+        raise wave.Error("data chunk missing")
+
+    def pcm_buffer(self):
+        return (c_int16 * self.slen).from_buffer(self.pcm_samples)
+
+    def stft(self, start, end, N, hop):
+        # Packed (peak freq, power) per frame, computed in a single call
+        end = min(end, self.slen)
+        frames = max(0, -(-(end - start) // hop))
+        track = array.array("d", bytes(16 * frames))
+        if frames:
+            self.lib.stft_track(
+                self.plan(N),
+                self.pcm_buffer(),
+                self.slen,
+                start,
+                end,
+                hop,
+                self.sr,
+                (c_double * len(track)).from_buffer(track),
+            )
+
+        return track
 
     def process_image(self, start, elen=None, N=512, hop=128):
         logger.info("Processing PCM stream...")
 
-        DoubleArray = c_double * N
-        hann = DoubleArray(*[0.0] * N)
-        self.lib.hann(hann, N)
+        end = start + elen if elen else self.slen
+        track = self.stft(start, end, N, hop)
         nonsil = start
         prev_pwr = 0
 
-        out = []
-        i = start
-        end = elen if elen else self.slen
-        while i < end:
-            n = min(N, self.slen - i)
-
-            slce = self.pcm_samples[i : i + n]
-            while len(slce) < N:
-                slce.append(0.0)
-
-            real = DoubleArray(*slce)
-            imag = DoubleArray(*[0.0] * N)  # TODO use the double realFFT
+        # Without a start, the first rise in power marks the signal
+        for k in range(0 if nonsil else len(track) // 2):
+            i = start + k * hop
+            pwr = track[2 * k + 1]
 
-            self.lib.filter(real, hann, N)
-            self.lib.fft(real, imag, N)
-
-            mag = DoubleArray(*[0.0] * N)
-            pwr = self.lib.fft_mag_pwr(real, imag, mag, N)
-
-            if not nonsil and pwr > prev_pwr and i > 0:
+            if pwr > prev_pwr and i > 0:
                 nonsil = i
                 print("starting at=", i)
-            else:
-                self.lib.mag_log(mag, N)
-                nf, c = self.find_window_peak(mag, N)
-                if nf > 3000:
-                    nf = abs(nf - self.sr)
-
-                out.append((i, nf))
+                break
 
             prev_pwr = pwr
-            i += min(hop, self.slen - i)
-
-        return nonsil, out
 
-    def find_nonsil(self, N=32, hop=16):
-        # Cheaper way to find first non-silence samples
+        return nonsil, Track(start + Track.center(N, hop), hop, track[0::2])
 
-        DoubleArray = c_double * N
-        hann = DoubleArray(*[0.0] * N)
-        self.lib.hann(hann, N)
-
-        i = 0
+    def find_nonsil(
+        self, N=32, hop=16, thresh=256, block=1 << 16, start=0, coarse=1024, snr=4.0
+    ):
+        # Cheaper way to find first non-silence samples: probe one window of
+        # 4N every coarse samples, then search closely only around a hit.
+        # Header tones last far longer than coarse, so none is skipped.
+        # A hit is above thresh and snr times the noise floor.
+        i = start
         while i < self.slen:
-            n = min(N, self.slen - i)
-
-            slce = self.pcm_samples[i : i + n]
-            while len(slce) < N:
-                slce.append(0.0)
-
-            real = DoubleArray(*slce)
-            self.lib.filter(real, hann, N)
-            if self.lib.goertzel(real, 1900, self.sr, N):
+            lo, hi = i, self.slen
+            if coarse:
+                hit = self.scan_tone(
+                    1900, 4 * N, coarse, thresh, block, i, self.slen, snr
+                )
+                if hit == self.slen:
+                    return self.slen
+                lo, hi = max(i, hit - coarse), min(self.slen, hit + 4 * N)
+
+            i = self.scan_tone(1900, N, hop, thresh, block, lo, hi, snr)
+            if i < hi:
                 if i - N > 0:
                     i -= N
                 return i
 
-            i += min(hop, self.slen - i)
+            i = hi
 
         return i
 
-    def process_header(self, start, elen, N=64, hop=32):
-        DoubleArray = c_double * N
-        hann = DoubleArray(*[0.0] * N)
-        self.lib.hann(hann, N)
-        out = []
-
+    def scan_tone(self, freq, N, hop, thresh, block, start, end, snr=4.0):
+        # Start of the first window whose magnitude at freq exceeds thresh
+        # and snr times the noise floor: the mean magnitude of the windows
+        # below it, a running mean of about the last 32 once there are that
+        # many. The floor is kept for unit window length (the magnitude of
+        # white noise falls as 1 / sqrt(N)), so probes of any length share it.
+        scale = math.sqrt(N)
         i = start
-        while i < start + elen:
-            n = min(N, start + elen - i)
-
-            slce = self.pcm_samples[i : i + n]
-            while len(slce) < N:
-                slce.append(0.0)
-
-            real = DoubleArray(*slce)
-            self.lib.filter(real, hann, N)
-            freqs = [1100, 1200, 1300, 1500, 1900, 2300]
-            g = [self.lib.goertzel(real, float(f), self.sr, N) for f in freqs]
-            mg = max(g)
-            m = freqs[g.index(mg)]
-            out.append((i, m))
+        while i < end:
+            e = min(end, i + block * hop)
+            mags = self.tone_mags([freq], i, e, N, hop)
 
-            i += min(hop, start + elen - i)
+            for k, m in enumerate(mags):
+                if m > max(thresh, snr * self.noise / scale):
+                    return i + k * hop
+                self.noise_n = min(self.noise_n + 1, 32)
+                self.noise += (m * scale - self.noise) / self.noise_n
 
-        return i, out
+            i = e
 
-    def interpolate_mag(self, mags, ind, N):
-        # https://ccrma.stanford.edu/~jos/sasp/Quadratic_Interpolation_Spectral_Peaks.html
+        return end
 
-        nf = ind * self.sr / N
-        c = mags[ind]
+    def process_header(self, start, elen, N=64, hop=32):
+        freqs = [1100, 1200, 1300, 1500, 1900, 2300]
+        end = start + elen
+        mags = self.tone_mags(freqs, start, end, N, hop, limit=end)
+        out = array.array("d")
+
+        k = len(freqs)
+        for j in range(len(mags) // k):
+            g = mags[j * k : (j + 1) * k]
+            out.append(freqs[g.index(max(g))])
+
+        return end, Track(start + Track.center(N, hop), hop, out)
+
+    def segments(self, track, starts, ends, method=MODE, binw=10):
+        # One estimate per [start, end) segment of a Track; a plain sequence
+        # is taken as a per-sample track starting at sample 0
+        if not isinstance(track, Track):
+            track = Track(0, 1, track)
+
+        freqs = track.freqs
+        starts = array.array("l", starts)
+        ends = array.array("l", ends)
+        n = len(starts)
+        out = array.array("d", bytes(8 * n))
+        if n and len(freqs):
+            self.lib.track_segments(
+                (c_double * len(freqs)).from_buffer(freqs),
+                len(freqs),
+                track.t0,
+                track.hop,
+                (c_long * n).from_buffer(starts),
+                (c_long * n).from_buffer(ends),
+                n,
+                method,
+                binw,
+                (c_double * n).from_buffer(out),
+            )
+        elif n:
+            out = array.array("d", [-1.0] * n)
+
+        return out
+
+    def hz_to_lum(self, freqs):
+        out = bytearray(len(freqs))
+        if freqs:
+            self.lib.hz_to_lum(
+                (c_double * len(freqs)).from_buffer(freqs),
+                len(freqs),
+                (c_ubyte * len(out)).from_buffer(out),
+            )
+
+        return out
+
+    def xcorr(self, x, t):
+        # out[k] = sum of x[i + k] * t[i], for every lag with t inside x
+        x = array.array("d", x)
+        t = array.array("d", t)
+        n = len(x) - len(t) + 1
+        out = array.array("d", bytes(8 * max(n, 0)))
+        if n > 0 and len(t):
+            self.lib.xcorr(
+                (c_double * len(x)).from_buffer(x),
+                len(x),
+                (c_double * len(t)).from_buffer(t),
+                len(t),
+                (c_double * n).from_buffer(out),
+            )
+
+        return out
+
+    def fax_front(self, start, track, header=True, margin=2.0):
+        # (start, confidence) of the FAX header and phasing interval, or of
+        # the phasing interval alone, found within +-margin seconds of start:
+        # the track is cross-correlated with the expected tone pattern in a
+        # single pass instead of being walked segment by segment. Tones are
+        # scored -1 (1200 Hz) .. +1 (2300 Hz) around the 1750 Hz midpoint.
+        encoder = FAXEncoder(mode="FAX480", sr=self.sr)
+        timing = encoder.timing()
+        line = float(timing.seconds)
+        sync = encoder.sync_ms
+        head = 2440 * 0.00205 if header else 0.0
+        hop = track.hop
+
+        def score(f):
+            return 0.0 if f < 0 else max(-1.0, min(1.0, (f - 1750) / 550))
+
+        def expected(t):
+            if t < head:
+                return [2300, 1500][int(t / 0.00205) % 2]
+            return 1200 if (t - head) % line < sync else 2300
+
+        nt = int((head + 20 * line) * self.sr) // hop
+        tmpl = [score(expected((i * hop + hop / 2) / self.sr)) for i in range(nt)]
+        mean = sum(tmpl) / nt
+        tmpl = [v - mean for v in tmpl]
+
+        j0 = track.frame(start - int(margin * self.sr))
+        j1 = track.frame(start + int(margin * self.sr)) + nt
+        x = [
+            score(track.freqs[j]) if 0 <= j < len(track) else 0.0 for j in range(j0, j1)
+        ]
+        corr = self.xcorr(x, tmpl)
+        if not corr:
+            return start, 0.0
 
-        if not (ind - 1 > 0 and ind + 1 < len(mags)):
-            return nf, c
+        k = max(range(len(corr)), key=corr.__getitem__)
 
-        p = mags[ind - 1]
-        n = mags[ind + 1]
+        # Sub-frame peak position from a parabola through its neighbours
+        d = 0.0
+        if 0 < k < len(corr) - 1:
+            den = corr[k - 1] - 2 * corr[k] + corr[k + 1]
+            d = 0.5 * (corr[k - 1] - corr[k + 1]) / den if den else 0.0
 
-        # Consider only if local peak
-        if c > p and c > n:
-            d = 0.5 * (p - n) / (p - 2 * c + n)
-            nf = (ind + d) * (self.sr / N)
-            return nf, c - 0.25 * (p - n) * d
+        # Normalized correlation; the template has zero mean, so only the
+        # spread of the track under it counts
+        sx = sum(x[k : k + nt])
+        sxx = sum(v * v for v in x[k : k + nt])
+        norm = math.sqrt(max(sxx - sx * sx / nt, 0.0) * sum(v * v for v in tmpl))
+        conf = corr[k] / norm if norm else 0.0
 
-        return nf, c
+        return track.t0 + (j0 + k + d) * hop, conf
 
     def parse_samples(self, fft_res):
         recording = []
@@ -244,43 +562,94 @@ class Decoder:
 
         return recording
 
-    def decode_VIS(self, start, freqs):
-        step = int(math.ceil(self.sr * 0.03))
-        bits = []
-        i = start
-        sb = 0
-
-        while len(bits) < 8 and i < len(freqs) - step:
-            win = [round(f, -1) for f in freqs[i : i + step]]
-            bit = int(statistics.mode(win))
-
-            if sb > 1:
-                break
-
-            if sb > 0:
-                bits.append(bit)
-
-            if abs(1200 - bit) < 50:
-                sb += 1
-
-            i += step
-
-        if len(bits) != 8:
-            return i, None
-
-        m = {1100: 1, 1300: 0}
-        vis_raw = [m[b] for b in bits[0:7]]
-        parity_raw = m[bits[7]]
+    def decode_VIS(self, start, track, search=0.35, min_conf=0.6):
+        # Matched filter over the VIS code: every candidate start within
+        # +-search seconds of start is scored against the end of the leader
+        # (1900 Hz), the start bit, 8 bits of 1100 or 1300 Hz and the stop
+        # bit (1200 Hz) at once, from running sums of each frame's distance
+        # to those tones. Candidates are tried a track hop apart, then every
+        # sample around the best. Returns (image start, info) with info
+        # holding the mode (None if unknown or rejected), the code, parity,
+        # bits, start of the start bit and a 0..1 confidence.
+        step = self.sr * 0.03
+        cap = 200.0
+
+        def cost(s, bits=None):
+            def seg(hz, k):
+                return self.track_sum(
+                    track, tones[hz], s + k * step, s + (k + 1) * step, cap
+                )
+
+            c = seg(1900, -1) + seg(1200, 0) + seg(1200, 9)
+            for k in range(1, 9):
+                one, zero = seg(1100, k), seg(1300, k)
+                c += min(one, zero)
+                if bits is not None:
+                    bits.append(int(one < zero))
+            return c
+
+        hop = track.hop
+        lo = start - search * self.sr
+        cands = [lo + k * hop for k in range(int(2 * search * self.sr / hop) + 1)]
+        tones = {hz: self.tone_costs(track, hz, cap) for hz in (1100, 1200, 1300, 1900)}
+        s = min(cands, key=cost)
+
+        # Bit edges are only as sharp as the track, so the final search
+        # runs on a fine track of just the VIS code
+        N, fine = 64, 16
+        a = max(self.base, math.floor(s - 2 * step - hop))
+        b = min(self.base + self.slen, math.ceil(s + 12 * step + hop))
+        freqs = self.stft(a - self.base, b - self.base, N, fine)[0::2]
+        track = Track(a + Track.center(N, fine), fine, freqs)
+        tones = {hz: self.tone_costs(track, hz, cap) for hz in (1100, 1200, 1300, 1900)}
+        s = min((s + d for d in range(-hop, hop + 1)), key=cost)
 
-        print(vis_raw, parity_raw)
-
-        vis = self.bin_to_dec_lsb(vis_raw)
-        parity = [1, 0][sum(vis_raw) % 2 == 0]
-
-        if parity == parity_raw and vis in self.modes:
-            return i, self.modes[vis]
-
-        return i, bits
+        bits = []
+        c = cost(s, bits)
+        conf = max(0.0, 1 - c / (11 * step * cap))
+
+        vis = self.bin_to_dec_lsb(bits[0:7])
+        parity = bits[7] == sum(bits[0:7]) % 2
+        mode = self.modes.get(vis) if parity and conf >= min_conf else None
+        check = "ok" if parity else "bad"
+        logger.info(
+            f"VIS {vis} at sample {s:.1f}: parity {check}, confidence {conf:.2f}"
+        )
+
+        # The image starts right after the stop bit
+        end = s + 10 * step
+        return end, {
+            "mode": mode,
+            "code": vis,
+            "bits": bits,
+            "parity": parity,
+            "start": s,
+            "confidence": conf,
+        }
+
+    def tone_costs(self, track, hz, cap):
+        # Running sum over the track of each frame's distance to hz, capped;
+        # out[j] covers frames 0 .. j - 1
+        out = array.array("d", [0.0])
+        acc = 0.0
+        for f in track.freqs:
+            acc += min(abs(f - hz), cap) if f >= 0 else cap
+            out.append(acc)
+        return out
+
+    def track_sum(self, track, costs, a, b, cap):
+        # Sample-weighted sum of the frame costs over samples [a, b), frames
+        # outside the track costing cap
+        def upto(x):
+            j = math.floor((x - track.t0) / track.hop)
+            if j < 0:
+                return (x - track.t0) * cap
+            if j >= len(track):
+                return costs[-1] * track.hop + (x - track.end) * cap
+            frac = (x - track.t0) / track.hop - j
+            return (costs[j] + frac * (costs[j + 1] - costs[j])) * track.hop
+
+        return upto(b) - upto(a)
 
     def bin_to_dec_lsb(self, bits_list, n=0x40):
         res = 0
@@ -289,84 +658,544 @@ class Decoder:
                 res |= n >> i
         return res
 
-    def decode_phasing_interval(self, start, freqs):
-        bits = []
-        i = start
-        return i, bits
+    def decode_phasing_interval(self, start, track):
+        # Image start and the sync pulse of every phasing line; the image
+        # start located along with the header is used when there is one
+        timing = FAXEncoder(mode="FAX480", sr=self.sr).timing()
+        i, self.fax_start = self.fax_start, None
+        if i is None:
+            i, conf = self.fax_front(start, track, header=False)
+            if conf < 0.5:
+                return start + 20 * float(timing.samples), []
+            i += 20 * float(timing.samples)
+
+        pulses = [
+            i - (20 - k) * float(timing.samples) + timing.sync[0] for k in range(20)
+        ]
+        return i, pulses
+
+    def decode_lines(self, encoder, start, track, first, count, period=None):
+        # RGB rows of scanlines first .. first + count - 1 of an image
+        # starting at sample start, lines period samples apart if measured
+        # (see sync_lines). Every pixel slot of every line is estimated in a
+        # single pass, the encoder then rebuilds its rows from the values.
+        length = encoder.timing().samples
+        scale = period / float(length) if period else None
+
+        layouts = {}
+        starts = []
+        ends = []
+        for j in range(first, first + count):
+            timing = encoder.timing(encoder.line_variant(j))
+            if timing not in layouts:
+                kinds = timing.kinds
+                slots = [k for k, m in enumerate(kinds) if m < SYNC]
+                # Where each run of same-kind pixels begins
+                runs = [
+                    (n, kinds[k])
+                    for n, k in enumerate(slots)
+                    if k == 0 or kinds[k - 1] != kinds[k]
+                ]
+                layouts[timing] = slots, runs
+
+            slots, _ = layouts[timing]
+            if period:
+                line_start = start + j * period
+                b = [math.floor(line_start + 0.5)] + timing.bounds(line_start, scale)
+            else:
+                line_start = Fraction(start) + j * length
+                b = [to_sample(line_start)] + timing.bounds(line_start)
+            starts += [b[k] for k in slots]
+            ends += [b[k + 1] for k in slots]
 
-    def hz_to_rgb(self, freq):
-        return max(0, min(255, int(round((freq - 1500.0) / 3.1372549))))
+        lum = self.hz_to_lum(self.segments(track, starts, ends, MEDIAN, 1))
 
-    def decode_image(self, encoder, mode, start, freqs):
-        encoder = encoder()
-        em = encoder.opts[mode]
-        h = em["height"]
-        w = em["width"]
+        w = encoder.enc["width"]
+        lines = []
+        i = 0
+        for j in range(first, first + count):
+            slots, runs = layouts[encoder.timing(encoder.line_variant(j))]
+            lines.append({m: lum[i + n : i + n + w] for n, m in runs})
+            i += len(slots)
 
-        pixels = [[0] * (w * 3) for _ in range(h)]
+        g = encoder.line_group
+        pixels = []
+        for k in range(0, count, g):
+            pixels += encoder.decode_rows(lines[k : k + g])
 
-        i = 0
-        j = 0
-        w = 0
-        while j < h:
-            for s, m in encoder.decode_sequence(self.sr):
-                if m <= 2:
-                    rgb = self.hz_to_rgb(statistics.mode(freqs[i : i + s]))
-                    pixels[j][w * 3 + m] = rgb
-                    w += 1
-                else:
-                    w = 0
-
-                i += s
-            j += 1
+        return pixels
+
+    def decode_region(self, encoder, mode, start, N=64, hop=16, period=None):
+        # Image starting at sample start, decoded straight from the PCM: the
+        # track is only computed over the image, and with jobs > 1 line
+        # chunks are decoded in worker processes sharing the PCM buffer
+        enc = encoder(mode=mode, sr=self.sr)
+        h = enc.line_count()
+        if self.jobs <= 1:
+            return self.decode_span(enc, start, 0, h, N, hop, period)
+
+        shm = shared_memory.SharedMemory(create=True, size=max(1, 2 * self.slen))
+        try:
+            shm.buf[: 2 * self.slen] = memoryview(self.pcm_samples).cast("B")
+            per = max(1, -(-h // (4 * self.jobs)))
+            per += -per % enc.line_group
+            with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+                futures = [
+                    pool.submit(
+                        decode_chunk,
+                        shm.name,
+                        self.slen,
+                        self.sr,
+                        encoder,
+                        mode,
+                        start,
+                        first,
+                        min(per, h - first),
+                        N,
+                        hop,
+                        period,
+                    )
+                    for first in range(0, h, per)
+                ]
+
+                pixels = []
+                for future in futures:
+                    pixels += [bytearray(row) for row in future.result()]
+        finally:
+            shm.close()
+            shm.unlink()
 
         return pixels
 
-    def decode_vox(self, start, freqs):
-        bits = []
+    def decode_span(self, encoder, start, first, count, N, hop, period=None):
+        # Lines first .. first + count - 1 from a track computed over just
+        # those lines, on the frame grid of a track starting at start, so
+        # chunks match a single pass over the whole image
+        length = period or encoder.timing().samples
+        origin = math.floor(start + 0.5)
+        c = Track.center(N, hop)
+        a = math.floor(start + first * length)
+        b = math.ceil(start + (first + count) * length)
+        # No frame starts before the recording
+        k0 = max((a - origin - c) // hop, -(origin // hop))
+        k1 = -(-(b - origin - c) // hop)
+
+        t0 = origin + k0 * hop
+        track = Track(t0 + c, hop, self.stft(t0, origin + k1 * hop, N, hop)[0::2])
+        return self.decode_lines(encoder, start, track, first, count, period)
+
+    def find_syncs(self, encoder, start, search=None):
+        # (line, sample, strength) of every line's sync pulse: a 1200 Hz
+        # Goertzel window as long as the pulse is slid over +-search samples
+        # around where the line should have it and peaks where it covers the
+        # pulse. Predictions follow a running fit of the pulses found so
+        # far, so a clock error does not walk out of the search window.
+        timing = encoder.timing()
+        offset, length = timing.sync
+        N = max(16, int(length))
+        hop = max(1, N // 32)
+        search = search or N
+        period = float(timing.samples)
+
+        syncs = []
+        fit = [0.0] * 5  # n, sum j, sum p, sum j*j, sum j*p
+        strengths = []
+        for j in range(encoder.line_count()):
+            if fit[0] >= 2:
+                n, sj, sp, sjj, sjp = fit
+                period = (n * sjp - sj * sp) / (n * sjj - sj * sj)
+                p = (sp - period * sj) / n + period * j
+            else:
+                p = start + offset + j * period
+
+            a = max(0, int(p) - search)
+            end = int(p) + search + 1
+            if end + N > self.slen:
+                break
+
+            mags = self.tone_mags([1200], a, end, N, hop, sliding=True)
+            k = max(range(len(mags)), key=mags.__getitem__)
+
+            # Sub-hop peak position from a parabola through its neighbours
+            d = 0.0
+            if 0 < k < len(mags) - 1:
+                den = mags[k - 1] - 2 * mags[k] + mags[k + 1]
+                d = 0.5 * (mags[k - 1] - mags[k + 1]) / den if den else 0.0
+
+            pos = a + (k + d) * hop
+            syncs.append((j, pos, mags[k]))
+
+            # Only clear pulses steer the prediction
+            strengths.append(mags[k])
+            if mags[k] >= 0.5 * sorted(strengths)[len(strengths) // 2]:
+                for i, v in enumerate([1, j, pos, j * j, j * pos]):
+                    fit[i] += v
+
+        return syncs
+
+    def sync_lines(self, encoder, mode, start):
+        # Start and period of the lines fitted to their sync pulses; the
+        # relative clock error (receiver vs sender) goes to self.clock_error
+        encoder = encoder(mode=mode, sr=self.sr)
+        timing = encoder.timing()
+        start += float(encoder.image_offset())
+        syncs = self.find_syncs(encoder, start)
+
+        strong = sorted(m for _, _, m in syncs)
+        pts = [
+            (j, p)
+            for j, p, m in syncs
+            if strong and m >= 0.5 * strong[len(strong) // 2]
+        ]
+        if len(pts) < 2:
+            self.clock_error = 0.0
+            return start, None
+
+        # Least squares, refitted without the outliers of the first pass
+        for _ in range(2):
+            n = len(pts)
+            sj = sum(j for j, _ in pts)
+            sp = sum(p for _, p in pts)
+            sjj = sum(j * j for j, _ in pts)
+            sjp = sum(j * p for j, p in pts)
+            period = (n * sjp - sj * sp) / (n * sjj - sj * sj)
+            base = (sp - period * sj) / n
+
+            res = sorted(abs(p - base - period * j) for j, p in pts)
+            lim = max(2.0, 3 * res[len(res) // 2])
+            kept = [(j, p) for j, p in pts if abs(p - base - period * j) <= lim]
+            if len(kept) < 2 or len(kept) == len(pts):
+                break
+            pts = kept
+
+        self.clock_error = period / float(timing.samples) - 1
+        return base - timing.sync[0], period
+
+    def decode_vox(self, start, track):
         step = int(math.ceil(self.sr * 0.1))
-        for i in range(start, start + step * 8, step):
-            win = [round(f, -1) for f in freqs[i : i + step]]
-            bits.append(statistics.mode(win))
+        starts = list(range(start, start + step * 8, step))
+        bits = list(self.segments(track, starts, [i + step for i in starts]))
 
-        return i, bits
+        return starts[-1], bits
+
+    def decode_header(self, start, track, is_fax):
+        # Leader tones of an SSTV header, or for FAX a dict with the start,
+        # the fax_front confidence and whether that is enough to go on
+        if is_fax:
+            # The whole front is matched at once; the image start is kept
+            # for decode_phasing_interval
+            timing = FAXEncoder(mode="FAX480", sr=self.sr).timing()
+            i, conf = self.fax_front(start, track)
+            header = {"start": i, "confidence": conf, "found": conf >= 0.5}
+            if not header["found"]:
+                return start + math.ceil(2440 * 0.00205 * self.sr), header
+
+            self.fax_start = i + 20 * float(timing.samples) + 2440 * 0.00205 * self.sr
+            return i + 2440 * 0.00205 * self.sr, header
 
-    def decode_header(self, start, freqs, is_fax):
         bits = []
         i = start
+        step1 = (1900, int(math.ceil(self.sr * 0.3)))
+        step2 = (1200, int(math.ceil(self.sr * 0.01)))
+        steps = [step1, step2, step1]
+        sidx = 0
+
+        while len(bits) < 3 and i < track.end and sidx < len(steps):
+            sf, s = steps[sidx]
+            bit = self.segments(track, [i], [i + s])[0]
+            if bit == sf:
+                sidx += 1
+                bits.append(bit)
 
-        if is_fax:
-            step = int(math.ceil(self.sr * 0.00205))
-            steps = [(2300, step), (1500, step)]
-            sidx = False
+            i += s
 
-            while len(bits) < 1220 * 2 and i < len(freqs):
-                sf, s = steps[sidx]
-                win = [round(f, -1) for f in freqs[i : i + s]]
-                bit = statistics.mode(win)
-                if bit == sf:
-                    sidx = not sidx
-                    bits.append(bit)
+        return i, bits
 
-                i += s
+    def stream_reset(self, intro=False, N=512, hop=128):
+        # Empty rolling buffer and track; the state machine starts in SILENCE
+        self.intro = intro
+        self.ring = array.array("h")
+        self.pcm_samples = self.ring
+        self.slen = 0
+        self.base = 0
+        self.pos = 0
+        self.trigger = 0
+        self.noise = 0.0
+        self.noise_n = 0
+        self.state = SILENCE
+        self.live = Track(0, hop, array.array("d"))
+        self.win = N
+        self.image = None
+
+    def feed(self, samples, final=False):
+        # Append 16-bit mono samples to the rolling buffer and return the
+        # scanlines they complete, as (line, row) pairs. With final set the
+        # stream has ended and the last windows are padded with silence.
+        self.ring.extend(samples)
+        self.slen = len(self.ring)
+
+        lines = []
+        while self.advance(lines, final):
+            pass
+
+        self.trim()
+        return lines
+
+    def extend_track(self, final=False):
+        # Track frames whose window is complete
+        rel = self.live.end - Track.center(self.win, self.live.hop) - self.base
+        end = self.slen if final else self.slen - self.win + 1
+        if end > rel:
+            self.live.freqs.extend(self.stft(rel, end, self.win, self.live.hop)[0::2])
+
+        return self.live.end
+
+    def advance(self, lines, final=False):
+        # One state machine step; False when more samples are needed.
+        # Silence is skipped with the tone scan alone, the track is only
+        # computed from where a signal starts.
+        if self.state == SILENCE:
+            i = self.find_nonsil(start=max(0, self.pos - self.base))
+            if i >= self.slen:
+                self.pos = max(self.pos, self.base + self.slen - self.win)
+                return False
+
+            self.pos = self.trigger = self.base + i
+            c = Track.center(self.win, self.live.hop)
+            self.live = Track(self.pos + c, self.live.hop, array.array("d"))
+            self.state = VOX if self.intro else HEADER
+            logger.info(f"Signal at sample {self.pos}")
+            return True
+
+        # The coarse track only serves the header and VIS code
+        if self.state != IMAGE:
+            have = self.extend_track(final)
+
+        if self.state == VOX:
+            if have < self.pos + 8 * math.ceil(self.sr * 0.1):
+                return False
+
+            self.pos, vox = self.decode_vox(self.pos, self.live)
+            self.state = HEADER
+
+        elif self.state == HEADER:
+            if self.encoding == "FAX":
+                # Header, phasing interval and the margin fax_front searches
+                timing = FAXEncoder(mode="FAX480", sr=self.sr).timing()
+                need = (
+                    math.ceil(2440 * 0.00205 * self.sr + 20 * timing.samples)
+                    + 2 * self.sr
+                )
+            else:
+                need = 2 * (2 * math.ceil(self.sr * 0.3) + math.ceil(self.sr * 0.01))
 
-        else:
-            step1 = (1900, int(math.ceil(self.sr * 0.3)))
-            step2 = (1200, int(math.ceil(self.sr * 0.01)))
-            steps = [step1, step2, step1]
-            sidx = 0
+            if have < self.pos + need:
+                return False
 
-            while len(bits) < 3 and i < len(freqs) and sidx < len(steps):
-                sf, s = steps[sidx]
-                win = [round(f, -1) for f in freqs[i : i + s]]
-                bit = statistics.mode(win)
-                if bit == sf:
-                    sidx += 1
-                    bits.append(bit)
+            is_fax = self.encoding == "FAX"
+            i, header = self.decode_header(self.pos, self.live, is_fax)
+            found = header["found"] if is_fax else len(header) == 3
+            if found:
+                self.pos = math.floor(i)
+                self.state = VIS
+            else:
+                # The walk may have run past a real leader: look again just
+                # after the sample the tone scan fired on
+                self.pos = self.trigger + self.live.hop
+                self.state = SILENCE
+
+        elif self.state == VIS:
+            if self.encoding == "FAX":
+                i, phint = self.decode_phasing_interval(self.pos, self.live)
+                vis = (FAXEncoder, "FAX480") if phint else None
+                fallback = self.mode
+            else:
+                # The code may start up to 0.35 s either side of here
+                if have < self.pos + math.ceil(self.sr * (0.35 + 0.33)) + self.live.hop:
+                    return False
+                i, info = self.decode_VIS(self.pos, self.live)
+                vis = info["mode"]
+                fallback = self.mode and info["confidence"] >= FALLBACK_CONF
+
+            if not (isinstance(vis, tuple) or fallback):
+                logger.warning(f"No VIS code at sample {self.pos}")
+                self.pos = max(self.pos + math.ceil(self.sr * 0.03), math.floor(i))
+                self.state = SILENCE
+                return True
+
+            if isinstance(vis, tuple):
+                encoder, mode = vis
+            else:
+                encoder, mode = Decoder.modes[self.fallback_vis()]
+
+            encoder = encoder(mode=mode, sr=self.sr)
+            self.image = {
+                "encoder": encoder,
+                "mode": mode,
+                "width": encoder.enc["width"],
+                "height": encoder.enc["height"],
+                "start": Fraction(i) + encoder.image_offset(),
+                "line": 0,
+                "row": 0,
+            }
+            self.pos = math.floor(i)
+            self.state = IMAGE
+            logger.info(f"Decoding {mode} image at sample {i}")
+
+        elif self.state == IMAGE:
+            # Lines come from a fine track of their own over the buffered
+            # PCM, as in decode_region; its last window runs N samples past
+            # the end of the last line. At the end of the stream whatever
+            # is left is decoded.
+            N, hop = 64, 16
+            img = self.image
+            encoder = img["encoder"]
+            timing = encoder.timing()
+            have = math.inf if final else self.base + self.slen - N
+            first = img["line"]
+            j = first
+            while j < encoder.line_count():
+                end = to_sample(img["start"] + (j + 1) * timing.samples)
+                if have < end:
+                    break
+                j += 1
+
+            # Whole groups only, e.g. the line pairs of Robot 36
+            j -= (j - first) % encoder.line_group
+            if j == first:
+                return False
+
+            start = img["start"] - self.base
+            rows = self.decode_span(encoder, start, first, j - first, N, hop)
+            lines += list(zip(range(img["row"], img["row"] + len(rows)), rows))
+            img["line"] = j
+            img["row"] += len(rows)
+            self.pos = to_sample(img["start"] + j * timing.samples)
+
+            if j == encoder.line_count():
+                self.state = SILENCE
+
+        return True
+
+    def fallback_vis(self):
+        # VIS code of the mode given on the command line
+        for vis, (encoder, mode) in Decoder.modes.items():
+            if mode == self.mode and (
+                self.encoding is None or self.encoding in encoder.__name__
+            ):
+                return vis
+
+    def trim(self, keep=1 << 16):
+        # Drop samples and track frames before the current position, in
+        # blocks so the buffer is not shifted on every chunk
+        coarse = self.state not in (SILENCE, IMAGE)
+        drop = min(self.pos, self.live.end) if coarse else self.pos
+        drop -= self.win + self.base
+        if drop < keep:
+            return
+
+        del self.ring[:drop]
+        self.base += drop
+        self.slen = len(self.ring)
+
+        if not coarse:
+            return
+
+        frames = (self.pos - self.live.t0) // self.live.hop - 1
+        if frames > 0:
+            del self.live.freqs[:frames]
+            self.live.t0 += frames * self.live.hop
+
+    def stream(self, f, intro=False, chunk=1 << 14, follow=False, poll=0.5):
+        # Decode a recording as it arrives from a file object: stdin, a pipe
+        # or a capture still being written (follow=True waits for more data
+        # at EOF). A RIFF header is parsed, anything else is taken as raw
+        # 16-bit mono. Yields (line, row) for every decoded scanline.
+        # The 2.05 ms FAX header tones need a finer track
+        N, hop = (64, 16) if self.encoding == "FAX" else (512, 128)
+        self.stream_reset(intro, N, hop)
+        read = getattr(f, "read1", f.read)
+
+        def more(n):
+            data = read(n)
+            while not data and follow:
+                time.sleep(poll)
+                data = read(n)
+            return data
+
+        head = b""
+        while len(head) < 12:
+            data = more(12 - len(head))
+            if not data:
+                return
+            head += data
+
+        ch, b = 1, 2
+        pending = head
+        if head[0:4] == b"RIFF" and head[8:12] == b"WAVE":
+            pending = b""
+            while True:
+                cid, csize = struct.unpack("<4sI", self.stream_read(more, 8))
+                if cid == b"data":
+                    break
+
+                body = self.stream_read(more, csize + (csize & 1))
+                if cid == b"fmt ":
+                    tag, ch, sr_, _, _, bits = struct.unpack("<HHIIHH", body[0:16])
+                    if tag not in (1, 0xFFFE):
+                        raise wave.Error(f"unknown format: {tag}")
+                    b = (bits + 7) // 8
+                    if sr_ != self.sr:
+                        logger.warning(
+                            f"Using WAV sample rate {sr_} Hz instead of {self.sr} Hz"
+                        )
+                        self.sr = sr_
+
+        fb = ch * b
+        while True:
+            data = pending + more(chunk)
+            if len(data) == len(pending):
+                yield from self.feed([], final=True)
+                break
 
-                i += s
+            n = len(data) // fb
+            pending = data[n * fb :]
+            raw = data[: n * fb]
 
-        return i, bits
+            if ch == 1 and b == 2:
+                pcm = array.array("h", raw)
+            else:
+                pcm = array.array("h", bytes(2 * n))
+                if n:
+                    self.lib.pcm_to_s16(
+                        (c_ubyte * len(raw)).from_buffer_copy(raw),
+                        n,
+                        b,
+                        ch,
+                        -1,
+                        (c_int16 * n).from_buffer(pcm),
+                    )
+
+            yield from self.feed(pcm)
+
+    def stream_read(self, more, n):
+        data = b""
+        while len(data) < n:
+            part = more(n - len(data))
+            if not part:
+                raise wave.Error("truncated WAV header")
+            data += part
+
+        return data
 
     def __del__(self):
-        self.file.close()
+        for plan in self.plans.values():
+            self.lib.fft_plan_destroy(plan)
+        self.plans = {}
+
+        for bank in self.banks.values():
+            self.lib.gbank_destroy(bank)
+        self.banks = {}
+
+        if self.file:
+            self.file.close()
@@ -11,21 +11,5 @@ if [[ -z $SOURCE || -z $OUT || -z $ENC || -z $MODE ]]; then
 	exit -1
 fi
 
-RESIZED="$SOURCE.tmp"
-
-# Get required img size for chosen mode
-SIZE=$(./sstv.py --get_size --encoding $ENC --mode $MODE)
-
-if [[ -z $SIZE ]]; then
-	echo "Invalid encoding or mode provided"
-	exit -2
-fi
-
-# Re-size img and save to tmp file
-magick $SOURCE -resize $SIZE\! $RESIZED
-
-# Run encoder
-./sstv.py --encode $RESIZED --encoding $ENC --mode $MODE --vox --out $OUT
-
-# Cleanup
-rm $RESIZED
+# Re-size img to the mode's resolution and run encoder
+./sstv.py --encode $SOURCE --encoding $ENC --mode $MODE --vox --resize stretch --out $OUT
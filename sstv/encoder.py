@@ -1,20 +1,103 @@
 import array
+import ctypes
 import logging
 import math
-from functools import lru_cache
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from ctypes import POINTER, c_double, c_int, c_int16, c_long
+from fractions import Fraction
+
+from img import ycc_planes, ycc_to_rgb
 
 logger = logging.getLogger(__name__)
 
+# Non-pixel slot kinds in a line layout, pixel slots use their channel index
+SYNC = 10
+PORCH = 11
+
+
+def to_sample(t):
+    # Round a Fraction sample position half-up to an integer sample
+    return (2 * t.numerator + t.denominator) // (2 * t.denominator)
+
+
+class Timing:
+    # Sample boundaries of one scanline, compiled with exact rational
+    # arithmetic so long transmissions do not drift
+
+    def __init__(self, layout, sr):
+        self.kinds = [kind for _, kind in layout]
+
+        t = Fraction(0)
+        ends = []
+        self.sync = None
+        for t_ms, kind in layout:
+            if kind == SYNC and self.sync is None:
+                # (offset, length) of the first sync pulse, in samples
+                self.sync = (float(t), float(Fraction(str(t_ms)) * sr))
+
+            t += Fraction(str(t_ms)) * sr
+            ends.append(t)
+
+        self.den = math.lcm(*[e.denominator for e in ends])
+        self.ends = [e.numerator * (self.den // e.denominator) for e in ends]
+        self.samples = t
+        self.seconds = t / sr
+
+    def bounds(self, start, scale=None):
+        # Absolute end sample of every slot of a line starting at sample
+        # start; scale stretches the line, e.g. to a measured line period
+        if scale is not None:
+            return [math.floor(start + e * scale / self.den + 0.5) for e in self.ends]
+
+        start = Fraction(start)
+        den = math.lcm(self.den, start.denominator)
+        k = den // self.den
+        s = 2 * start.numerator * (den // start.denominator) + den
+
+        return [(s + 2 * e * k) // (2 * den) for e in self.ends]
+
+
+def render_tones(freqs, ends, start, phase, sr, amp):
+    # Back-to-back tones from sample start, tone i ending (exclusive) at
+    # ends[i]; returns the samples and the phase to carry on from
+    freqs = array.array("d", freqs)
+    ends = array.array("l", ends)
+    n = len(freqs)
+
+    b = array.array("h", bytes(2 * max(0, ends[-1] - start)))
+    if not len(b):
+        return b, phase
+
+    ph = c_double(phase)
+    Encoder.load_libtone().synth_tones(
+        (c_int16 * len(b)).from_buffer(b),
+        (c_double * n).from_buffer(freqs),
+        (c_long * n).from_buffer(ends),
+        n,
+        start,
+        ph,
+        sr,
+        amp,
+    )
+    return b, ph.value
+
 
 class Encoder:
+    timings = {}
+    libtone = None
+    # Scanlines the decoder has to see together to rebuild their rows
+    line_group = 1
+
     def __init__(self, f, wav=True, samp_rate=44100):
         self.phase = 0.0
-        self.clock = 0.0
+        self.clock = Fraction(0)
         self.last_sample = 0
         self.SR = samp_rate
         self.A = 32767
         self.file = f
         self.wav = wav
+        self.jobs = 1
 
         logger.info(f"Using sample rate {self.SR} Hz")
 
@@ -28,43 +111,194 @@ class Encoder:
             logger.info("Writing output as WAV")
             self.file.setparams((1, 2, self.SR, 0, "NONE", "Uncompressed"))
 
+        self.lib = self.load_libtone()
+
+    @staticmethod
+    def load_libtone():
+        # Loaded once per process and shared by every encoder
+        if Encoder.libtone:
+            return Encoder.libtone
+
+        lib = ctypes.CDLL("../lib/libtone.so")
+        lib.synth_tones.argtypes = [
+            POINTER(c_int16),
+            POINTER(c_double),
+            POINTER(c_long),
+            c_int,
+            c_long,
+            POINTER(c_double),
+            c_double,
+            c_int,
+        ]
+        lib.synth_tones.restype = c_long
+        lib.advance_tones.argtypes = [
+            POINTER(c_double),
+            POINTER(c_long),
+            c_int,
+            c_long,
+            c_double,
+            c_double,
+        ]
+        lib.advance_tones.restype = c_double
+        Encoder.libtone = lib
+        return lib
+
+    def synth(self, freqs, ends):
+        # Render back-to-back tones, tone i ending (exclusive) at sample ends[i]
+        b, self.phase = render_tones(
+            freqs, ends, self.last_sample, self.phase, self.SR, self.A
+        )
+        return b
+
+    def advance(self, freqs, ends):
+        # Phase after the tones, without rendering them or stepping through
+        # their samples
+        n = len(freqs)
+        self.phase = self.lib.advance_tones(
+            (c_double * n).from_buffer(freqs),
+            (c_long * n).from_buffer(ends),
+            n,
+            self.last_sample,
+            self.phase,
+            self.SR,
+        )
+
+    def write(self, b):
+        if not self.wav:
+            self.file.write(b.tobytes())
+        else:
+            self.file.writeframes(b.tobytes())
+
     def generate_tone(self, f_hz, t_ms):
-        self.clock += t_ms
+        self.generate_tones([f_hz], [t_ms])
 
-        # Closest sample we should use without cutting
-        end_sample = round(self.clock * self.SR)
+    def generate_tones(self, freqs, durations):
+        ends = []
+        for t_ms in durations:
+            self.clock += Fraction(str(t_ms))
 
-        total_samples = end_sample - self.last_sample
-        phase_inc = 2 * math.pi * f_hz / self.SR
+            # Closest sample we should use without cutting
+            ends.append(to_sample(self.clock * self.SR))
 
-        b = array.array("h", [0] * total_samples)
-        i = 0
-        while i < total_samples:
-            sample = max(-self.A, min(self.A, int(self.A * math.sin(self.phase))))
-            self.phase = (self.phase + phase_inc) % (2 * math.pi)
-            b[i] = sample
-            i += 1
+        if not ends:
+            return
 
-        if not self.wav:
-            self.file.write(b.tobytes())
-        else:
-            self.file.writeframes(b.tobytes())
+        self.write(self.synth(freqs, ends))
+        self.last_sample = ends[-1]
 
-        self.last_sample = end_sample
+    def generate_line(self, freqs, timing):
+        ends = timing.bounds(self.clock * self.SR)
+        self.clock += timing.seconds
 
-    def encode_image(self, data, ext):
+        self.write(self.synth(freqs, ends))
+        self.last_sample = ends[-1]
+
+    def timing(self, variant=0):
+        # Scanline timing, compiled once per (mode, sample rate)
+        key = (type(self), self.mode, self.SR, variant)
+        if key not in self.timings:
+            self.timings[key] = Timing(self.line_layout(variant), self.SR)
+
+        return self.timings[key]
+
+    def encode_image(self, rows):
+        # rows: the mode's RGB rows top to bottom, pulled one at a time (an
+        # ImageReader decodes them on demand)
         logger.info("Encoding image data...")
-        for y in range(self.enc["height"]):
-            # Reversed rows for BMP
-            if ext == "bmp":
-                y = self.enc["height"] - y - 1
+        if self.jobs > 1:
+            self.render_parallel(self.image_lines(rows))
+            return
+
+        for line in self.image_lines(rows):
+            self.encode_line(line)
+
+    def line_count(self):
+        # Scanlines transmitted per image
+        return self.enc["height"]
+
+    def image_offset(self):
+        # Samples sent between the VIS code and the first scanline
+        return Fraction(0)
+
+    def line_variant(self, j):
+        # Timing variant of scanline j
+        return 0
+
+    def decode_rows(self, lines):
+        # RGB rows from a group of decoded scanlines, each a dict of the
+        # luminance bytes of its pixel runs keyed by slot kind
+        rows = []
+        for planes in lines:
+            row = bytearray(3 * self.enc["width"])
+            for k in range(3):
+                row[k::3] = planes[k]
+            rows.append(row)
+
+        return rows
+
+    def image_lines(self, rows):
+        # Input of every encode_line call, in transmission order
+        return iter(rows)
+
+    def render_parallel(self, lines):
+        # Lines are planned here in order and rendered in ranges by worker
+        # processes. Each range starts from the phase the serial render
+        # reaches there, computed in closed form by advance() (see
+        # advance_tones in tone.c for the tolerance), so the seams are
+        # continuous and the output matches a serial render to within a
+        # rare one-LSB rounding difference.
+        per = max(1, self.enc["height"] // (4 * self.jobs))
+        with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+            pending = deque()
+            freqs, ends = array.array("d"), array.array("l")
+
+            def submit():
+                start, phase = self.last_sample, self.phase
+                self.advance(freqs, ends)
+                self.last_sample = ends[-1]
+                pending.append(
+                    pool.submit(
+                        render_tones, freqs, ends, start, phase, self.SR, self.A
+                    )
+                )
+
+                # Bounded read-ahead, written in order
+                while len(pending) > 2 * self.jobs:
+                    self.write(pending.popleft().result()[0])
+
+            n = 0
+            for line in lines:
+                f, timing = self.line_plan(line)
+                freqs.extend(f)
+                ends.extend(timing.bounds(self.clock * self.SR))
+                self.clock += timing.seconds
+                n += 1
 
-            w = self.enc["width"]
-            self.encode_line(data[y * w * 3 : (y + 1) * w * 3])
+                if n == per:
+                    submit()
+                    freqs, ends = array.array("d"), array.array("l")
+                    n = 0
+
+            if n:
+                submit()
+
+            while pending:
+                self.write(pending.popleft().result()[0])
 
     def encode_line(self, line):
-        # To be overriden
-        return
+        # Whole scanline rendered and written at once
+        self.generate_line(*self.line_plan(line))
+
+    def line_plan(self, line):
+        # To be overriden, returns the freqs and Timing of one scanline
+        return [], None
+
+    def line_layout(self, variant=0):
+        # To be overriden, returns the (duration, kind) slots of one scanline
+        return []
+
+    def pixel_freqs(self, values):
+        return [self.lum_b_hz + v * 3.1372549 for v in values]
 
     def generate_intro(self):
         logger.info("Generating VOX intro code...")
@@ -91,18 +325,6 @@ class Encoder:
         self.generate_tone(f_hz=hz, t_ms=0.03)  # parity bit
         self.generate_tone(f_hz=1200, t_ms=0.03)  # stop bit
 
-    @lru_cache(maxsize=4096)
-    def rgb_to_y(self, R, G, B):
-        return 16.0 + (0.003906 * ((65.738 * R) + (129.057 * G) + (25.064 * B)))
-
-    @lru_cache(maxsize=4096)
-    def rgb_to_ry(self, R, G, B):
-        return 128.0 + (0.003906 * ((112.439 * R) + (-94.154 * G) + (-18.285 * B)))
-
-    @lru_cache(maxsize=4096)
-    def rgb_to_by(self, R, G, B):
-        return 128.0 + (0.003906 * ((-37.945 * R) + (-74.494 * G) + (112.439 * B)))
-
     def dec_to_bin_lsb(self, val, n=7):
         return [(val >> i) & 1 for i in range(n)]
 
@@ -131,26 +353,23 @@ class MartinEncoder(Encoder):
         self.t1_hz = 1500
         self.t1_ms = 0.000572
 
-    def encode_line(self, line):
-        self.generate_tone(f_hz=self.sync_hz, t_ms=self.sync_ms)
-        self.generate_tone(f_hz=self.t1_hz, t_ms=self.t1_ms)
+    def line_plan(self, line):
+        freqs = [self.sync_hz, self.t1_hz]
 
         for j in [1, 2, 0]:  # GBR
-            for i in range(0, self.enc["width"]):
-                f_l = line[i * 3 + j] * 3.1372549
-                self.generate_tone(f_hz=self.lum_b_hz + f_l, t_ms=self.enc["t_pixel"])
+            freqs += self.pixel_freqs(line[j::3])
+            freqs.append(self.t1_hz)
 
-            self.generate_tone(f_hz=self.t1_hz, t_ms=self.t1_ms)
+        return freqs, self.timing()
 
-    def decode_sequence(self, sr):
-        yield int(round(sr * self.sync_ms)), 10
-        yield int(round(sr * self.t1_ms)), 11
+    def line_layout(self, variant=0):
+        layout = [(self.sync_ms, SYNC), (self.t1_ms, PORCH)]
 
         for j in [1, 2, 0]:
-            for _ in range(0, self.enc["width"]):
-                yield int(round(sr * self.enc["t_pixel"])), j
+            layout += [(self.enc["t_pixel"], j)] * self.enc["width"]
+            layout.append((self.t1_ms, PORCH))
 
-            yield int(round(sr * self.t1_ms)), 11
+        return layout
 
 
 class ScottieEncoder(Encoder):
@@ -168,29 +387,46 @@ class ScottieEncoder(Encoder):
         self.enc = self.opts[self.mode]
         super().__init__(f, wav, sr)
         logger.info(f"Using ScottieEncoder with mode {mode}")
-        self.first_line_done = False
         self.sync_hz = 1200
         self.sync_ms = 0.009
         self.t1_hz = 1500
         self.t1_ms = 0.0015
 
-    def encode_line(self, line):
-        if not self.first_line_done:
-            self.generate_tone(f_hz=self.sync_hz, t_ms=self.sync_ms)
-            self.first_line_done = True
+    def encode_image(self, rows):
+        # A single sync pulse precedes the first line
+        self.generate_tone(f_hz=self.sync_hz, t_ms=self.sync_ms)
+        super().encode_image(rows)
 
-        self.generate_tone(f_hz=self.t1_hz, t_ms=self.t1_ms)
+    def image_offset(self):
+        return Fraction(str(self.sync_ms)) * self.SR
+
+    def line_plan(self, line):
+        freqs = [self.t1_hz]
 
         for j in [1, 2, 0]:  # GBR
-            for i in range(0, self.enc["width"]):
-                f_l = line[i * 3 + j] * 3.1372549
-                self.generate_tone(f_hz=self.lum_b_hz + f_l, t_ms=self.enc["t_pixel"])
+            freqs += self.pixel_freqs(line[j::3])
+
+            if j == 2:
+                freqs.append(self.sync_hz)
+
+            if j != 0:
+                freqs.append(self.t1_hz)
+
+        return freqs, self.timing()
+
+    def line_layout(self, variant=0):
+        layout = [(self.t1_ms, PORCH)]
+
+        for j in [1, 2, 0]:
+            layout += [(self.enc["t_pixel"], j)] * self.enc["width"]
 
             if j == 2:
-                self.generate_tone(f_hz=self.sync_hz, t_ms=self.sync_ms)
+                layout.append((self.sync_ms, SYNC))
 
             if j != 0:
-                self.generate_tone(f_hz=self.t1_hz, t_ms=self.t1_ms)
+                layout.append((self.t1_ms, PORCH))
+
+        return layout
 
 
 class WrasseEncoder(Encoder):
@@ -212,14 +448,21 @@ class WrasseEncoder(Encoder):
         self.t1_hz = 1500
         self.t1_ms = 0.0005
 
-    def encode_line(self, line):
-        self.generate_tone(f_hz=self.sync_hz, t_ms=self.sync_ms)
-        self.generate_tone(f_hz=self.t1_hz, t_ms=self.t1_ms)
+    def line_plan(self, line):
+        freqs = [self.sync_hz, self.t1_hz]
 
         for j in [0, 1, 2]:  # RGB
-            for i in range(0, self.enc["width"]):
-                f_l = line[i * 3 + j] * 3.1372549
-                self.generate_tone(f_hz=self.lum_b_hz + f_l, t_ms=self.enc["t_pixel"])
+            freqs += self.pixel_freqs(line[j::3])
+
+        return freqs, self.timing()
+
+    def line_layout(self, variant=0):
+        layout = [(self.sync_ms, SYNC), (self.t1_ms, PORCH)]
+
+        for j in [0, 1, 2]:
+            layout += [(self.enc["t_pixel"], j)] * self.enc["width"]
+
+        return layout
 
 
 class PasokonEncoder(Encoder):
@@ -263,16 +506,23 @@ class PasokonEncoder(Encoder):
         super().__init__(f, wav, sr)
         logger.info(f"Using PasokonEncoder with mode {mode}")
 
-    def encode_line(self, line):
-        self.generate_tone(f_hz=self.enc["sync_hz"], t_ms=self.enc["sync_ms"])
-        self.generate_tone(f_hz=self.enc["t1_hz"], t_ms=self.enc["t1_ms"])
+    def line_plan(self, line):
+        freqs = [self.enc["sync_hz"], self.enc["t1_hz"]]
 
         for j in [0, 1, 2]:  # RGB
-            for i in range(0, self.enc["width"]):
-                f_l = line[i * 3 + j] * 3.1372549
-                self.generate_tone(f_hz=self.lum_b_hz + f_l, t_ms=self.enc["t_pixel"])
+            freqs += self.pixel_freqs(line[j::3])
+            freqs.append(self.enc["t1_hz"])
+
+        return freqs, self.timing()
+
+    def line_layout(self, variant=0):
+        layout = [(self.enc["sync_ms"], SYNC), (self.enc["t1_ms"], PORCH)]
+
+        for j in [0, 1, 2]:
+            layout += [(self.enc["t_pixel"], j)] * self.enc["width"]
+            layout.append((self.enc["t1_ms"], PORCH))
 
-            self.generate_tone(f_hz=self.enc["t1_hz"], t_ms=self.enc["t1_ms"])
+        return layout
 
 
 class PDEncoder(Encoder):
@@ -331,45 +581,39 @@ class PDEncoder(Encoder):
         self.sync_ms = 0.02
         self.t1_hz = 1500
         self.t1_ms = 0.00208
-        self.odd_line = False
 
-    def encode_line(self, line):
-        w = self.enc["width"]
+    def line_count(self):
+        return self.enc["height"] // 2
 
-        if self.odd_line:
-            self.generate_tone(f_hz=self.sync_hz, t_ms=self.sync_ms)
-            self.generate_tone(f_hz=self.t1_hz, t_ms=self.t1_ms)
+    def decode_rows(self, lines):
+        rows = []
+        for p in lines:
+            rows += [ycc_to_rgb(p[0], p[1], p[2]), ycc_to_rgb(p[3], p[1], p[2])]
 
-            for i in range(0, w):
-                y = (
-                    self.rgb_to_y(line[i * 3], line[i * 3 + 1], line[i * 3 + 2])
-                    * 3.1372549
-                )
-                self.generate_tone(f_hz=self.lum_b_hz + y, t_ms=self.enc["y_scan_ms"])
+        return rows
 
-            for i in range(0, w):
-                r_y = (
-                    self.rgb_to_ry(line[i * 3], line[i * 3 + 1], line[i * 3 + 2])
-                    * 3.1372549
-                )
-                self.generate_tone(f_hz=self.lum_b_hz + r_y, t_ms=self.enc["y_scan_ms"])
+    def image_lines(self, rows):
+        # Each frame carries a pair of rows: Y0, averaged R-Y and B-Y, Y1
+        w = self.enc["width"]
+        rows = iter(rows)
 
-            for i in range(0, w):
-                b_y = (
-                    self.rgb_to_by(line[i * 3], line[i * 3 + 1], line[i * 3 + 2])
-                    * 3.1372549
-                )
-                self.generate_tone(f_hz=self.lum_b_hz + b_y, t_ms=self.enc["y_scan_ms"])
+        for r0, r1 in zip(rows, rows):
+            y, ry, by = ycc_planes(b"".join((r0, r1)), w, 2, pairs=True)
+            yield y[:w], ry, by, y[w:]
 
-        else:
-            for i in range(0, w):
-                y = (
-                    self.rgb_to_y(line[i * 3], line[i * 3 + 1], line[i * 3 + 2])
-                    * 3.1372549
-                )
-                self.generate_tone(f_hz=self.lum_b_hz + y, t_ms=self.enc["y_scan_ms"])
+    def line_plan(self, line):
+        freqs = [self.sync_hz, self.t1_hz]
+        for plane in line:
+            freqs += self.pixel_freqs(plane)
 
-        self.odd_line = not self.odd_line
+        return freqs, self.timing()
+
+    def line_layout(self, variant=0):
+        layout = [(self.sync_ms, SYNC), (self.t1_ms, PORCH)]
+        for j in [0, 1, 2, 3]:  # Y0, R-Y, B-Y, Y1
+            layout += [(self.enc["y_scan_ms"], j)] * self.enc["width"]
+
+        return layout
 
 
 class RobotEncoder(Encoder):
@@ -412,64 +656,64 @@ class RobotEncoder(Encoder):
         self.osep_hz = 2300
         self.osep_ms = 0.0045
         self.odd_line = False
+        # Robot 36 sends R-Y on even and B-Y on odd lines, shared by the pair
+        self.line_group = 2 if mode == "36" else 1
 
-    def encode_line(self, line):
+    def line_variant(self, j):
+        return j % 2 if self.mode == "36" else 0
+
+    def decode_rows(self, lines):
+        if self.mode == "36":
+            even, odd = lines
+            cr, cb = even[1], odd[2]
+            return [ycc_to_rgb(even[0], cr, cb), ycc_to_rgb(odd[0], cr, cb)]
+
+        return [ycc_to_rgb(p[0], p[1], p[2]) for p in lines]
+
+    def image_lines(self, rows):
         w = self.enc["width"]
-        self.generate_tone(f_hz=self.sync_hz, t_ms=self.sync_ms)
-        self.generate_tone(f_hz=self.t1_hz, t_ms=self.t1_ms)
+        for row in rows:
+            yield list(ycc_planes(row, w, 1))
 
-        for i in range(0, w):
-            y = self.rgb_to_y(line[i * 3], line[i * 3 + 1], line[i * 3 + 2]) * 3.1372549
-            self.generate_tone(f_hz=self.lum_b_hz + y, t_ms=self.enc["y_scan_ms"])
+    def line_plan(self, line):
+        y, r_y, b_y = line
+        freqs = [self.sync_hz, self.t1_hz] + self.pixel_freqs(y)
+        timing = self.timing(self.odd_line)
 
         if self.mode == "36":
             if self.odd_line:
-                self.generate_tone(f_hz=self.osep_hz, t_ms=self.osep_ms)
-                self.generate_tone(f_hz=self.t2_hz, t_ms=self.t2_ms)
-                for i in range(0, w):
-                    b_y = (
-                        self.rgb_to_by(line[i * 3], line[i * 3 + 1], line[i * 3 + 2])
-                        * 3.1372549
-                    )
-                    self.generate_tone(
-                        f_hz=self.lum_b_hz + b_y, t_ms=self.enc["by_scan_ms"]
-                    )
+                freqs += [self.osep_hz, self.t2_hz] + self.pixel_freqs(b_y)
             else:
-                self.generate_tone(f_hz=self.esep_hz, t_ms=self.esep_ms)
-                self.generate_tone(f_hz=self.t2_hz, t_ms=self.t2_ms)
-                for i in range(0, w):
-                    r_y = (
-                        self.rgb_to_ry(line[i * 3], line[i * 3 + 1], line[i * 3 + 2])
-                        * 3.1372549
-                    )
-                    self.generate_tone(
-                        f_hz=self.lum_b_hz + r_y, t_ms=self.enc["ry_scan_ms"]
-                    )
+                freqs += [self.esep_hz, self.t2_hz] + self.pixel_freqs(r_y)
 
             self.odd_line = not self.odd_line
 
         elif self.mode == "72":
-            self.generate_tone(f_hz=self.esep_hz, t_ms=self.esep_ms)
-            self.generate_tone(f_hz=self.t2_hz, t_ms=self.t2_ms)
-            for i in range(0, w):
-                r_y = (
-                    self.rgb_to_ry(line[i * 3], line[i * 3 + 1], line[i * 3 + 2])
-                    * 3.1372549
-                )
-                self.generate_tone(
-                    f_hz=self.lum_b_hz + r_y, t_ms=self.enc["ry_scan_ms"]
-                )
+            freqs += [self.esep_hz, self.t2_hz] + self.pixel_freqs(r_y)
+            freqs += [self.osep_hz, self.t3_hz] + self.pixel_freqs(b_y)
 
-            self.generate_tone(f_hz=self.osep_hz, t_ms=self.osep_ms)
-            self.generate_tone(f_hz=self.t3_hz, t_ms=self.t3_ms)
-            for i in range(0, w):
-                b_y = (
-                    self.rgb_to_by(line[i * 3], line[i * 3 + 1], line[i * 3 + 2])
-                    * 3.1372549
-                )
-                self.generate_tone(
-                    f_hz=self.lum_b_hz + b_y, t_ms=self.enc["by_scan_ms"]
-                )
+        return freqs, timing
+
+    def line_layout(self, variant=0):
+        w = self.enc["width"]
+        layout = [(self.sync_ms, SYNC), (self.t1_ms, PORCH)]
+        layout += [(self.enc["y_scan_ms"], 0)] * w
+
+        if self.mode == "36":
+            if variant:
+                layout += [(self.osep_ms, PORCH), (self.t2_ms, PORCH)]
+                layout += [(self.enc["by_scan_ms"], 2)] * w
+            else:
+                layout += [(self.esep_ms, PORCH), (self.t2_ms, PORCH)]
+                layout += [(self.enc["ry_scan_ms"], 1)] * w
+
+        elif self.mode == "72":
+            layout += [(self.esep_ms, PORCH), (self.t2_ms, PORCH)]
+            layout += [(self.enc["ry_scan_ms"], 1)] * w
+            layout += [(self.osep_ms, PORCH), (self.t3_ms, PORCH)]
+            layout += [(self.enc["by_scan_ms"], 2)] * w
+
+        return layout
 
 
 class FAXEncoder(Encoder):
@@ -488,21 +732,33 @@ class FAXEncoder(Encoder):
 
     # @override
     def generate_header(self):
-        for _ in range(1220):
-            self.generate_tone(f_hz=2300, t_ms=0.00205)
-            self.generate_tone(f_hz=1500, t_ms=0.00205)
+        self.generate_tones([2300, 1500] * 1220, [0.00205] * 2440)
 
     def generate_phasing_interval(self):
+        w = self.enc["width"]
         for _ in range(20):
             self.generate_tone(f_hz=self.sync_hz, t_ms=self.sync_ms)
-            for i in range(0, self.enc["width"]):
-                self.generate_tone(f_hz=self.lum_w_hz, t_ms=self.enc["t_pixel"])
-
-    def encode_line(self, line):
-        self.generate_tone(f_hz=self.sync_hz, t_ms=self.sync_ms)
-
-        for i in range(0, self.enc["width"]):
-            # wacky RGB->monochrome conversion
-            mono = 0.3 * line[i * 3] + 0.59 * line[i * 3 + 1] + 0.11 * line[i * 3 + 2]
-            f_l = mono * 3.1372549
-            self.generate_tone(f_hz=self.lum_b_hz + f_l, t_ms=self.enc["t_pixel"])
+            self.generate_tones([self.lum_w_hz] * w, [self.enc["t_pixel"]] * w)
+
+    def line_plan(self, line):
+        # wacky RGB->monochrome conversion
+        mono = [
+            0.3 * r + 0.59 * g + 0.11 * b
+            for r, g, b in zip(line[0::3], line[1::3], line[2::3])
+        ]
+
+        return [self.sync_hz] + self.pixel_freqs(mono), self.timing()
+
+    def line_layout(self, variant=0):
+        return [(self.sync_ms, SYNC)] + [(self.enc["t_pixel"], 0)] * self.enc["width"]
+
+    def decode_rows(self, lines):
+        # Grey rows
+        rows = []
+        for planes in lines:
+            row = bytearray(3 * self.enc["width"])
+            for k in range(3):
+                row[k::3] = planes[0]
+            rows.append(row)
+
+        return rows
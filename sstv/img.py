@@ -1,49 +1,264 @@
+import array
 import struct
 import ctypes
-from ctypes import c_char_p, c_int, POINTER, c_ubyte, byref, c_ulong, string_at, c_bool
+from ctypes import c_char_p, c_int, POINTER, c_ubyte, byref, c_ulong, c_bool, c_double, c_void_p
 import logging
 logger = logging.getLogger(__name__)
 
 
 lib = ctypes.CDLL("../lib/libimg.so")
-lib.load_png.argtypes = [c_char_p, POINTER(POINTER(c_ubyte)), POINTER(c_ulong), POINTER(c_ulong)]
-lib.load_png.restype = c_int
-lib.load_bmp.argtypes = [c_char_p, POINTER(POINTER(c_ubyte)), POINTER(c_ulong), POINTER(c_ulong)]
-lib.load_bmp.restype = c_int
-lib.load_jpg.argtypes = [c_char_p, POINTER(POINTER(c_ubyte)), POINTER(c_ulong), POINTER(c_ulong)]
-lib.load_jpg.restype = c_int
-lib.free_image.argtypes = [POINTER(c_ubyte)]
-lib.free_image.restype = None
-
-LD = {
-    'bmp': lib.load_bmp,
-    'png': lib.load_png,
-    'jpg': lib.load_jpg,
-    'jpeg': lib.load_jpg
+for fmt in ['png', 'bmp', 'jpg']:
+    size = getattr(lib, f'size_{fmt}')
+    size.argtypes = [c_char_p, POINTER(c_ulong), POINTER(c_ulong)]
+    size.restype = c_int
+    into = getattr(lib, f'load_{fmt}_into')
+    into.argtypes = [c_char_p, POINTER(c_ubyte), c_ulong, c_ulong]
+    into.restype = c_int
+lib.resample.argtypes = [POINTER(c_ubyte), c_ulong, c_ulong, c_double, c_double, c_double, c_double, POINTER(c_ubyte), c_ulong, c_ulong, c_int]
+lib.resample.restype = c_int
+lib.writer_open.argtypes = [c_int, c_int, c_ulong, c_ulong, c_int]
+lib.writer_open.restype = c_void_p
+lib.writer_row.argtypes = [c_void_p, POINTER(c_ubyte)]
+lib.writer_row.restype = c_int
+lib.writer_close.argtypes = [c_void_p]
+lib.writer_close.restype = c_int
+lib.write_image.argtypes = [c_int, c_int, POINTER(c_ubyte), c_ulong, c_ulong, c_int]
+lib.write_image.restype = c_int
+lib.reader_open.argtypes = [c_char_p, c_int, POINTER(c_ulong), POINTER(c_ulong)]
+lib.reader_open.restype = c_void_p
+lib.reader_row.argtypes = [c_void_p, POINTER(c_ubyte)]
+lib.reader_row.restype = c_int
+lib.reader_close.argtypes = [c_void_p]
+lib.reader_close.restype = None
+lib.rgb_to_ycc.argtypes = [POINTER(c_ubyte), c_ulong, c_ulong, c_int, POINTER(c_double), POINTER(c_double), POINTER(c_double)]
+lib.rgb_to_ycc.restype = None
+lib.ycc_to_rgb.argtypes = [POINTER(c_ubyte), POINTER(c_ubyte), POINTER(c_ubyte), c_ulong, POINTER(c_ubyte)]
+lib.ycc_to_rgb.restype = None
+
+# reader_open() and writer_open() formats; JPEG quality as PIL used to save them
+WR = {
+    'png': 0,
+    'bmp': 1,
+    'jpg': 2,
+    'jpeg': 2
+}
+JPEG_QUALITY = 75
+
+# Resize policies and resample() filters, see resize_image
+RESIZE = ('stretch', 'fit', 'crop')
+RESAMPLE_AREA = 0
+RESAMPLE_BILINEAR = 1
+
+# (size probe, decode into a caller buffer) per format
+LD_INTO = {
+    'bmp': (lib.size_bmp, lib.load_bmp_into),
+    'png': (lib.size_png, lib.load_png_into),
+    'jpg': (lib.size_jpg, lib.load_jpg_into),
+    'jpeg': (lib.size_jpg, lib.load_jpg_into)
 }
 
 
-def load_image(path):
+def image_format(path):
     ext = path.replace('.tmp', '').split('.')[-1].lower()
+    if ext not in LD_INTO:
+        logger.error(f'Error: provided image format is not supported: {ext.upper()}')
+        raise ValueError('Unsupported image format')
 
-    if ext in LD:
-        logger.info(f'Detected image format: {ext.upper()}')
+    return ext
+
+
+def image_size(path):
+    # (width, height) from the image header, nothing is decoded
+    size, _ = LD_INTO[image_format(path)]
+    w, h = c_ulong(), c_ulong()
+
+    res = size(path.encode('utf-8'), byref(w), byref(h))
+    if res != 0:
+        raise RuntimeError(f"Failed to load image: error code {res}")
+
+    return w.value, h.value
+
+
+def ubytes(data):
+    # ctypes view of a buffer, copied only when it is read-only
+    mv = memoryview(data).cast('B')
+    if mv.readonly:
+        return (c_ubyte * len(mv)).from_buffer_copy(mv)
+    return (c_ubyte * len(mv)).from_buffer(mv)
+
+
+def image_buffer(buf, size):
+    # Writable byte view of the first size bytes of buf, a new one if None
+    mv = memoryview(bytearray(size) if buf is None else buf).cast('B')
+    if len(mv) < size:
+        raise ValueError(f'Image buffer too small: {len(mv)} < {size} bytes')
+
+    return mv[:size]
+
+
+def load_image(path, buf=None, size=None, policy='stretch'):
+    # Decode straight into buf (a bytearray, shared memory block or any
+    # writable buffer of at least width * height * 3 bytes, see image_size)
+    # or into a new bytearray; the RGB data comes back as a view of it, so
+    # nothing is copied and workers can share one decoded image. With size
+    # (width, height) the image is resampled to it on the way, see
+    # resize_image for the policies.
+    ext = image_format(path)
+    logger.info(f'Detected image format: {ext.upper()}')
+
+    w, h = image_size(path)
+    logger.info(f'Detected image size: ({w},{h})')
+
+    resize = size is not None and size != (w, h)
+    mv = image_buffer(None if resize else buf, w * h * 3)
+
+    res = LD_INTO[ext][1](path.encode('utf-8'), (c_ubyte * len(mv)).from_buffer(mv), w, h)
+    if res != 0:
+        raise RuntimeError(f"Failed to load image: error code {res}")
+
+    if resize:
+        logger.info(f'Resizing image to {size} ({policy})')
+        mv = resize_image(mv, w, h, *size, policy, buf)
+        w, h = size
+
+    return (ext, w, h, mv)
 
-        buf = POINTER(c_ubyte)()
-        w, h = c_ulong(), c_ulong()
 
-        res = LD[ext](path.encode('utf-8'), byref(buf), byref(w), byref(h))
+def buffer_rows(data, width, height, bottom_up=False):
+    # RGB rows of a decoded buffer, top to bottom; load_image leaves BMP rows
+    # in file order, which is bottom-up
+    mv = memoryview(data).cast('B')
+    for y in range(height):
+        if bottom_up:
+            y = height - y - 1
+        yield mv[y * width * 3 : (y + 1) * width * 3]
+
+
+def resize_image(data, w, h, ew, eh, policy='stretch', buf=None):
+    # RGB image resampled to ew x eh, into buf if given: 'stretch' scales
+    # each axis to fit exactly, 'crop' keeps the aspect ratio and cuts the
+    # overflow evenly from both sides, 'fit' keeps the aspect ratio and
+    # pads with black. Area averaging when shrinking, bilinear otherwise.
+    assert policy in RESIZE
+    out = image_buffer(buf, ew * eh * 3)
+    src = ubytes(data)
+
+    x0, y0, cw, ch = 0.0, 0.0, float(w), float(h)
+    dx, dy, dw, dh = 0, 0, ew, eh
+    if policy == 'crop':
+        scale = max(ew / w, eh / h)
+        cw, ch = ew / scale, eh / scale
+        x0, y0 = (w - cw) / 2, (h - ch) / 2
+    elif policy == 'fit':
+        scale = min(ew / w, eh / h)
+        dw, dh = max(1, min(ew, round(w * scale))), max(1, min(eh, round(h * scale)))
+        dx, dy = (ew - dw) // 2, (eh - dh) // 2
+
+    filt = RESAMPLE_AREA if cw >= dw and ch >= dh else RESAMPLE_BILINEAR
+    if (dw, dh) == (ew, eh):
+        res = lib.resample(src, w, h, x0, y0, cw, ch, (c_ubyte * len(out)).from_buffer(out), dw, dh, filt)
         if res != 0:
-            raise RuntimeError(f"Failed to load image: error code {res}")
+            raise RuntimeError(f"Failed to resize image: error code {res}")
+        return out
+
+    # Letterboxed: resample the inner image, then place it on black
+    inner = bytearray(dw * dh * 3)
+    res = lib.resample(src, w, h, x0, y0, cw, ch, (c_ubyte * len(inner)).from_buffer(inner), dw, dh, filt)
+    if res != 0:
+        raise RuntimeError(f"Failed to resize image: error code {res}")
+    out[:] = bytes(len(out))
+    for r in range(dh):
+        a = ((dy + r) * ew + dx) * 3
+        out[a : a + dw * 3] = inner[r * dw * 3 : (r + 1) * dw * 3]
+    return out
+
 
-        size = w.value * h.value * 3
-        data = string_at(buf, size)
-        # data = ctypes.memoryview_at(buf, size) nb! 3.14 feature
-        logger.info(f'Detected image size: ({w.value},{h.value})')
+def ycc_planes(data, width, rows, pairs=False):
+    # Y, R-Y and B-Y planes of a whole RGB buffer, chroma averaged over
+    # row pairs if requested
+    n = width * rows
+    cn = width * ((rows + 1) // 2) if pairs else n
+    planes = array.array('d', bytes(8 * n)), array.array('d', bytes(8 * cn)), array.array('d', bytes(8 * cn))
 
-        lib.free_image(buf)
-        return (ext, w.value, h.value, memoryview(data))
+    y, ry, by = [(c_double * len(p)).from_buffer(p) for p in planes]
+    lib.rgb_to_ycc(ubytes(data), width, rows, pairs, y, ry, by)
+    return planes
+
+
+def ycc_to_rgb(y, ry, by):
+    # Packed RGB row from equally long Y, R-Y and B-Y byte rows
+    n = len(y)
+    rgb = bytearray(3 * n)
+    y, ry, by = [(c_ubyte * n).from_buffer_copy(p) for p in (y, ry, by)]
+    lib.ycc_to_rgb(y, ry, by, n, (c_ubyte * (3 * n)).from_buffer(rgb))
+    return rgb
+
+
+class ImageReader:
+    # RGB rows of the image at path, top to bottom, decoded one at a time as
+    # they are iterated; only the header is read on opening
+    def __init__(self, path):
+        self.format = image_format(path)
+        w, h = c_ulong(), c_ulong()
+        self.rd = lib.reader_open(path.encode('utf-8'), WR[self.format], byref(w), byref(h))
+        if not self.rd:
+            raise RuntimeError(f"Failed to load image: {path}")
+        self.width, self.height = w.value, h.value
+        logger.info(f'Detected image format: {self.format.upper()}')
+        logger.info(f'Detected image size: ({self.width},{self.height})')
+
+    def __iter__(self):
+        while self.rd:
+            row = bytearray(self.width * 3)
+            res = lib.reader_row(self.rd, (c_ubyte * len(row)).from_buffer(row))
+            if res == -1:
+                return
+            if res != 0:
+                raise RuntimeError(f"Failed to load image: error code {res}")
+            yield row
+
+    def close(self):
+        if self.rd:
+            lib.reader_close(self.rd)
+            self.rd = None
+
+    def __del__(self):
+        self.close()
+
+
+def save_image(f, data, width, height, quality=JPEG_QUALITY):
+    # Write a packed RGB buffer to the open file f, in the format of its
+    # extension, at its current position
+    f.flush()
+    res = lib.write_image(f.fileno(), WR[image_format(f.name)], ubytes(data), width, height, quality)
+    if res != 0:
+        raise RuntimeError(f"Failed to save image: error code {res}")
+
+
+class ImageWriter:
+    # Streams RGB rows, top to bottom, into the open file f in the format of
+    # its extension; rows left unwritten at close() come out black
+    def __init__(self, f, width, height, quality=JPEG_QUALITY):
+        f.flush()
+        self.width = width
+        self.wr = lib.writer_open(f.fileno(), WR[image_format(f.name)], width, height, quality)
+        if not self.wr:
+            raise RuntimeError("Failed to open image writer")
+
+    def write(self, row):
+        if len(row) != self.width * 3:
+            raise ValueError(f'Row of {len(row)} bytes, expected {self.width * 3}')
+
+        res = lib.writer_row(self.wr, ubytes(row))
+        if res != 0:
+            raise RuntimeError(f"Failed to write image row: error code {res}")
 
+    def close(self):
+        if self.wr:
+            res = lib.writer_close(self.wr)
+            self.wr = None
+            if res != 0:
+                raise RuntimeError(f"Failed to save image: error code {res}")
 
-    logger.error(f'Error: provided image format is not supported: {ext.upper()}')
-    raise ValueError('Unsupported image format')
+    def __del__(self):
+        self.close()
@@ -6,14 +6,19 @@ import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import logging
+import time
 import wave
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
+from itertools import islice
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.WARNING)
 
 from decoder import *
 from encoder import *
-from img import load_image
+from img import RESIZE, ImageReader, ImageWriter, buffer_rows, load_image
 
 # http://lionel.cordesses.free.fr/gpages/Cordesses.pdf
 # https://web.archive.org/web/20241227121817/http://www.barberdsp.com/downloads/Dayton%20Paper.pdf
@@ -33,34 +38,77 @@ ENCODERS = {
 DECODERS = {"General": Decoder}
 
 
-def encode(img_path, out_path, encoding, mode, intro_tone, sr, wav):
+def partial_path(out_path):
+    # Where the output is written until it is complete
+    return out_path + ".part"
+
+
+def encode(
+    img_path, out_path, encoding, mode, intro_tone, sr, wav, jobs=1, resize=None
+):
     assert encoding in ENCODERS
 
-    if wav:
-        f = wave.open(out_path, "wb")
-    else:
-        f = open(out_path, "wb")
+    # Written under a temporary name next to out_path and renamed once
+    # complete, so a failed encode leaves nothing that looks like a result
+    part = partial_path(out_path)
+    out = open(part, "wb")
+    try:
+        encode_to(out, img_path, encoding, mode, intro_tone, sr, wav, jobs, resize)
+    except BaseException:
+        out.close()
+        os.remove(part)
+        raise
+
+    out.close()
+    os.replace(part, out_path)
+    return True
+
+
+def encode_to(out, img_path, encoding, mode, intro_tone, sr, wav, jobs=1, resize=None):
+    # The whole transmission of one image into the open file out. The wave
+    # writer patches its header on close, so it is closed here while out is
+    # still open, also when the encode fails.
+    with wave.open(out, "wb") if wav else nullcontext(out) as f:
+        send_image(f, img_path, encoding, mode, intro_tone, sr, wav, jobs, resize)
 
+
+def send_image(f, img_path, encoding, mode, intro_tone, sr, wav, jobs=1, resize=None):
+    # Tones of one image into f, a wave writer or raw file
     try:
         e = ENCODERS[encoding](f, wav, mode, sr)
     except AssertionError:
         logger.error("Unknown encoder or mode provided!")
         sys.exit(1)
 
-    ext, w, h, data = load_image(img_path)
+    # Scanlines rendered on this many worker processes
+    e.jobs = jobs
 
+    # Rows are decoded as the encoder takes them, so the audio starts at
+    # once and only a few rows are held. Resampling (if a policy is given
+    # and the size is off) needs the whole image decoded first.
     ew, eh = e.enc["width"], e.enc["height"]
+    img = ImageReader(img_path)
+    w, h, rows = img.width, img.height, img
+    if resize and (w, h) != (ew, eh):
+        img.close()
+        ext, w, h, data = load_image(img_path, size=(ew, eh), policy=resize)
+        rows = buffer_rows(data, w, h, bottom_up=ext == "bmp")
+
     if (w, h) != (ew, eh):
         logger.warning(
             f"Error: input image dimensions ({w},{h}) not supported by encoding mode ({ew},{eh})"
         )
-        logger.warning("Please find a way to re-size your image")
+        logger.warning(
+            f"Please re-size your image, e.g. with --resize {'|'.join(RESIZE)}"
+        )
         if w < ew or h < eh:
             logger.error("Stopping program execution")
-            f.close()
-            del data
+            img.close()
             sys.exit(3)
 
+        # Larger images are sent from their top left corner
+        rows = (row[: ew * 3] for row in islice(rows, eh))
+
     if intro_tone:
         e.generate_intro()
 
@@ -71,17 +119,143 @@ def encode(img_path, out_path, encoding, mode, intro_tone, sr, wav):
     else:
         e.generate_phasing_interval()
 
-    e.encode_image(data, ext)
+    e.encode_image(rows)
 
     e.__del__()
-    del data
-    if not wav and not f.closed:
-        f.close()
+    img.close()
 
-    return True
+
+def batch_sources(src):
+    # Images of a directory, or the paths listed in a manifest file (one per
+    # line, relative to the manifest, # starts a comment)
+    if os.path.isdir(src):
+        return sorted(
+            os.path.join(src, name)
+            for name in os.listdir(src)
+            if name.split(".")[-1].lower() in ["png", "jpg", "jpeg", "bmp"]
+        )
+
+    paths = []
+    with open(src) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if line:
+                paths.append(os.path.join(os.path.dirname(src), line))
+
+    return paths
+
+
+def batch_init(level):
+    # Once per worker: quiet logging, libtone loaded up front (libimg is
+    # loaded when img is imported)
+    logging.getLogger().setLevel(level)
+    Encoder.load_libtone()
 
 
-def decode(in_path, out_path, sr, wave, encoding, mode, intro):
+def batch_job(img_path, out_path, encoding, mode, intro_tone, sr, wav, resize=None):
+    t = time.perf_counter()
+    try:
+        encode(img_path, out_path, encoding, mode, intro_tone, sr, wav, resize=resize)
+        err = None
+    except SystemExit as ex:
+        err = f"stopped with exit code {ex.code}"
+    except Exception as ex:
+        err = f"{type(ex).__name__}: {ex}"
+
+    return img_path, out_path, time.perf_counter() - t, err
+
+
+def encode_batch(src, out_dir, encoding, mode, intro_tone, sr, wav, jobs, resize=None):
+    # Encode every image of src into out_dir on a pool of worker processes;
+    # a failing file is reported and the rest of the batch carries on
+    assert encoding in ENCODERS and mode in ENCODERS[encoding].opts
+
+    paths = batch_sources(src)
+    os.makedirs(out_dir, exist_ok=True)
+    ext = ".wav" if wav else ".raw"
+
+    todo = []
+    for img_path in paths:
+        stem = os.path.splitext(os.path.basename(img_path))[0]
+        todo.append((img_path, os.path.join(out_dir, stem + ext)))
+
+    t = time.perf_counter()
+    failed = 0
+    isolate = False
+    while todo:
+        # A crashing worker (e.g. a library abort on a corrupt image) takes
+        # the pool down with it: the files it lost are run again, one pool
+        # per file once a round gets nothing through
+        groups = [[job] for job in todo] if isolate else [todo]
+        lost = []
+        for group in groups:
+            n, crashed = batch_round(
+                group, encoding, mode, intro_tone, sr, wav, jobs, resize
+            )
+            failed += n
+            lost += crashed
+
+        if isolate:
+            for img_path, out_path in lost:
+                failed += 1
+                print(f"FAIL {0:7.2f}s {img_path}: worker crashed")
+
+                # The worker died before it could remove its partial output
+                if os.path.exists(partial_path(out_path)):
+                    os.remove(partial_path(out_path))
+            lost = []
+
+        isolate = len(lost) == len(todo)
+        todo = lost
+
+    took = time.perf_counter() - t
+    print(f"{len(paths) - failed}/{len(paths)} encoded in {took:.2f}s, {failed} failed")
+    return failed == 0
+
+
+def batch_round(todo, encoding, mode, intro_tone, sr, wav, jobs, resize=None):
+    # Run (image, output) jobs on a fresh pool, print each result and return
+    # the failure count and the jobs lost to a crashed worker
+    failed = 0
+    crashed = []
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=batch_init, initargs=(logging.getLogger().level,)
+    ) as pool:
+        futures = {
+            pool.submit(
+                batch_job,
+                img_path,
+                out_path,
+                encoding,
+                mode,
+                intro_tone,
+                sr,
+                wav,
+                resize,
+            ): (
+                img_path,
+                out_path,
+            )
+            for img_path, out_path in todo
+        }
+
+        for future in as_completed(futures):
+            try:
+                img_path, out_path, secs, err = future.result()
+            except BrokenProcessPool:
+                crashed.append(futures[future])
+                continue
+
+            if err:
+                failed += 1
+                print(f"FAIL {secs:7.2f}s {img_path}: {err}")
+            else:
+                print(f"ok   {secs:7.2f}s {img_path} -> {out_path}")
+
+    return failed, crashed
+
+
+def decode(in_path, out_path, sr, wave, encoding, mode, intro, jobs=1):
     iformat = out_path.split(".")[-1].upper()
     assert iformat in ["JPEG", "JPG", "BMP", "PNG"]
 
@@ -100,6 +274,12 @@ def decode(in_path, out_path, sr, wave, encoding, mode, intro):
     if wave:
         e.read_wav(in_path)
 
+    # The WAV header's rate replaces the one given on the command line
+    sr = e.sr
+
+    # Image chunks decoded on this many worker processes
+    e.jobs = jobs
+
     header_size = round(sr * 0.3) * 2 + round(sr * 0.01)
     fax_head_size = round(sr * 0.00205) * 2 * 1220
     intro_size = round(sr * 0.1) * 8
@@ -118,15 +298,13 @@ def decode(in_path, out_path, sr, wave, encoding, mode, intro):
     ns = e.find_nonsil()
     print("expected len", elen, ns)
     # i,data = e.process_header(ns, elen)
-    ns, data = e.process_image(ns, elen)
-    # print(data[:100])
-    freqs = []
-    for i in range(len(data) - 1):
-        x0, y0 = data[i]
-        for t in range(x0, data[i + 1][0]):
-            freqs.append(y0)
-
-    freqs.append(data[-1][1])
+    if encoding != "FAX":
+        ns, track = e.process_image(ns, elen)
+    else:
+        # The 2.05 ms header tones need a finer track; the front is matched
+        # up to 2 s either side of where the signal seems to start
+        lo = max(0, ns - 2 * sr)
+        _, track = e.process_image(lo, ns - lo + elen + 2 * sr, N=64, hop=16)
 
     vox = None
     header = None
@@ -136,44 +314,51 @@ def decode(in_path, out_path, sr, wave, encoding, mode, intro):
     phint = None
     j = ns
     if intro:
-        j, vox = e.decode_vox(j, freqs)
+        j, vox = e.decode_vox(j, track)
 
-    j, header = e.decode_header(j, freqs, encoding == "FAX")
+    j, header = e.decode_header(j, track, encoding == "FAX")
 
     if encoding != "FAX":
-        j, vis = e.decode_VIS(j, freqs)
+        j, vis = e.decode_VIS(j, track)
     else:
-        j, phint = e.decode_phasing_interval(j, freqs)
+        j, phint = e.decode_phasing_interval(j, track)
 
     print("j=", j)
     print("vox/header/VIS/phint:")
     print(vox, header, vis, phint)
 
-    if vis:
-        d_enc, d_mode = vis
+    if encoding == "FAX":
+        print(f"FAX header confidence: {header['confidence']:.2f}")
+
+    # Without a readable code the given mode is only used if something
+    # like a VIS code or FAX header was there at all
+    conf = vis["confidence"] if vis else header["confidence"]
+    given = encoding in ENCODERS and mode in ENCODERS[encoding].opts
+
+    if vis and vis["mode"]:
+        d_enc, d_mode = vis["mode"]
         print("Detected encode and mode:", d_enc, d_mode)
+        print(f"VIS confidence: {vis['confidence']:.2f}")
+    elif phint:
+        d_enc, d_mode = FAXEncoder, "FAX480"
+    elif given and conf >= FALLBACK_CONF:
+        d_enc, d_mode = ENCODERS[encoding], mode
+        print("No usable VIS code, decoding as", d_enc, d_mode)
+    else:
+        # Rejected before spending a full decode on it
+        print("No usable VIS code, giving up")
+        if not f.closed:
+            f.close()
+        return False
 
     print("IMAGE:")
-    nns, data2 = e.process_image(j)
-    imgfreqs = []
-    for i in range(len(data2) - 1):
-        x0, y0 = data2[i]
-        for t in range(x0, data2[i + 1][0]):
-            imgfreqs.append(y0)
-
-    imgfreqs.append(data[-1][1])
-    # print(len(imgfreqs), imgfreqs[:500])
-    pixels = e.decode_image(d_enc, d_mode, j, imgfreqs)
+    # Line start and period measured on the sync pulses: no slant from a
+    # sound card clock that differs from the sender's
+    j, period = e.sync_lines(d_enc, d_mode, j)
+    print(f"Clock error: {e.clock_error * 1e6:.1f} ppm")
+    pixels = e.decode_region(d_enc, d_mode, j, period=period)
     print(len(pixels))
-    imbytes = []
-    for line in pixels:
-        imbytes.extend(line)
-    print(len(imbytes))
-
-    from PIL import Image
-
-    im = Image.frombytes("RGB", (320, 256), bytes(imbytes))
-    im.save(f)
+    save_image(f, pixels)
 
     e.__del__()
     if not wave and not f.closed:
@@ -182,6 +367,96 @@ def decode(in_path, out_path, sr, wave, encoding, mode, intro):
     return False
 
 
+def image_path(out_path, offset, t0, mode):
+    # TARGET_<time>_<mode>.EXT, time being the wall clock when t0 is known
+    # and the offset into the recording otherwise
+    stem, ext = os.path.splitext(out_path)
+    if t0 is None:
+        stamp = time.strftime("%H%M%S", time.gmtime(offset))
+    else:
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(t0 + offset))
+
+    return f"{stem}_{stamp}_{mode}{ext}"
+
+
+def save_image(f, pixels):
+    # Rows go to the native writer one by one, never joined into one buffer
+    w = ImageWriter(f, len(pixels[0]) // 3, len(pixels))
+    for row in pixels:
+        w.write(row)
+    w.close()
+
+
+def discard_image(out, writer):
+    # An image that broke off before its last line is not kept
+    if writer:
+        writer.close()
+        out.close()
+        os.remove(out.name)
+
+
+def decode_stream(in_path, out_path, sr, encoding, mode, intro, follow, scan=False):
+    # Decode lines as the recording arrives; "-" reads from stdin. With scan
+    # set, every image found is written to its own timestamped file.
+    iformat = out_path.split(".")[-1].upper()
+    assert iformat in ["JPEG", "JPG", "BMP", "PNG"]
+
+    f = None if scan else open(out_path, "wb")
+    try:
+        e = DECODERS["General"](f, encoding, mode, sr)
+    except AssertionError:
+        logger.error("Unknown encoder or mode provided!")
+        sys.exit(1)
+
+    # Wall clock of the first sample for live input, else offsets into the file
+    t0 = time.time() if in_path == "-" or follow else None
+
+    src = sys.stdin.buffer if in_path == "-" else open(in_path, "rb")
+    pixels = []
+    out = writer = None
+    done = False
+    for j, row in e.stream(src, intro=intro, follow=follow):
+        if j == 0:
+            discard_image(out, writer)
+            out = writer = None
+            pixels = []
+            logger.info(f"Receiving {e.image['mode']} image...")
+
+            # Scanned images each get their own file, written as lines arrive
+            if scan:
+                path = image_path(
+                    out_path, float(e.image["start"] / e.sr), t0, e.image["mode"]
+                )
+                out = open(path, "wb")
+                writer = ImageWriter(out, len(row) // 3, e.image["height"])
+
+        if writer:
+            writer.write(row)
+        else:
+            pixels.append(row)
+        print(f"line {j + 1}/{e.image['height']}", end="\r", flush=True)
+
+        if j == e.image["height"] - 1:
+            print()
+            if scan:
+                writer.close()
+                out.close()
+                logger.info(f"Wrote {out.name}")
+                out = writer = None
+            else:
+                f.seek(0)
+                f.truncate()
+                save_image(f, pixels)
+            done = True
+
+    discard_image(out, writer)
+    if src is not sys.stdin.buffer:
+        src.close()
+    e.__del__()
+
+    return done
+
+
 def print_help():
     print("Usage:\n\t./sstv.py ...")
     print("\nAvailable encoders and modes:")
@@ -210,8 +485,13 @@ if __name__ == "__main__":
     wav = True
     intro = False
     get_size = False
+    stream = False
+    follow = False
+    scan = False
+    jobs = None
+    resize = None
     for arg in args:
-        if arg in ["--encode", "--decode"]:
+        if arg in ["--encode", "--decode", "--batch"]:
             func = arg
             in_path = args[args.index(arg) + 1]
         elif arg == "--out":
@@ -228,6 +508,21 @@ if __name__ == "__main__":
             intro = True
         elif arg == "--get_size":
             get_size = True
+        elif arg == "--stream":
+            stream = True
+        elif arg == "--follow":
+            stream = True
+            follow = True
+        elif arg == "--scan":
+            stream = True
+            scan = True
+        elif arg == "--jobs":
+            jobs = int(args[args.index(arg) + 1])
+        elif arg == "--resize":
+            resize = args[args.index(arg) + 1]
+            if resize not in RESIZE:
+                print(f"--resize takes one of: {', '.join(RESIZE)}")
+                sys.exit(1)
 
     # convert tool helper: print chosen encoding image size as WxH
     if get_size and encoding and mode:
@@ -238,14 +533,30 @@ if __name__ == "__main__":
         sys.exit(1)
 
     if in_path and out_path:
-        if func == "--encode" and encoding and mode:
+        if func == "--batch" and encoding and mode:
+            logger.info(f"Encoding images of {in_path}...")
+            if not encode_batch(
+                in_path, out_path, encoding, mode, intro, sr, wav, jobs, resize
+            ):
+                sys.exit(4)
+
+        elif func == "--encode" and encoding and mode:
             logger.info(f"Encoding {in_path}...")
-            if encode(in_path, out_path, encoding, mode, intro, sr, wav):
+            if encode(
+                in_path, out_path, encoding, mode, intro, sr, wav, jobs or 1, resize
+            ):
+                logger.info(f"Wrote output to {out_path}")
+
+        elif func == "--decode" and stream:
+            logger.info(f"Decoding {in_path} as it arrives...")
+            if decode_stream(
+                in_path, out_path, sr, encoding, mode, intro, follow, scan
+            ):
                 logger.info(f"Wrote output to {out_path}")
 
         elif func == "--decode":
             logger.info(f"Decoding {in_path}...")
-            if decode(in_path, out_path, sr, wav, encoding, mode, intro):
+            if decode(in_path, out_path, sr, wav, encoding, mode, intro, jobs or 1):
                 logger.info(f"Wrote output to {out_path}")
 
     logger.info("Done.")
@@ -0,0 +1,28 @@
+import math
+import os
+import sys
+
+# The modules load their C libraries from ../lib, relative to the working
+# directory: run from sstv/ like the scripts
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "digital"))
+sys.path.insert(0, os.path.join(ROOT, "sstv"))
+os.chdir(os.path.join(ROOT, "sstv"))
+
+
+def smooth_rows(w, h):
+    # RGB rows of a test card without sharp edges inside the checks
+    rows = []
+    for y in range(h):
+        row = bytearray()
+        for x in range(w):
+            b = (x * 255) // w if (x // 40 + y // 40) % 2 else 60
+            row += bytes((int(128 + 100 * math.sin(x / 23.0)), 255 * y // h, b))
+        rows.append(row)
+    return rows
+
+
+def mean_error(a, b):
+    a, b = b"".join(a), b"".join(b)
+    assert len(a) == len(b)
+    return sum(abs(x - y) for x, y in zip(a, b)) / len(a)
@@ -0,0 +1,54 @@
+import gc
+import os
+import sys
+
+import pytest
+from conftest import smooth_rows
+from img import save_image
+from sstv import encode, encode_batch
+
+
+def write_png(path, w, h):
+    with open(path, "wb") as f:
+        save_image(f, b"".join(smooth_rows(w, h)), w, h)
+
+
+def test_failed_encode_leaves_no_output(tmp_path):
+    # Too small for the mode: stopped before anything useful is written
+    src = tmp_path / "small.png"
+    write_png(src, 300, 200)
+    out = tmp_path / "small.wav"
+
+    with pytest.raises(SystemExit):
+        encode(str(src), str(out), "Martin", "M1", False, 44100, True)
+
+    assert os.listdir(tmp_path) == ["small.png"]
+
+
+def test_batch_failures_leave_no_output(tmp_path):
+    src = tmp_path / "in"
+    out = tmp_path / "out"
+    src.mkdir()
+    write_png(src / "good.png", 320, 256)
+    write_png(src / "small.png", 300, 200)
+    (src / "corrupt.png").write_bytes(b"not a png")
+
+    assert not encode_batch(str(src), str(out), "Martin", "M1", False, 44100, True, 1)
+    assert os.listdir(out) == ["good.wav"]
+
+
+@pytest.mark.parametrize("wav", [True, False])
+def test_failed_encode_closes_writer(tmp_path, monkeypatch, wav):
+    # The writer is closed before its file: nothing is left to write to the
+    # closed file when the encoder is collected
+    errors = []
+    monkeypatch.setattr(sys, "unraisablehook", errors.append)
+    src = tmp_path / "corrupt.png"
+    src.write_bytes(b"not a png")
+
+    with pytest.raises(RuntimeError):
+        encode(str(src), str(tmp_path / "out.wav"), "Martin", "M1", False, 44100, wav)
+    gc.collect()
+
+    assert not errors
+    assert os.listdir(tmp_path) == ["corrupt.png"]
@@ -0,0 +1,49 @@
+import array
+import random
+import wave
+
+from conftest import mean_error
+from encoder import MartinEncoder
+from img import buffer_rows, load_image
+from sstv import decode
+from test_stream import encode_wav
+
+
+def test_decode_uses_wav_rate(tmp_path):
+    # Recorded at 22050 Hz, decoded with the default --sr of 44100
+    path = tmp_path / "m1.wav"
+    rows = encode_wav(path, MartinEncoder, "M1", sr=22050)
+    with wave.open(str(path), "rb") as f:
+        assert f.getframerate() == 22050
+
+    out = tmp_path / "m1.png"
+    decode(str(path), str(out), 44100, True, "Martin", "M1", False)
+    _, w, h, data = load_image(str(out))
+    assert mean_error(list(buffer_rows(data, w, h)), rows) < 8
+
+
+def test_decode_fallback_mode(tmp_path):
+    # No known mode has this VIS code, but it is clearly there
+    path = tmp_path / "unknown.wav"
+    rows = encode_wav(path, MartinEncoder, "M1", vis=1)
+
+    out = tmp_path / "m1.png"
+    decode(str(path), str(out), 44100, True, "Martin", "M1", False)
+    _, w, h, data = load_image(str(out))
+    assert mean_error(list(buffer_rows(data, w, h)), rows) < 8
+
+
+def test_decode_rejects_noise(tmp_path):
+    # Noise alone is not decoded as the given mode
+    rng = random.Random(3)
+    pcm = array.array("h", [int(rng.gauss(0, 800)) for _ in range(5 * 44100)])
+    path = tmp_path / "noise.wav"
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(44100)
+        f.writeframes(pcm.tobytes())
+
+    out = tmp_path / "noise.png"
+    assert not decode(str(path), str(out), 44100, True, "Martin", "M1", False)
+    assert out.stat().st_size == 0
@@ -0,0 +1,80 @@
+import array
+import random
+import wave
+
+import pytest
+
+import fsk
+
+
+def payload(n, seed=1):
+    rng = random.Random(seed)
+    return bytes(rng.randrange(256) for _ in range(n))
+
+
+@pytest.mark.parametrize("sr", [44100, 8000])
+def test_raw_round_trip(tmp_path, sr):
+    # The last bit ends with the input, before the PLL samples it
+    data = payload(20000)
+    (tmp_path / "in.bin").write_bytes(data)
+    fsk.encode(str(tmp_path / "in.bin"), str(tmp_path / "fsk.wav"), sr, True)
+    fsk.decode(str(tmp_path / "fsk.wav"), str(tmp_path / "out.bin"))
+    assert (tmp_path / "out.bin").read_bytes() == data
+
+
+@pytest.mark.parametrize("sr", [44100, 8000])
+def test_raw_trailing_silence(tmp_path, sr):
+    # Carrier drops at some point of the silence, or not before the input
+    # ends; the last bit is sampled exactly once either way
+    data = payload(2000, 2)
+    (tmp_path / "in.bin").write_bytes(data)
+    fsk.encode(str(tmp_path / "in.bin"), str(tmp_path / "fsk.wav"), sr, True)
+    with wave.open(str(tmp_path / "fsk.wav"), "rb") as f:
+        pcm = array.array("h", f.readframes(f.getnframes()))
+
+    bit_len = sr // 1200
+    for tail in [0, bit_len // 4, bit_len // 2, bit_len, 3 * bit_len, sr]:
+        d = fsk.FSKDecoder(sr)
+        bits = d.demod(pcm + array.array("h", bytes(2 * tail))) + d.flush()
+        assert len(bits) == 8 * len(data)
+        assert d.pack(bits) == data
+        d.__del__()
+
+
+@pytest.mark.parametrize("sr", [44100, 8000])
+def test_hdlc_round_trip(tmp_path, sr):
+    data = payload(3000, 3)
+    (tmp_path / "in.bin").write_bytes(data)
+    fsk.encode(str(tmp_path / "in.bin"), str(tmp_path / "fsk.wav"), sr, True, 200)
+    fsk.decode(str(tmp_path / "fsk.wav"), str(tmp_path / "out.bin"), True)
+    assert (tmp_path / "out.bin").read_bytes() == data
+
+
+def convert(pcm, width, channels):
+    # Little-endian frames of the given width, the signal on every channel
+    frames = bytearray()
+    for v in pcm:
+        if width == 1:
+            s = bytes([(v >> 8) + 128])
+        else:
+            s = (v << (8 * width - 16)).to_bytes(width, "little", signed=True)
+        frames += s * channels
+    return bytes(frames)
+
+
+@pytest.mark.parametrize("width,channels", [(1, 1), (2, 2), (3, 1), (4, 2)])
+def test_sample_formats(tmp_path, width, channels):
+    data = payload(500, 4)
+    (tmp_path / "in.bin").write_bytes(data)
+    fsk.encode(str(tmp_path / "in.bin"), str(tmp_path / "fsk.wav"), 8000, True)
+    with wave.open(str(tmp_path / "fsk.wav"), "rb") as f:
+        pcm = array.array("h", f.readframes(f.getnframes()))
+
+    with wave.open(str(tmp_path / "conv.wav"), "wb") as f:
+        f.setnchannels(channels)
+        f.setsampwidth(width)
+        f.setframerate(8000)
+        f.writeframes(convert(pcm, width, channels))
+
+    fsk.decode(str(tmp_path / "conv.wav"), str(tmp_path / "out.bin"))
+    assert (tmp_path / "out.bin").read_bytes() == data
@@ -0,0 +1,37 @@
+import wave
+
+from decoder import Decoder
+from encoder import FAXEncoder
+
+SR = 44100
+
+
+def fax_track(path, header=True):
+    # One second of silence, then the header and phasing interval
+    f = wave.open(str(path), "wb")
+    e = FAXEncoder(f, True, "FAX480", SR)
+    e.generate_tones([0], [1.0])
+    if header:
+        e.generate_header()
+        e.generate_phasing_interval()
+    e.generate_tones([0], [3.0])
+    e.__del__()
+
+    d = Decoder(None, "FAX", "FAX480", SR)
+    d.read_wav(str(path))
+    _, track = d.process_image(0, d.slen, N=64, hop=16)
+    return d, track
+
+
+def test_fax_header(tmp_path):
+    d, track = fax_track(tmp_path / "fax.wav")
+    i, header = d.decode_header(0, track, True)
+    assert header["found"] and header["confidence"] > 0.8
+    assert abs(header["start"] - SR) < 16
+    assert abs(i - SR * (1 + 2440 * 0.00205)) < 16
+
+
+def test_fax_header_missing(tmp_path):
+    d, track = fax_track(tmp_path / "silence.wav", header=False)
+    _, header = d.decode_header(0, track, True)
+    assert not header["found"]
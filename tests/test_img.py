@@ -0,0 +1,263 @@
+import wave
+from multiprocessing import shared_memory
+
+import pytest
+from conftest import mean_error, smooth_rows
+from img import (
+    ImageReader,
+    ImageWriter,
+    buffer_rows,
+    load_image,
+    resize_image,
+    save_image,
+)
+from sstv import ENCODERS, encode
+
+
+@pytest.mark.parametrize("w", [1, 2, 3, 4, 101])
+def test_bmp_row_padding(tmp_path, w):
+    # Rows of width * 3 bytes are padded to a multiple of 4 in the file
+    rows = smooth_rows(w, 7)
+    path = tmp_path / "odd.bmp"
+    with open(path, "wb") as f:
+        save_image(f, b"".join(rows), w, 7)
+
+    ext, w_, h, data = load_image(str(path))
+    assert (w_, h) == (w, 7)
+    assert [bytes(r) for r in buffer_rows(data, w, h, bottom_up=True)] == rows
+
+    img = ImageReader(str(path))
+    assert list(img) == rows
+    img.close()
+
+
+def bands(w, h, widths):
+    # RGB rows of vertical bands, (colour, width) from the left
+    row = b"".join(bytes(c) * n for c, n in widths)
+    assert len(row) == 3 * w
+    return [row] * h
+
+
+def pixel(data, w, x, y):
+    return tuple(data[3 * (y * w + x) : 3 * (y * w + x) + 3])
+
+
+RED, GREEN, BLUE, WHITE = (255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255)
+
+
+@pytest.mark.parametrize("w, h", [(100, 50), (640, 480), (1000, 1000)])
+def test_resize_stretch(w, h):
+    # Each axis scaled on its own: the halves stay halves, flat areas flat,
+    # whether shrinking (area) or growing (bilinear)
+    rows = bands(w, h, [(RED, w // 2), (BLUE, w - w // 2)])
+    out = resize_image(b"".join(rows), w, h, 320, 256, "stretch")
+
+    assert len(out) == 320 * 256 * 3
+    for y in (0, 128, 255):
+        assert pixel(out, 320, 0, y) == RED and pixel(out, 320, 150, y) == RED
+        assert pixel(out, 320, 170, y) == BLUE and pixel(out, 320, 319, y) == BLUE
+
+
+def test_resize_fit():
+    # A square in a 320 x 256 frame: black bars left and right
+    rows = bands(100, 100, [(WHITE, 100)])
+    out = resize_image(b"".join(rows), 100, 100, 320, 256, "fit")
+
+    for y in (0, 255):
+        assert pixel(out, 320, 31, y) == (0, 0, 0)
+        assert pixel(out, 320, 32, y) == WHITE
+        assert pixel(out, 320, 287, y) == WHITE
+        assert pixel(out, 320, 288, y) == (0, 0, 0)
+
+
+def test_resize_crop():
+    # 2:1 into 5:4, cut evenly from both sides: 37.5 columns each
+    rows = bands(200, 100, [(RED, 30), (GREEN, 140), (BLUE, 30)])
+    out = resize_image(b"".join(rows), 200, 100, 320, 256, "crop")
+
+    assert set(pixel(out, 320, x, y) for x in range(320) for y in (0, 200)) == {GREEN}
+
+
+@pytest.mark.parametrize("policy", ["stretch", "fit", "crop"])
+def test_load_resized(tmp_path, policy):
+    # load_image resamples on the way, to the same result
+    rows = smooth_rows(300, 200)
+    path = tmp_path / "img.png"
+    with open(path, "wb") as f:
+        save_image(f, b"".join(rows), 300, 200)
+
+    ext, w, h, data = load_image(str(path), size=(320, 256), policy=policy)
+    assert (w, h) == (320, 256)
+    assert bytes(data) == bytes(
+        resize_image(b"".join(rows), 300, 200, 320, 256, policy)
+    )
+
+
+def test_encode_resized(tmp_path):
+    # A size the mode does not have is resampled instead of rejected
+    rows = smooth_rows(300, 200)
+    src = tmp_path / "img.png"
+    with open(src, "wb") as f:
+        save_image(f, b"".join(rows), 300, 200)
+
+    out = tmp_path / "img.wav"
+    assert encode(str(src), str(out), "Martin", "M1", False, 44100, True, resize="fit")
+    with wave.open(str(out), "rb") as f:
+        assert f.getnframes() > 114 * 44100
+
+
+def write_image(path, rows, w, h):
+    with open(path, "wb") as f:
+        save_image(f, b"".join(rows), w, h)
+
+
+@pytest.mark.parametrize("ext", ["png", "bmp", "jpg"])
+def test_load_into_buffer(tmp_path, ext):
+    # Decoded straight into the caller's buffer, which the result views
+    rows = smooth_rows(64, 48)
+    path = tmp_path / f"img.{ext}"
+    write_image(path, rows, 64, 48)
+
+    buf = bytearray(64 * 48 * 3 + 10)
+    _, w, h, data = load_image(str(path), buf)
+    assert (w, h) == (64, 48)
+    data[0] = 7
+    assert buf[0] == 7 and len(data) == 64 * 48 * 3
+    assert bytes(buf[len(data) :]) == bytes(10)
+
+    _, _, _, fresh = load_image(str(path))
+    data[0] = fresh[0]
+    assert bytes(data) == bytes(fresh)
+
+
+def test_load_into_shared_memory(tmp_path):
+    rows = smooth_rows(64, 48)
+    path = tmp_path / "img.png"
+    write_image(path, rows, 64, 48)
+
+    shm = shared_memory.SharedMemory(create=True, size=64 * 48 * 3)
+    try:
+        _, w, h, data = load_image(str(path), shm.buf)
+        assert bytes(shm.buf) == b"".join(rows)
+        data.release()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def test_load_into_small_buffer(tmp_path):
+    path = tmp_path / "img.png"
+    write_image(path, smooth_rows(64, 48), 64, 48)
+
+    with pytest.raises(ValueError):
+        load_image(str(path), bytearray(64 * 48 * 3 - 1))
+
+
+def read_rows(path):
+    reader = ImageReader(str(path))
+    rows = list(reader)
+    reader.close()
+    return reader.width, reader.height, rows
+
+
+@pytest.mark.parametrize("ext,tol", [("png", 0), ("bmp", 0), ("jpg", 4)])
+def test_writer_round_trip(tmp_path, ext, tol):
+    rows = smooth_rows(101, 37)
+    with open(tmp_path / f"out.{ext}", "wb") as f:
+        writer = ImageWriter(f, 101, 37)
+        for row in rows:
+            writer.write(row)
+        writer.close()
+
+    w, h, got = read_rows(tmp_path / f"out.{ext}")
+    assert (w, h) == (101, 37)
+    assert mean_error(got, rows) <= tol
+
+
+@pytest.mark.parametrize("ext", ["png", "bmp", "jpg"])
+def test_writer_matches_save(tmp_path, ext):
+    # Streaming the rows and saving the whole buffer give the same file
+    rows = smooth_rows(64, 48)
+    write_image(tmp_path / f"a.{ext}", rows, 64, 48)
+    with open(tmp_path / f"b.{ext}", "wb") as f:
+        writer = ImageWriter(f, 64, 48)
+        for row in rows:
+            writer.write(row)
+        writer.close()
+    assert (tmp_path / f"a.{ext}").read_bytes() == (tmp_path / f"b.{ext}").read_bytes()
+
+
+@pytest.mark.parametrize("ext", ["png", "bmp"])
+def test_writer_unwritten_rows(tmp_path, ext):
+    rows = smooth_rows(64, 48)
+    with open(tmp_path / f"out.{ext}", "wb") as f:
+        writer = ImageWriter(f, 64, 48)
+        for row in rows[:20]:
+            writer.write(row)
+        with pytest.raises(ValueError):
+            writer.write(rows[20][:-3])
+        writer.close()
+
+    _, _, got = read_rows(tmp_path / f"out.{ext}")
+    assert got[:20] == rows[:20]
+    assert got[20:] == [bytes(64 * 3)] * 28
+
+
+def encode_rows(path, encoding, mode, rows):
+    # Raw tones of the rows handed to the encoder from memory
+    with open(path, "wb") as f:
+        e = ENCODERS[encoding](f, False, mode, 44100)
+        e.generate_header()
+        e.generate_VIS()
+        e.encode_image(iter(rows))
+        e.__del__()
+
+
+@pytest.mark.parametrize("ext", ["png", "bmp"])
+@pytest.mark.parametrize(
+    "encoding,mode", [("Martin", "M2"), ("Robot", "36"), ("PD", "PD50")]
+)
+def test_encode_streamed(tmp_path, ext, encoding, mode):
+    # Rows pulled from the file as the encoder goes give the same audio
+    e = ENCODERS[encoding](None, False, mode, 44100)
+    w, h = e.enc["width"], e.enc["height"]
+    rows = smooth_rows(w, h)
+    write_image(tmp_path / f"src.{ext}", rows, w, h)
+
+    encode(
+        str(tmp_path / f"src.{ext}"),
+        str(tmp_path / "a.raw"),
+        encoding,
+        mode,
+        False,
+        44100,
+        False,
+    )
+    encode_rows(tmp_path / "b.raw", encoding, mode, rows)
+    assert (tmp_path / "a.raw").read_bytes() == (tmp_path / "b.raw").read_bytes()
+
+
+@pytest.mark.parametrize("ext", ["png", "bmp"])
+def test_encode_oversized(tmp_path, ext):
+    # Without --resize a larger image is sent from its top left corner
+    rows = smooth_rows(400, 300)
+    write_image(tmp_path / f"src.{ext}", rows, 400, 300)
+
+    encode(
+        str(tmp_path / f"src.{ext}"),
+        str(tmp_path / "a.raw"),
+        "Martin",
+        "M2",
+        False,
+        44100,
+        False,
+    )
+    encode_rows(tmp_path / "b.raw", "Martin", "M2", [r[: 320 * 3] for r in rows[:256]])
+    assert (tmp_path / "a.raw").read_bytes() == (tmp_path / "b.raw").read_bytes()
+
+
+def test_buffer_rows_bottom_up():
+    rows = smooth_rows(5, 4)
+    data = b"".join(rows)
+    assert list(map(bytes, buffer_rows(data, 5, 4))) == rows
+    assert list(map(bytes, buffer_rows(data, 5, 4, bottom_up=True))) == rows[::-1]
@@ -0,0 +1,37 @@
+import array
+import math
+import wave
+
+from conftest import mean_error, smooth_rows
+from decoder import Decoder
+from encoder import MartinEncoder
+
+
+def test_stft_zero_before_start():
+    # Frames reaching before sample 0 see silence there
+    d = Decoder(None, None, None, 8000)
+    pcm = array.array(
+        "h", [int(8000 * math.sin(2 * math.pi * 1900 * i / 8000)) for i in range(4096)]
+    )
+    d.pcm_samples = memoryview(pcm)
+    d.slen = len(pcm)
+
+    track = d.stft(-64, 64, 64, 16)
+    assert track[0] == -1 and track[1] < 1e-6
+    assert abs(track[-2] - 1900) < 20
+
+
+def test_region_at_sample_zero(tmp_path):
+    # Line 0 starts the recording: the track is clamped to the PCM
+    path = tmp_path / "image.wav"
+    f = wave.open(str(path), "wb")
+    e = MartinEncoder(f, True, "M1", 44100)
+    rows = smooth_rows(e.enc["width"], e.enc["height"])
+    e.encode_image(rows)
+    e.__del__()
+
+    d = Decoder(None, "Martin", "M1")
+    d.read_wav(str(path))
+    got = d.decode_region(MartinEncoder, "M1", 0)
+    assert len(got) == len(rows)
+    assert mean_error(got, rows) < 4
@@ -0,0 +1,165 @@
+import array
+import math
+import random
+import wave
+
+import pytest
+from conftest import mean_error, smooth_rows
+from decoder import Decoder
+from encoder import MartinEncoder, PDEncoder, RobotEncoder, ScottieEncoder
+
+
+def encode_wav(path, encoder, mode, sr=44100, vis=None):
+    f = wave.open(str(path), "wb")
+    e = encoder(f, True, mode, sr)
+    if vis is not None:
+        e.enc = dict(e.enc, vis=vis)
+    rows = smooth_rows(e.enc["width"], e.enc["height"])
+    e.generate_header()
+    e.generate_VIS()
+    e.encode_image(rows)
+    e.__del__()
+    return rows
+
+
+@pytest.mark.parametrize("mode", ["S1", "DX"])
+def test_stream_scottie(tmp_path, mode):
+    # The leading sync pulse comes before line 0
+    path = tmp_path / "scottie.wav"
+    rows = encode_wav(path, ScottieEncoder, mode)
+
+    d = Decoder(None, "Scottie", mode)
+    with open(path, "rb") as f:
+        got = [row for _, row in d.stream(f)]
+
+    assert d.image["mode"] == mode
+    assert len(got) == len(rows)
+    assert mean_error(got, rows) < 6
+
+
+@pytest.mark.parametrize(
+    "encoding, encoder, mode",
+    [
+        ("Robot", RobotEncoder, "36"),
+        ("PD", PDEncoder, "PD50"),
+        ("Martin", MartinEncoder, "M1"),
+    ],
+)
+def test_stream_fine_track(tmp_path, encoding, encoder, mode):
+    # Image lines are decoded on the fine track, as close as a batch decode
+    path = tmp_path / "image.wav"
+    rows = encode_wav(path, encoder, mode)
+
+    d = Decoder(None, encoding, mode)
+    with open(path, "rb") as f:
+        got = [row for _, row in d.stream(f, chunk=4096)]
+
+    assert len(got) == len(rows)
+    assert mean_error(got, rows) < 8
+
+
+def prepend(path, lead):
+    # Rewrite a mono 16-bit WAV with the samples of lead in front
+    with wave.open(str(path), "rb") as f:
+        sr = f.getframerate()
+        pcm = f.readframes(f.getnframes())
+
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sr)
+        f.writeframes(lead.tobytes() + pcm)
+
+
+@pytest.mark.parametrize("gap", [0.1, 0.4, 0.9])
+def test_stream_false_start(tmp_path, gap):
+    # A short 1900 Hz burst is not a header; the leader that follows it
+    # within the span the header search walks is still found
+    path = tmp_path / "burst.wav"
+    rows = encode_wav(path, MartinEncoder, "M1")
+    burst = [int(8000 * math.sin(2 * math.pi * 1900 * i / 44100)) for i in range(8820)]
+    prepend(path, array.array("h", burst + [0] * int(gap * 44100)))
+
+    d = Decoder(None, None, None)
+    with open(path, "rb") as f:
+        got = [row for _, row in d.stream(f)]
+
+    assert d.image["mode"] == "M1"
+    assert len(got) == len(rows)
+    assert mean_error(got, rows) < 6
+
+
+@pytest.mark.parametrize("lead", [5, 8, 12])
+def test_stream_noise_lead(tmp_path, lead):
+    # Seconds of noise well above the fixed tone threshold before a weaker
+    # transmission: the scan tracks the noise floor instead of firing on it
+    path = tmp_path / "noise.wav"
+    rows = encode_wav(path, MartinEncoder, "M1")
+    with wave.open(str(path), "rb") as f:
+        pcm = array.array("h", f.readframes(f.getnframes()))
+    for i, v in enumerate(pcm):
+        pcm[i] = int(0.3 * v)
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(44100)
+        f.writeframes(pcm.tobytes())
+
+    rng = random.Random(lead)
+    noise = [int(rng.gauss(0, 800)) for _ in range(lead * 44100)]
+    prepend(path, array.array("h", [max(-32768, min(32767, v)) for v in noise]))
+
+    d = Decoder(None, None, None)
+    with open(path, "rb") as f:
+        got = [row for _, row in d.stream(f)]
+
+    assert d.image["mode"] == "M1"
+    assert len(got) == len(rows)
+    assert mean_error(got, rows) < 6
+
+
+def test_scan_ignores_noise():
+    # Once the floor is known, 20 s of noise give no more than a stray hit
+    rng = random.Random(1)
+    pcm = array.array("h", [int(rng.gauss(0, 800)) for _ in range(20 * 44100)])
+    d = Decoder(None, None, None)
+    d.pcm_samples = memoryview(pcm)
+    d.slen = len(pcm)
+
+    hits = []
+    i = d.find_nonsil()
+    while i < d.slen:
+        hits.append(i)
+        i = d.find_nonsil(start=i + 128)
+
+    assert len(hits) <= 2
+
+
+def test_stream_fallback_mode(tmp_path):
+    # A clear VIS code of no known mode is decoded as the given one
+    path = tmp_path / "unknown.wav"
+    rows = encode_wav(path, MartinEncoder, "M1", vis=1)
+
+    d = Decoder(None, "Martin", "M1")
+    with open(path, "rb") as f:
+        got = [row for _, row in d.stream(f)]
+
+    assert len(got) == len(rows)
+    assert mean_error(got, rows) < 6
+
+
+def test_stream_fallback_needs_code(tmp_path):
+    # A header without anything like a VIS code after it is no image,
+    # whatever mode was given
+    path = tmp_path / "header.wav"
+    f = wave.open(str(path), "wb")
+    e = MartinEncoder(f, True, "M1", 44100)
+    e.generate_header()
+    e.generate_tones([0], [2.0])
+    e.__del__()
+
+    d = Decoder(None, "Martin", "M1")
+    with open(path, "rb") as f:
+        got = [row for _, row in d.stream(f)]
+
+    assert d.image is None and not got
@@ -0,0 +1,57 @@
+import wave
+
+import pytest
+from conftest import mean_error
+from decoder import Decoder
+from encoder import MartinEncoder
+from test_stream import encode_wav
+
+
+def relabel(path, sr):
+    # Claim another sample rate: a sender whose sound card clock is off
+    with wave.open(str(path), "rb") as f:
+        pcm = f.readframes(f.getnframes())
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sr)
+        f.writeframes(pcm)
+
+
+def decode_m1(path):
+    # Header, VIS code and sync fit as decode() does them
+    d = Decoder(None, None, None)
+    d.read_wav(str(path))
+    ns = d.find_nonsil()
+    ns, track = d.process_image(ns, round(d.sr * 0.91))
+    j, _ = d.decode_header(ns, track, False)
+    j, vis = d.decode_VIS(j, track)
+    assert vis["mode"] == (MartinEncoder, "M1")
+
+    start, period = d.sync_lines(MartinEncoder, "M1", j)
+    return d, start, period
+
+
+@pytest.mark.parametrize("sent", [44100, 44122, 44065])
+def test_clock_error(tmp_path, sent):
+    # Sent at one rate and received at 44100 Hz: the fit measures the
+    # difference and the lines are sampled on it, without slant
+    path = tmp_path / "m1.wav"
+    rows = encode_wav(path, MartinEncoder, "M1", sr=sent)
+    relabel(path, 44100)
+
+    d, start, period = decode_m1(path)
+    got = d.decode_region(MartinEncoder, "M1", start, period=period)
+    assert abs(d.clock_error - (sent / 44100 - 1)) < 20e-6
+    assert mean_error(got, rows) < 4
+
+
+def test_slant_without_fit(tmp_path):
+    # Lines taken at the nominal period drift across the image
+    path = tmp_path / "m1.wav"
+    rows = encode_wav(path, MartinEncoder, "M1", sr=44144)
+    relabel(path, 44100)
+
+    d, start, _ = decode_m1(path)
+    got = d.decode_region(MartinEncoder, "M1", start)
+    assert mean_error(got, rows) > 10
@@ -0,0 +1,100 @@
+import array
+import math
+import random
+import wave
+
+import pytest
+from decoder import Decoder
+from encoder import MartinEncoder, PDEncoder, RobotEncoder, ScottieEncoder
+
+SR = 44100
+
+
+def vis_track(tmp_path, encoder, mode, parity_ok=True, lead=0.5):
+    # Silence, header and VIS code of a mode, then silence again
+    path = tmp_path / "vis.wav"
+    f = wave.open(str(path), "wb")
+    e = encoder(f, True, mode, SR)
+    e.generate_tones([0], [lead])
+    e.generate_header()
+    if parity_ok:
+        e.generate_VIS()
+    else:
+        bits = e.dec_to_bin_lsb(e.enc["vis"])
+        parity = sum(bits) % 2 == 0
+        e.generate_tones(
+            [1200] + [[1300, 1100][b] for b in bits] + [[1300, 1100][parity], 1200],
+            [0.03] * 10,
+        )
+    e.generate_tones([0], [0.5])
+    e.__del__()
+
+    d = Decoder(None, None, None)
+    d.read_wav(str(path))
+    _, track = d.process_image(0, d.slen)
+    return d, track, round((lead + 0.61) * SR)
+
+
+@pytest.mark.parametrize(
+    "encoder, mode",
+    [
+        (MartinEncoder, "M1"),
+        (ScottieEncoder, "DX"),
+        (RobotEncoder, "36"),
+        (PDEncoder, "PD290"),
+    ],
+)
+@pytest.mark.parametrize("off", [-0.2, -0.01, 0, 0.013, 0.25])
+def test_vis_found(tmp_path, encoder, mode, off):
+    # Found wherever the search starts within 0.35 s of the start bit, to
+    # a fraction of a millisecond
+    d, track, start = vis_track(tmp_path, encoder, mode)
+    end, info = d.decode_VIS(start + round(off * SR), track)
+
+    assert info["mode"] == (encoder, mode)
+    assert info["parity"]
+    assert info["confidence"] > 0.9
+    assert abs(info["start"] - start) <= 8
+    assert abs(end - (start + 10 * 0.03 * SR)) <= 8
+
+
+def test_vis_bad_parity(tmp_path):
+    d, track, start = vis_track(tmp_path, MartinEncoder, "M1", parity_ok=False)
+    _, info = d.decode_VIS(start, track)
+
+    assert info["code"] == 44 and not info["parity"]
+    assert info["mode"] is None
+
+
+def test_vis_noise():
+    # Nothing like a VIS code: low confidence, no mode
+    rng = random.Random(5)
+    pcm = array.array("h", [int(rng.gauss(0, 3000)) for _ in range(2 * SR)])
+    d = Decoder(None, None, None)
+    d.pcm_samples = memoryview(pcm)
+    d.slen = len(pcm)
+    _, track = d.process_image(0, d.slen)
+    _, info = d.decode_VIS(SR, track)
+
+    assert info["mode"] is None
+    assert info["confidence"] < 0.1
+
+
+@pytest.mark.parametrize("N,hop", [(441, 10), (220, 1), (1024, 37)])
+def test_tone_mags_sliding(N, hop):
+    # The sliding DFT gives the same windows as the Goertzel filters
+    rng = random.Random(N)
+    d = Decoder(None, None, None, SR)
+    d.pcm_samples = array.array(
+        "h",
+        (
+            int(8000 * math.sin(2 * math.pi * 1900 * i / SR) + rng.gauss(0, 2000))
+            for i in range(SR)
+        ),
+    )
+    d.slen = len(d.pcm_samples)
+
+    a = d.tone_mags([1100, 1200, 1900], 0, SR - N, N, hop)
+    b = d.tone_mags([1100, 1200, 1900], 0, SR - N, N, hop, sliding=True)
+    assert max(abs(x - y) for x, y in zip(a, b)) < 1e-6
+    assert 7500 < max(a) < 9500
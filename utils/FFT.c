@@ -14,6 +14,9 @@
 #include <stdlib.h>
 #include <float.h>
 #include "goertzel.c"
+#include "bank.c"
+#include "segments.c"
+#include "fsk.c"
 
 
 void fft(double *real, double *imag, int n) {
@@ -62,11 +65,63 @@ void fft(double *real, double *imag, int n) {
 }
 
 void ifft(double *real, double *imag, int n) {
+    // Inverse through the forward transform: conj(fft(conj(x))) / n
+    for (int i = 0; i < n; i++)
+        imag[i] = -imag[i];
+
     fft(real, imag, n);
     for (int i = 0; i < n; i++) {
         real[i] /= n;
-        imag[i] /= n;
+        imag[i] /= -n;
+    }
+}
+
+/* Cross-correlation out[k] = sum_i x[k + i] * t[i] for k = 0 .. nx - nt.
+   Both real inputs go through a single complex FFT (x as the real part, t as
+   the imaginary part) and one inverse FFT gives every lag. Returns the
+   number of lags. */
+long xcorr(const double *x, long nx, const double *t, long nt, double *out) {
+    if (nt <= 0 || nt > nx)
+        return 0;
+
+    int n = 1;
+    while (n < nx)
+        n <<= 1;
+
+    double *re = calloc(n, sizeof(double));
+    double *im = calloc(n, sizeof(double));
+    double *rr = malloc(n * sizeof(double));
+    double *ri = malloc(n * sizeof(double));
+
+    for (long i = 0; i < nx; i++)
+        re[i] = x[i];
+    for (long i = 0; i < nt; i++)
+        im[i] = t[i];
+
+    fft(re, im, n);
+
+    for (int k = 0; k < n; k++) {
+        int m = (n - k) & (n - 1);
+
+        // X = (Z[k] + conj(Z[n-k])) / 2, T = (Z[k] - conj(Z[n-k])) / 2i
+        double xr = (re[k] + re[m]) / 2, xi = (im[k] - im[m]) / 2;
+        double tr = (im[k] + im[m]) / 2, ti = -(re[k] - re[m]) / 2;
+
+        // X * conj(T)
+        rr[k] = xr * tr + xi * ti;
+        ri[k] = xi * tr - xr * ti;
     }
+
+    ifft(rr, ri, n);
+
+    for (long k = 0; k <= nx - nt; k++)
+        out[k] = rr[k];
+
+    free(re);
+    free(im);
+    free(rr);
+    free(ri);
+    return nx - nt + 1;
 }
 
 void dct(double *val, int n) {
@@ -115,4 +170,207 @@ void mag_log(double *mag, int n) {
     for (int i = 0; i < n; i++) {
         mag[i] = log(100*mag[i] + 1.0);
     }
-}
\ No newline at end of file
+}
+
+/* Convert interleaved little-endian PCM frames (8-bit unsigned, or 16/24/32-bit
+   signed) to 16-bit mono. A negative channel averages all channels. */
+void pcm_to_s16(const unsigned char *raw, long frames, int width, int channels,
+                int channel, int16_t *out) {
+    for (long i = 0; i < frames; i++) {
+        const unsigned char *frame = raw + i * width * channels;
+        long acc = 0;
+
+        for (int c = 0; c < channels; c++) {
+            if (channel >= 0 && c != channel)
+                continue;
+
+            const unsigned char *s = frame + c * width;
+            int v;
+            if (width == 1)
+                v = ((int)s[0] - 128) << 8;
+            else
+                v = (int16_t)(s[width - 2] | (s[width - 1] << 8));
+
+            acc += v;
+        }
+
+        out[i] = (int16_t)(channel >= 0 ? acc : acc / channels);
+    }
+}
+
+
+/* FFT plan for real input of length n (a power of two): bit reversal,
+   twiddles and Hann window are computed once and reused by every rfft()
+   call. The transform packs the n real samples into n/2 complex values,
+   runs an n/2-point complex FFT and splits the result into the n/2 + 1
+   non-redundant bins. */
+typedef struct {
+    int n;
+    int *rev;
+    double *tw_re, *tw_im;
+    double *sp_re, *sp_im;
+    double *win;
+    double *zr, *zi;
+} fft_plan;
+
+fft_plan *fft_plan_create(int n) {
+    int m = n / 2;
+    fft_plan *p = malloc(sizeof(fft_plan));
+
+    p->n = n;
+    p->rev = malloc(m * sizeof(int));
+    p->tw_re = malloc((m / 2 + 1) * sizeof(double));
+    p->tw_im = malloc((m / 2 + 1) * sizeof(double));
+    p->sp_re = malloc((m + 1) * sizeof(double));
+    p->sp_im = malloc((m + 1) * sizeof(double));
+    p->win = malloc(n * sizeof(double));
+    p->zr = malloc(m * sizeof(double));
+    p->zi = malloc(m * sizeof(double));
+
+    for (int i = 1, j = 0; i < m; i++) {
+        int bit = m >> 1;
+
+        for (; j & bit; bit >>= 1)
+            j ^= bit;
+
+        j ^= bit;
+        p->rev[i] = j;
+    }
+    p->rev[0] = 0;
+
+    for (int k = 0; k <= m / 2; k++) {
+        p->tw_re[k] = cos(-2 * M_PI * k / m);
+        p->tw_im[k] = sin(-2 * M_PI * k / m);
+    }
+
+    for (int k = 0; k <= m; k++) {
+        p->sp_re[k] = cos(-2 * M_PI * k / n);
+        p->sp_im[k] = sin(-2 * M_PI * k / n);
+    }
+
+    hann(p->win, n);
+    return p;
+}
+
+void fft_plan_destroy(fft_plan *p) {
+    free(p->rev);
+    free(p->tw_re);
+    free(p->tw_im);
+    free(p->sp_re);
+    free(p->sp_im);
+    free(p->win);
+    free(p->zr);
+    free(p->zi);
+    free(p);
+}
+
+/* Real-to-complex FFT of in[0..n), writes bins 0..n/2 to re and im. */
+void rfft(fft_plan *p, const double *in, double *re, double *im) {
+    int m = p->n / 2;
+    double *zr = p->zr, *zi = p->zi;
+
+    for (int i = 0; i < m; i++) {
+        zr[p->rev[i]] = in[2 * i];
+        zi[p->rev[i]] = in[2 * i + 1];
+    }
+
+    for (int len = 2; len <= m; len <<= 1) {
+        int step = m / len;
+
+        for (int i = 0; i < m; i += len) {
+            for (int j = 0; j < len / 2; j++) {
+                double wr = p->tw_re[j * step], wi = p->tw_im[j * step];
+                int a = i + j, b = i + j + len / 2;
+                double vr = zr[b] * wr - zi[b] * wi;
+                double vi = zr[b] * wi + zi[b] * wr;
+
+                zr[b] = zr[a] - vr;
+                zi[b] = zi[a] - vi;
+                zr[a] += vr;
+                zi[a] += vi;
+            }
+        }
+    }
+
+    for (int k = 0; k <= m; k++) {
+        double ar = zr[k % m], ai = zi[k % m];
+        double br = zr[(m - k) % m], bi = -zi[(m - k) % m];
+
+        // Even and odd sample spectra
+        double evr = 0.5 * (ar + br), evi = 0.5 * (ai + bi);
+        double odr = 0.5 * (ai - bi), odi = -0.5 * (ar - br);
+
+        re[k] = evr + odr * p->sp_re[k] - odi * p->sp_im[k];
+        im[k] = evi + odr * p->sp_im[k] + odi * p->sp_re[k];
+    }
+}
+
+/* Peak-picking STFT over a 16-bit PCM buffer. One frame of n samples
+   (zero outside 0 .. len - 1) is Hann-windowed and transformed every hop samples from
+   start while below end. For frame k, out[2k] receives the peak frequency
+   (quadratically interpolated on the log magnitude, -1 if none) and
+   out[2k + 1] the frame power. Returns the number of frames.
+
+   https://ccrma.stanford.edu/~jos/sasp/Quadratic_Interpolation_Spectral_Peaks.html */
+long stft_track(fft_plan *plan, const int16_t *pcm, long len, long start,
+                long end, int hop, double sample_rate, double *out) {
+    int n = plan->n;
+    int bins = n / 2 + 1;
+    double *x = malloc(n * sizeof(double));
+    double *re = malloc(bins * sizeof(double));
+    double *im = malloc(bins * sizeof(double));
+    double *mag = malloc(bins * sizeof(double));
+    long frames = 0;
+
+    if (end > len)
+        end = len;
+
+    for (long i = start; i < end; i += hop, frames++) {
+        for (int k = 0; k < n; k++)
+            x[k] = (i + k >= 0 && i + k < len) ? pcm[i + k] * plan->win[k] : 0.0;
+
+        rfft(plan, x, re, im);
+
+        // Power over the full (mirrored) spectrum
+        double pwr = DBL_EPSILON;
+        for (int k = 0; k < bins; k++) {
+            mag[k] = re[k] * re[k] + im[k] * im[k];
+            pwr += (k == 0 || k == bins - 1) ? mag[k] : 2 * mag[k];
+        }
+        pwr = sqrt(pwr / n);
+        mag_log(mag, bins);
+
+        int peak = 0;
+        double best = 1e-10;
+        for (int k = 0; k < bins; k++) {
+            if (mag[k] > best) {
+                best = mag[k];
+                peak = k;
+            }
+        }
+
+        double nf = -1;
+        if (peak) {
+            nf = peak * sample_rate / n;
+
+            if (peak - 1 > 0 && peak + 1 < bins) {
+                double p = mag[peak - 1], c = mag[peak], q = mag[peak + 1];
+
+                // Consider only if local peak
+                if (c > p && c > q) {
+                    double d = 0.5 * (p - q) / (p - 2 * c + q);
+                    nf = (peak + d) * (sample_rate / n);
+                }
+            }
+        }
+
+        out[2 * frames] = nf;
+        out[2 * frames + 1] = pwr;
+    }
+
+    free(x);
+    free(re);
+    free(im);
+    free(mag);
+    return frames;
+}
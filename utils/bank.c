@@ -0,0 +1,181 @@
+/*
+  bank.c
+
+  Goertzel filter bank: the coefficients for a fixed set of tones are
+  computed once, then every window is evaluated for all tones in a single
+  pass over its samples.
+
+  Both use the periodic Hann window. gbank_run() recomputes each window
+  from scratch (cheapest for hop >= n / 8). gbank_slide() instead updates
+  a sliding DFT every sample, which is cheaper for small hops. It builds
+  the window from three rectangular bins per tone, and recomputes the bins
+  from scratch every GBANK_RESYNC windows to stop rounding drift.
+
+  Magnitudes are scaled to the amplitude of a matching sine, so a
+  full-scale tone reads about 32767.
+*/
+
+#include <complex.h>
+#include <math.h>
+#include <stdint.h>
+#include <stdlib.h>
+
+#define GBANK_RESYNC 64
+
+
+typedef struct {
+    int k;
+    int n;
+    double *coeff;          /* 2 cos(w) for the Goertzel recurrence */
+    double *cw, *sw;        /* cos(w), sin(w) for the final output */
+    double *win;
+    double norm;            /* 2 / sum(win) */
+    double complex *rot;    /* e^{jw} for the 3 sliding bins of each tone */
+    double complex *head;   /* e^{-jw(n-1)} */
+    double complex *bins;
+} gbank;
+
+void gbank_destroy(gbank *b) {
+    free(b->coeff);
+    free(b->cw);
+    free(b->sw);
+    free(b->win);
+    free(b->rot);
+    free(b->head);
+    free(b->bins);
+    free(b);
+}
+
+/* NULL if out of memory. */
+gbank *gbank_create(const double *freqs, int k, double sample_rate, int n) {
+    gbank *b = calloc(1, sizeof(gbank));
+    double wsum = 0;
+    if (!b)
+        return NULL;
+
+    b->k = k;
+    b->n = n;
+    b->coeff = malloc(k * sizeof(double));
+    b->cw = malloc(k * sizeof(double));
+    b->sw = malloc(k * sizeof(double));
+    b->win = malloc(n * sizeof(double));
+    b->rot = malloc(3 * k * sizeof(double complex));
+    b->head = malloc(3 * k * sizeof(double complex));
+    b->bins = malloc(3 * k * sizeof(double complex));
+    if (!b->coeff || !b->cw || !b->sw || !b->win || !b->rot || !b->head || !b->bins) {
+        gbank_destroy(b);
+        return NULL;
+    }
+
+    for (int i = 0; i < n; i++) {
+        b->win[i] = 0.5 * (1 - cos(2*M_PI * i/n));
+        wsum += b->win[i];
+    }
+    b->norm = 2 / wsum;
+
+    for (int t = 0; t < k; t++) {
+        double w = 2*M_PI * freqs[t] / sample_rate;
+        b->coeff[t] = 2 * cos(w);
+        b->cw[t] = cos(w);
+        b->sw[t] = sin(w);
+
+        for (int j = 0; j < 3; j++) {
+            double wj = w + (j - 1) * 2*M_PI / n;
+            b->rot[3*t + j] = cexp(I * wj);
+            b->head[3*t + j] = cexp(-I * wj * (n - 1));
+        }
+    }
+
+    return b;
+}
+
+static double pcm_at(const int16_t *pcm, long len, long i) {
+    return (i >= 0 && i < len) ? pcm[i] : 0.0;
+}
+
+/* Windowed magnitudes of all tones for windows starting at start, start + hop,
+   ... below end; out[frame * k + tone]. Returns the number of frames, or -1
+   if out of memory. */
+long gbank_run(gbank *b, const int16_t *pcm, long len, long start, long end,
+               int hop, double *out) {
+    int k = b->k, n = b->n;
+    double *s1 = malloc(k * sizeof(double));
+    double *s2 = malloc(k * sizeof(double));
+    long frames = 0;
+    if (!s1 || !s2) {
+        free(s1);
+        free(s2);
+        return -1;
+    }
+
+    for (long i = start; i < end; i += hop, frames++) {
+        for (int t = 0; t < k; t++)
+            s1[t] = s2[t] = 0;
+
+        for (int m = 0; m < n; m++) {
+            double x = pcm_at(pcm, len, i + m) * b->win[m];
+
+            for (int t = 0; t < k; t++) {
+                double s0 = x + b->coeff[t] * s1[t] - s2[t];
+                s2[t] = s1[t];
+                s1[t] = s0;
+            }
+        }
+
+        for (int t = 0; t < k; t++) {
+            double re = s1[t] - s2[t] * b->cw[t];
+            double im = s2[t] * b->sw[t];
+            out[frames * k + t] = sqrt(re*re + im*im) * b->norm;
+        }
+    }
+
+    free(s1);
+    free(s2);
+    return frames;
+}
+
+static void gbank_bins(gbank *b, const int16_t *pcm, long len, long last) {
+    // Direct DFT of the rectangular window ending at sample last
+    for (int j = 0; j < 3 * b->k; j++) {
+        double complex w = conj(b->rot[j]), acc = 0, p = 1;
+
+        for (int m = 0; m < b->n; m++) {
+            acc += pcm_at(pcm, len, last - b->n + 1 + m) * p;
+            p *= w;
+        }
+        b->bins[j] = acc;
+    }
+}
+
+/* Same frames as gbank_run, with a sliding DFT updated every sample. */
+long gbank_slide(gbank *b, const int16_t *pcm, long len, long start, long end,
+                 int hop, double *out) {
+    int k = b->k, n = b->n;
+    long frames = 0;
+
+    if (start >= end)
+        return 0;
+
+    gbank_bins(b, pcm, len, start + n - 1);
+
+    for (long i = start; i < end; i += hop, frames++) {
+        if (frames && frames % GBANK_RESYNC == 0) {
+            gbank_bins(b, pcm, len, i + n - 1);
+        } else if (frames) {
+            for (long s = i - hop + n; s < i + n; s++) {
+                double x = pcm_at(pcm, len, s), old = pcm_at(pcm, len, s - n);
+
+                for (int j = 0; j < 3 * k; j++)
+                    b->bins[j] = (b->bins[j] - old) * b->rot[j] + x * b->head[j];
+            }
+        }
+
+        for (int t = 0; t < k; t++) {
+            double complex *c = b->bins + 3 * t;
+            double complex y = 0.5 * c[1] - 0.25 * c[0] - 0.25 * c[2];
+            out[frames * k + t] = cabs(y) * 4 / n;
+        }
+    }
+
+    return frames;
+}
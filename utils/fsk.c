@@ -0,0 +1,164 @@
+/*
+  fsk.c
+
+  Two-tone FSK demodulator (Bell 202 by default) with bit clock recovery.
+
+  Every sample is mixed down by a mark and a space oscillator and summed
+  over a sliding window one bit long, which gives a matched filter for
+  each tone at a few multiplies per sample. The sign of |mark|^2 -
+  |space|^2 is the line level. A digital PLL, a 32-bit phase counter
+  advancing baud / sample_rate of a turn per sample, samples the level
+  every time it wraps and is pulled towards the level transitions, which
+  should fall half a bit away from the samples.
+
+  The state lives in an fsk_demod, so a recording can be fed in chunks of
+  any size and the bits come out the same. Bits are only produced while
+  the tones are above the carrier threshold. The last bit of a burst ends
+  where the carrier does, often before the PLL samples it: when the
+  carrier drops, or the input ends (fsk_flush), a bit that was more than
+  half received when the tones stopped, and not sampled since, is sampled
+  there. The window magnitude decays linearly once the tones stop, so how
+  far it has fallen from its peak tells how long ago that was.
+*/
+
+#include <complex.h>
+#include <math.h>
+#include <stdint.h>
+#include <stdlib.h>
+
+/* Fraction of its phase error the PLL keeps on every level transition */
+#define FSK_PLL_INERTIA 0.7
+
+
+typedef struct {
+    int len;                    /* correlator window, samples */
+    int pos;
+    double complex osc[2];      /* space, mark oscillators */
+    double complex rot[2];
+    double complex *ring;       /* window of mixed samples, 2 per sample */
+    double complex acc[2];
+    double thresh;              /* carrier threshold, window magnitude */
+    uint32_t step;
+    int32_t pll;
+    int level;
+    int last;                   /* previous sampled level, for NRZI */
+    int nrzi;
+    int dcd;
+    double mag;                 /* window magnitude of the stronger tone */
+    double peak;                /* highest mag since the carrier appeared */
+    long count;                 /* samples since the last renormalization */
+} fsk_demod;
+
+fsk_demod *fsk_create(double sample_rate, double baud, double mark,
+                      double space, int nrzi, double min_amp) {
+    fsk_demod *d = calloc(1, sizeof(fsk_demod));
+    if (!d)
+        return NULL;
+
+    d->len = (int)(sample_rate / baud + 0.5);
+    d->ring = calloc(2 * d->len, sizeof(double complex));
+    if (!d->ring) {
+        free(d);
+        return NULL;
+    }
+    d->rot[0] = cexp(-I * 2 * M_PI * space / sample_rate);
+    d->rot[1] = cexp(-I * 2 * M_PI * mark / sample_rate);
+    d->osc[0] = d->osc[1] = 1;
+    d->step = (uint32_t)(4294967296.0 * baud / sample_rate + 0.5);
+    d->pll = INT32_MIN;
+    d->last = 1;
+    d->nrzi = nrzi;
+
+    // A tone of amplitude min_amp sums to about min_amp * len / 2
+    d->thresh = min_amp * d->len / 2;
+    return d;
+}
+
+void fsk_destroy(fsk_demod *d) {
+    free(d->ring);
+    free(d);
+}
+
+/* Sample the pending bit if the PLL was past the midpoint between two
+   samples when the tones stopped, and has not wrapped since. Returns 0 or
+   1 bits. */
+static long fsk_pending(fsk_demod *d, unsigned char *out) {
+    double lag = d->peak > 0 ? d->len * (1 - d->mag / d->peak) : 0;
+    int64_t at_end = (int64_t)d->pll - (int64_t)(lag > 0 ? lag * d->step : 0);
+
+    if (at_end <= 0)
+        return 0;
+
+    out[0] = d->nrzi ? d->level == d->last : d->level;
+    d->last = d->level;
+    d->pll = INT32_MIN;
+    return 1;
+}
+
+/* Demodulate n samples into out, one byte per bit: data bits after NRZI
+   decoding if enabled, line levels (1 mark, 0 space) otherwise. The PLL
+   wraps at most twice a bit, so out must hold 2 * n * baud / sample_rate
+   + 2 bits. Returns the number of bits. */
+long fsk_run(fsk_demod *d, const int16_t *pcm, long n, unsigned char *out) {
+    long bits = 0;
+
+    for (long i = 0; i < n; i++) {
+        double x = pcm[i];
+        double complex *slot = d->ring + 2 * d->pos;
+
+        for (int t = 0; t < 2; t++) {
+            double complex y = x * d->osc[t];
+            d->acc[t] += y - slot[t];
+            slot[t] = y;
+            d->osc[t] *= d->rot[t];
+        }
+        d->pos = d->pos + 1 == d->len ? 0 : d->pos + 1;
+
+        if (++d->count == 4096) {
+            d->osc[0] /= cabs(d->osc[0]);
+            d->osc[1] /= cabs(d->osc[1]);
+            d->count = 0;
+        }
+
+        double ms = creal(d->acc[1]) * creal(d->acc[1]) + cimag(d->acc[1]) * cimag(d->acc[1]);
+        double ss = creal(d->acc[0]) * creal(d->acc[0]) + cimag(d->acc[0]) * cimag(d->acc[0]);
+        int dcd = ms > d->thresh * d->thresh || ss > d->thresh * d->thresh;
+        d->mag = sqrt(ms > ss ? ms : ss);
+
+        // Carrier just appeared: first sample one bit from now
+        if (dcd && !d->dcd) {
+            d->pll = INT32_MIN;
+            d->peak = 0;
+        }
+        if (dcd && d->mag > d->peak)
+            d->peak = d->mag;
+        // Carrier gone: its last bit may not have been sampled yet
+        if (!dcd && d->dcd)
+            bits += fsk_pending(d, out + bits);
+        d->dcd = dcd;
+        if (!dcd)
+            continue;
+
+        int level = ms > ss;
+        if (level != d->level) {
+            d->pll = (int32_t)(d->pll * FSK_PLL_INERTIA);
+            d->level = level;
+        }
+
+        int32_t prev = d->pll;
+        d->pll = (int32_t)((uint32_t)d->pll + d->step);
+
+        if (prev > 0 && d->pll < 0) {
+            out[bits++] = d->nrzi ? level == d->last : level;
+            d->last = level;
+        }
+    }
+
+    return bits;
+}
+
+/* End of input: the bit in progress, if more than half received. out must
+   hold one bit. Returns the number of bits. */
+long fsk_flush(fsk_demod *d, unsigned char *out) {
+    return d->dcd ? fsk_pending(d, out) : 0;
+}
@@ -15,37 +15,99 @@
 #include <stdlib.h>
 #include <stdio.h>
 #include <stdint.h>
+#include <string.h>
+#include <math.h>
+#include <stdbool.h>
+#include <unistd.h>
 #include <jpeglib.h>
 #include <jerror.h>
 #include "readPNG.c"
 #include "readBMP.c"
+#include "writePNG.c"
 
 
-int load_png(const char *path, unsigned char **out, unsigned long *width, unsigned long *height) {
-    unsigned char bg_red=0, bg_green=0, bg_blue=0;
+/* Image dimensions, read from the header without decoding the pixels. */
+int size_png(const char *path, unsigned long *width, unsigned long *height) {
+    FILE *fp = fopen(path, "rb");
+    if (!fp) 
+        return -1;
+
+    int res = readpng_init(fp, width, height);
+    readpng_cleanup(FALSE);
+    fclose(fp);
+    return res ? -2 : 0;
+}
+
+int size_jpg(const char *path, unsigned long *width, unsigned long *height) {
+    struct jpeg_decompress_struct info;
+    struct jpeg_error_mgr err;
+
+    FILE *fp = fopen(path, "rb");
+    if (!fp) 
+        return -1;
+
+    info.err = jpeg_std_error(&err);
+    jpeg_create_decompress(&info);
+
+    jpeg_stdio_src(&info, fp);
+    jpeg_read_header(&info, TRUE);
+    *width = info.image_width;
+    *height = info.image_height;
+
+    jpeg_destroy_decompress(&info);
+    fclose(fp);
+    return 0;
+}
+
+int size_bmp(const char *path, unsigned long *width, unsigned long *height) {
+    Image image;
+
+    FILE *fp = fopen(path, "rb");
+    if (!fp) 
+        return -1;
+
+    int res = ImageHeader(fp, &image);
+    fclose(fp);
+    if (res != 1)
+        return -2;
+
+    *width = image.sizeX;
+    *height = image.sizeY;
+    return 0;
+}
+
+/* Decode straight into out, a caller-owned buffer of width * height * 3
+   bytes (RGB). The image must have exactly these dimensions. */
+int load_png_into(const char *path, unsigned char *out, unsigned long width, unsigned long height) {
     double display_exponent = 1.0 * 2.2;
-    unsigned long image_rowbytes;
+    unsigned long image_rowbytes, w, h;
     int image_channels;
 
     FILE *fp = fopen(path, "rb");
     if (!fp) 
         return -1;
 
-    readpng_init(fp, width, height);
-    readpng_get_bgcolor(&bg_red, &bg_green, &bg_blue);
+    int res = readpng_init(fp, &w, &h);
+    if (res) {
+        fclose(fp);
+        return -2;
+    }
+    if (w != width || h != height) {
+        readpng_cleanup(FALSE);
+        fclose(fp);
+        return -6;
+    }
 
-    *out = readpng_get_image(display_exponent, &image_channels, &image_rowbytes);
+    unsigned char *img = readpng_get_image_into(display_exponent, out, &image_channels, &image_rowbytes);
     
     readpng_cleanup(FALSE);
     fclose(fp);
-    return 0;
+    return img ? 0 : -3;
 }
 
-int load_jpg(const char *path, unsigned char **out, unsigned long *width, unsigned long *height) {
+int load_jpg_into(const char *path, unsigned char *out, unsigned long width, unsigned long height) {
     struct jpeg_decompress_struct info;
     struct jpeg_error_mgr err;
-    unsigned long int iw, ih, ic, bsize, sclen, sccnt;
-    unsigned char* buf;
     JSAMPROW lineBuf;
 
     FILE *fp = fopen(path, "rb");
@@ -57,41 +119,30 @@ int load_jpg(const char *path, unsigned char **out, unsigned long *width, unsign
 
     jpeg_stdio_src(&info, fp);
     jpeg_read_header(&info, TRUE);
+
+    // Greyscale JPEGs are expanded, the buffer is always RGB
+    info.out_color_space = JCS_RGB;
     if (!jpeg_start_decompress(&info)) {
         jpeg_destroy_decompress(&info);
         fclose(fp);
         return -2;
     }
 
-    iw = info.output_width;
-    ih = info.output_height;
-    ic = info.output_components;
-
-    bsize = iw * ih * 3;
-    buf = (unsigned char*) malloc(sizeof(unsigned char)*bsize);
-    if (!buf) {
+    if (info.output_width != width || info.output_height != height) {
         jpeg_destroy_decompress(&info);
         fclose(fp);
-        return -3;
+        return -6;
     }
 
-    sclen = iw * ic;
-    sccnt = 0;
-
     while (info.output_scanline < info.output_height) {
-        lineBuf = (buf + (sccnt * sclen));
+        lineBuf = out + info.output_scanline * width * 3;
         if (!jpeg_read_scanlines(&info, &lineBuf, 1)) {
             jpeg_destroy_decompress(&info);
             fclose(fp);
             return -4;
         }
-        sccnt++;
     }
 
-    *out = buf;
-    *width = iw;
-    *height = ih;
-
     bool ok = jpeg_finish_decompress(&info);
     jpeg_destroy_decompress(&info);
     fclose(fp);
@@ -101,27 +152,579 @@ int load_jpg(const char *path, unsigned char **out, unsigned long *width, unsign
     return 0;
 }
 
-int load_bmp(const char *path, unsigned char **out, unsigned long *width, unsigned long *height) {
-    Image *image;
+int load_bmp_into(const char *path, unsigned char *out, unsigned long width, unsigned long height) {
+    Image image;
 
     FILE *fp = fopen(path, "rb");
     if (!fp) 
         return -1;
 
-    image = (Image *) malloc(sizeof(Image));
-    if (!ImageLoad(fp, image))
+    if (ImageHeader(fp, &image) != 1) {
+        fclose(fp);
         return -2;
+    }
+    if (image.sizeX != width || image.sizeY != height) {
+        fclose(fp);
+        return -6;
+    }
 
-    *width = image->sizeX;
-    *height = image->sizeY;
-    *out = image->data;
-
-    free(image);
+    image.data = out;
+    int res = ImageRead(fp, &image);
     fclose(fp);
+    return res == 1 ? 0 : -3;
+}
+
+/* Convert packed RGB rows to Y, R-Y and B-Y planes in one pass. With pairs
+   set, the chroma planes hold one row per pair of image rows, averaged
+   over the two rows (as sent by the PD modes). */
+void rgb_to_ycc(const unsigned char *rgb, unsigned long width, unsigned long rows,
+                int pairs, double *y, double *ry, double *by) {
+    for (unsigned long r = 0; r < rows; r++) {
+        const unsigned char *px = rgb + r * width * 3;
+        unsigned long crow = pairs ? r / 2 : r;
+
+        for (unsigned long i = 0; i < width; i++) {
+            double R = px[i*3], G = px[i*3 + 1], B = px[i*3 + 2];
+            double cr = 128.0 + (0.003906 * ((112.439 * R) + (-94.154 * G) + (-18.285 * B)));
+            double cb = 128.0 + (0.003906 * ((-37.945 * R) + (-74.494 * G) + (112.439 * B)));
+
+            y[r * width + i] = 16.0 + (0.003906 * ((65.738 * R) + (129.057 * G) + (25.064 * B)));
+
+            if (!pairs || (r % 2 == 0 && r + 1 == rows)) {
+                ry[crow * width + i] = cr;
+                by[crow * width + i] = cb;
+            } else if (r % 2 == 0) {
+                ry[crow * width + i] = cr / 2;
+                by[crow * width + i] = cb / 2;
+            } else {
+                ry[crow * width + i] += cr / 2;
+                by[crow * width + i] += cb / 2;
+            }
+        }
+    }
+}
+
+static unsigned char clamp_px(double v) {
+    v = nearbyint(v);
+    return v < 0 ? 0 : (v > 255 ? 255 : (unsigned char)v);
+}
+
+/* Packed RGB from Y, R-Y and B-Y samples, the inverse of rgb_to_ycc. */
+void ycc_to_rgb(const unsigned char *y, const unsigned char *ry, const unsigned char *by,
+                unsigned long n, unsigned char *rgb) {
+    for (unsigned long i = 0; i < n; i++) {
+        double Y = 1.164457 * (y[i] - 16.0);
+        double cr = ry[i] - 128.0, cb = by[i] - 128.0;
+
+        rgb[i*3] = clamp_px(Y + 1.596128 * cr);
+        rgb[i*3 + 1] = clamp_px(Y - 0.813022 * cr - 0.391786 * cb);
+        rgb[i*3 + 2] = clamp_px(Y + 2.017364 * cb);
+    }
+}
+
+/* Resample the source rectangle at (x0, y0) of size cw x ch (fractional,
+   in pixels of the sw-wide src) to a dw x dh RGB image. RESAMPLE_AREA
+   averages every source pixel by the share of it each output pixel
+   covers, for shrinking; RESAMPLE_BILINEAR interpolates between the four
+   nearest pixel centres, for enlarging. Both passes are separable.
+   Returns 0, or -3 if out of memory. */
+#define RESAMPLE_AREA 0
+#define RESAMPLE_BILINEAR 1
+
+typedef struct {
+    long first, n;              /* source pixels contributing */
+    double *w;                  /* their weights, summing to 1 */
+} rs_tap;
+
+static void rs_free(rs_tap *taps, long n) {
+    if (!taps)
+        return;
+    for (long i = 0; i < n; i++)
+        free(taps[i].w);
+    free(taps);
+}
+
+/* Taps of each of the out pixels, NULL if out of memory. */
+static rs_tap *rs_taps(double start, double len, long limit, long out, int filter) {
+    rs_tap *taps = calloc(out, sizeof(rs_tap));
+    double scale = len / out;
+    if (!taps)
+        return NULL;
+
+    for (long i = 0; i < out; i++) {
+        rs_tap *t = taps + i;
+
+        if (filter == RESAMPLE_AREA) {
+            double a = start + i * scale, b = a + scale;
+            long lo = (long)floor(a), hi = (long)ceil(b);
+
+            t->first = lo;
+            t->n = hi - lo;
+            t->w = malloc(t->n * sizeof(double));
+            if (!t->w) {
+                rs_free(taps, i);
+                return NULL;
+            }
+            for (long k = 0; k < t->n; k++) {
+                double l = fmax(a, lo + k), r = fmin(b, lo + k + 1);
+                t->w[k] = (r - l) / scale;
+            }
+        } else {
+            double c = start + (i + 0.5) * scale - 0.5;
+            long lo = (long)floor(c);
+            double f = c - lo;
+
+            t->first = lo;
+            t->n = 2;
+            t->w = malloc(2 * sizeof(double));
+            if (!t->w) {
+                rs_free(taps, i);
+                return NULL;
+            }
+            t->w[0] = 1 - f;
+            t->w[1] = f;
+        }
+
+        // Taps past the image edges repeat the edge pixel
+        for (long k = 0; k < t->n; k++) {
+            long j = t->first + k;
+            if (j < 0 || j >= limit) {
+                double w = t->w[k];
+                t->w[k] = 0;
+                t->w[j < 0 ? -t->first : limit - 1 - t->first] += w;
+            }
+        }
+    }
+
+    return taps;
+}
+
+static void rs_row(const unsigned char *s, rs_tap *tx, unsigned long dw, double *o) {
+    for (unsigned long x = 0; x < dw; x++) {
+        double r = 0, g = 0, b = 0;
+        for (long k = 0; k < tx[x].n; k++) {
+            double w = tx[x].w[k];
+            const unsigned char *p = s + (tx[x].first + k) * 3;
+            if (w == 0)
+                continue;
+
+            r += w * p[0];
+            g += w * p[1];
+            b += w * p[2];
+        }
+        o[x*3] = r;
+        o[x*3 + 1] = g;
+        o[x*3 + 2] = b;
+    }
+}
+
+int resample(const unsigned char *src, unsigned long sw, unsigned long sh,
+             double x0, double y0, double cw, double ch,
+             unsigned char *dst, unsigned long dw, unsigned long dh, int filter) {
+    rs_tap *tx = rs_taps(x0, cw, sw, dw, filter);
+    rs_tap *ty = rs_taps(y0, ch, sh, dh, filter);
+    if (!tx || !ty) {
+        rs_free(tx, dw);
+        rs_free(ty, dh);
+        return -3;
+    }
+
+    // Horizontally resampled source rows, kept in a ring just deep enough
+    // for one output row: the rows read only move forward
+    long cap = 1;
+    for (unsigned long y = 0; y < dh; y++)
+        cap = ty[y].n > cap ? ty[y].n : cap;
+
+    double *ring = malloc(cap * dw * 3 * sizeof(double));
+    long *held = malloc(cap * sizeof(long));
+    if (!ring || !held) {
+        free(held);
+        free(ring);
+        rs_free(tx, dw);
+        rs_free(ty, dh);
+        return -3;
+    }
+    for (long k = 0; k < cap; k++)
+        held[k] = -1;
+
+    for (unsigned long y = 0; y < dh; y++) {
+        unsigned char *o = dst + y * dw * 3;
+        rs_tap *t = ty + y;
+
+        for (long k = 0; k < t->n; k++) {
+            long r = t->first + k, slot = r % cap;
+            if (t->w[k] != 0 && held[slot] != r) {
+                rs_row(src + r * sw * 3, tx, dw, ring + slot * dw * 3);
+                held[slot] = r;
+            }
+        }
+
+        for (unsigned long i = 0; i < dw * 3; i++) {
+            double v = 0;
+            for (long k = 0; k < t->n; k++)
+                if (t->w[k] != 0)
+                    v += t->w[k] * ring[((t->first + k) % cap) * dw * 3 + i];
+            o[i] = clamp_px(v);
+        }
+    }
+
+    free(held);
+    free(ring);
+    rs_free(tx, dw);
+    rs_free(ty, dh);
     return 0;
 }
 
-void free_image(unsigned char *data) {
-    free(data);
-    data = NULL;
-}
\ No newline at end of file
+
+/* Image writers. A writer takes RGB rows top to bottom and streams them to
+   an already open file descriptor (duplicated, so the caller keeps its
+   own), which lets a decoder save each line as soon as it is ready. */
+#define IMG_PNG 0
+#define IMG_BMP 1
+#define IMG_JPG 2
+
+typedef struct {
+    int format;
+    unsigned long width, height, row;
+    FILE *fp;
+    long base;                  /* file offset of the BMP header */
+    unsigned char *line;        /* one BMP row, BGR and padded */
+    mainprog_info png;
+    struct jpeg_compress_struct jpg;
+    struct jpeg_error_mgr jerr;
+} img_writer;
+
+static void put_le(unsigned char *p, unsigned long v, int n) {
+    for (int i = 0; i < n; i++)
+        p[i] = (v >> (8 * i)) & 0xff;
+}
+
+static unsigned long bmp_stride(unsigned long width) {
+    return (width * 3 + 3) & ~3UL;
+}
+
+static int bmp_begin(img_writer *wr) {
+    unsigned long stride = bmp_stride(wr->width);
+    unsigned char h[54] = {'B', 'M'};
+
+    // BMP rows are stored bottom-up: every row is written at its own
+    // offset, so the header position must be known
+    wr->base = ftell(wr->fp);
+    if (wr->base < 0)
+        return -2;
+
+    put_le(h + 2, 54 + stride * wr->height, 4);
+    put_le(h + 10, 54, 4);
+    put_le(h + 14, 40, 4);
+    put_le(h + 18, wr->width, 4);
+    put_le(h + 22, wr->height, 4);
+    put_le(h + 26, 1, 2);
+    put_le(h + 28, 24, 2);
+    put_le(h + 34, stride * wr->height, 4);
+    put_le(h + 38, 2835, 4);
+    put_le(h + 42, 2835, 4);
+
+    wr->line = calloc(stride, 1);
+    if (!wr->line || fwrite(h, 54, 1, wr->fp) != 1)
+        return -3;
+    return 0;
+}
+
+static int bmp_row(img_writer *wr, const unsigned char *rgb) {
+    unsigned long stride = bmp_stride(wr->width);
+
+    for (unsigned long i = 0; i < wr->width * 3; i += 3) {
+        wr->line[i] = rgb[i + 2];
+        wr->line[i + 1] = rgb[i + 1];
+        wr->line[i + 2] = rgb[i];
+    }
+
+    if (fseek(wr->fp, wr->base + 54 + (wr->height - 1 - wr->row) * stride, SEEK_SET))
+        return -2;
+    return fwrite(wr->line, stride, 1, wr->fp) == 1 ? 0 : -3;
+}
+
+static int png_begin(img_writer *wr) {
+    wr->png.width = wr->width;
+    wr->png.height = wr->height;
+    wr->png.outfile = wr->fp;
+    wr->png.pnmtype = 6;
+    wr->png.sample_depth = 8;
+
+    if (writepng_init(&wr->png))
+        return -3;
+
+    // writepng_init asks for maximum compression, several times slower for
+    // little gain on decoded images; libpng only starts deflating with the
+    // first row, so the default level still applies
+    png_set_compression_level(wr->png.png_ptr, Z_DEFAULT_COMPRESSION);
+    return 0;
+}
+
+static int jpg_begin(img_writer *wr, int quality) {
+    wr->jpg.err = jpeg_std_error(&wr->jerr);
+    jpeg_create_compress(&wr->jpg);
+    jpeg_stdio_dest(&wr->jpg, wr->fp);
+
+    wr->jpg.image_width = wr->width;
+    wr->jpg.image_height = wr->height;
+    wr->jpg.input_components = 3;
+    wr->jpg.in_color_space = JCS_RGB;
+    jpeg_set_defaults(&wr->jpg);
+    jpeg_set_quality(&wr->jpg, quality, TRUE);
+    jpeg_start_compress(&wr->jpg, TRUE);
+    return 0;
+}
+
+/* Start an image of width x height in format (IMG_PNG, IMG_BMP or IMG_JPG)
+   at the current position of fd; quality only applies to JPEG. NULL on
+   failure. */
+img_writer *writer_open(int fd, int format, unsigned long width, unsigned long height,
+                        int quality) {
+    img_writer *wr = calloc(1, sizeof(img_writer));
+    int res = -1;
+
+    if (!wr)
+        return NULL;
+
+    int dupfd = dup(fd);
+    wr->fp = dupfd < 0 ? NULL : fdopen(dupfd, "wb");
+    if (!wr->fp) {
+        if (dupfd >= 0)
+            close(dupfd);
+        free(wr);
+        return NULL;
+    }
+
+    wr->format = format;
+    wr->width = width;
+    wr->height = height;
+
+    if (format == IMG_PNG)
+        res = png_begin(wr);
+    else if (format == IMG_BMP)
+        res = bmp_begin(wr);
+    else if (format == IMG_JPG)
+        res = jpg_begin(wr, quality);
+
+    if (res) {
+        if (format == IMG_PNG)
+            writepng_cleanup(&wr->png);
+        fclose(wr->fp);
+        free(wr->line);
+        free(wr);
+        return NULL;
+    }
+    return wr;
+}
+
+/* Append the next row, width * 3 bytes of RGB. */
+int writer_row(img_writer *wr, const unsigned char *rgb) {
+    int res = 0;
+
+    if (wr->row >= wr->height)
+        return -1;
+
+    if (wr->format == IMG_PNG) {
+        wr->png.image_data = (uch *)rgb;
+        res = writepng_encode_row(&wr->png) ? -3 : 0;
+    } else if (wr->format == IMG_BMP) {
+        res = bmp_row(wr, rgb);
+    } else {
+        JSAMPROW line = (JSAMPROW)rgb;
+        res = jpeg_write_scanlines(&wr->jpg, &line, 1) == 1 ? 0 : -3;
+    }
+
+    if (!res)
+        wr->row++;
+    return res;
+}
+
+/* Finish the image and release the writer. Rows never written are black,
+   so the file is always complete. */
+int writer_close(img_writer *wr) {
+    int res = 0;
+
+    unsigned char *black = calloc(wr->width * 3, 1);
+    while (!res && black && wr->row < wr->height)
+        res = writer_row(wr, black);
+    free(black);
+
+    if (wr->format == IMG_PNG) {
+        if (!res && writepng_encode_finish(&wr->png))
+            res = -3;
+        writepng_cleanup(&wr->png);
+    } else if (wr->format == IMG_JPG) {
+        if (!res)
+            jpeg_finish_compress(&wr->jpg);
+        jpeg_destroy_compress(&wr->jpg);
+    }
+
+    if (fclose(wr->fp) && !res)
+        res = -3;
+    free(wr->line);
+    free(wr);
+    return res;
+}
+
+/* Write a whole packed RGB image in one call. */
+int write_image(int fd, int format, const unsigned char *rgb, unsigned long width,
+                unsigned long height, int quality) {
+    img_writer *wr = writer_open(fd, format, width, height, quality);
+    int res = 0;
+
+    if (!wr)
+        return -1;
+
+    for (unsigned long y = 0; !res && y < height; y++)
+        res = writer_row(wr, rgb + y * width * 3);
+
+    int closed = writer_close(wr);
+    return res ? res : closed;
+}
+
+
+/* Image readers, the counterpart of the writers: RGB rows come out top to
+   bottom one call at a time, so only a row is held instead of the image.
+   BMP stores its rows bottom-up and is read backwards by seeking, JPEG is
+   decoded a scanline at a time and PNG a row at a time (interlaced PNGs
+   are only complete at the last pass, those are decoded whole). PNG
+   readers share the global state of readPNG.c: one at a time. */
+typedef struct {
+    int format;
+    unsigned long width, height, row;
+    FILE *fp;
+    long base;                  /* file offset of the BMP pixel data */
+    unsigned char *image;       /* whole interlaced PNG */
+    struct jpeg_decompress_struct jpg;
+    struct jpeg_error_mgr jerr;
+} img_reader;
+
+static int png_start(img_reader *rd) {
+    unsigned long rowbytes;
+    int channels;
+
+    if (readpng_init(rd->fp, &rd->width, &rd->height))
+        return -2;
+
+    if (readpng_interlaced()) {
+        rd->image = readpng_get_image(1.0 * 2.2, &channels, &rowbytes);
+        return rd->image && rowbytes == rd->width * 3 ? 0 : -3;
+    }
+
+    if (readpng_setup(1.0 * 2.2, &channels, &rowbytes))
+        return -3;
+    return rowbytes == rd->width * 3 ? 0 : -3;
+}
+
+static int jpg_start(img_reader *rd) {
+    rd->jpg.err = jpeg_std_error(&rd->jerr);
+    jpeg_create_decompress(&rd->jpg);
+    jpeg_stdio_src(&rd->jpg, rd->fp);
+    jpeg_read_header(&rd->jpg, TRUE);
+
+    // Greyscale JPEGs are expanded, as in load_jpg_into
+    rd->jpg.out_color_space = JCS_RGB;
+    if (!jpeg_start_decompress(&rd->jpg))
+        return -2;
+
+    rd->width = rd->jpg.output_width;
+    rd->height = rd->jpg.output_height;
+    return 0;
+}
+
+static int bmp_start(img_reader *rd) {
+    Image image;
+
+    if (ImageHeader(rd->fp, &image) != 1)
+        return -2;
+
+    rd->width = image.sizeX;
+    rd->height = image.sizeY;
+    rd->base = ftell(rd->fp);
+    return rd->base < 0 ? -2 : 0;
+}
+
+/* Release the reader; the remaining rows need not be read. */
+void reader_close(img_reader *rd) {
+    if (rd->format == IMG_PNG) {
+        // An interlaced image is readPNG.c's image_data, freed with it
+        readpng_cleanup(rd->image != NULL);
+    } else if (rd->format == IMG_JPG && rd->jpg.err) {
+        jpeg_destroy_decompress(&rd->jpg);
+    }
+
+    fclose(rd->fp);
+    free(rd);
+}
+
+/* Open path, in format IMG_PNG, IMG_BMP or IMG_JPG, and read its size. NULL
+   on failure. */
+img_reader *reader_open(const char *path, int format, unsigned long *width,
+                        unsigned long *height) {
+    img_reader *rd = calloc(1, sizeof(img_reader));
+    int res = -1;
+
+    if (!rd)
+        return NULL;
+
+    rd->fp = fopen(path, "rb");
+    if (!rd->fp) {
+        free(rd);
+        return NULL;
+    }
+
+    rd->format = format;
+    if (format == IMG_PNG)
+        res = png_start(rd);
+    else if (format == IMG_BMP)
+        res = bmp_start(rd);
+    else if (format == IMG_JPG)
+        res = jpg_start(rd);
+
+    if (res) {
+        reader_close(rd);
+        return NULL;
+    }
+
+    *width = rd->width;
+    *height = rd->height;
+    return rd;
+}
+
+/* The next row, width * 3 bytes of RGB, into out. -1 past the last row. */
+int reader_row(img_reader *rd, unsigned char *out) {
+    int res = 0;
+
+    if (rd->row >= rd->height)
+        return -1;
+
+    if (rd->format == IMG_PNG) {
+        if (rd->image)
+            memcpy(out, rd->image + rd->row * rd->width * 3, rd->width * 3);
+        else
+            res = readpng_get_row(out) ? -3 : 0;
+    } else if (rd->format == IMG_BMP) {
+        // Same layout as load_bmp_into reads, which leaves the rows in file
+        // order: the last one stored is the top of the image
+        unsigned long size = rd->width * 3;
+        long at = rd->base + (rd->height - 1 - rd->row) * bmp_stride(rd->width);
+
+        if (fseek(rd->fp, at, SEEK_SET) || fread(out, size, 1, rd->fp) != 1) {
+            res = -3;
+        } else {
+            for (unsigned long i = 0; i < size; i += 3) {
+                unsigned char t = out[i];
+                out[i] = out[i + 2];
+                out[i + 2] = t;
+            }
+        }
+    } else {
+        JSAMPROW line = out;
+        res = jpeg_read_scanlines(&rd->jpg, &line, 1) == 1 ? 0 : -3;
+    }
+
+    if (!res)
+        rd->row++;
+    return res;
+}
@@ -64,12 +64,10 @@ unsigned short int endianReadShort(FILE* file) {
 
 // quick and dirty bitmap loader...for 24 bit bitmaps with 1 plane only.  
 // See http://www.dcs.ed.ac.uk/~mxr/gfx/2d/BMP.txt for more info.
-int ImageLoad(FILE *file, Image *image) {
-    unsigned long size;                 // size of the image in bytes.
-    unsigned long i;                    // standard counter.
+// Reads the header up to the pixel data; 1 on success.
+int ImageHeader(FILE *file, Image *image) {
     unsigned short int planes;          // number of planes in image (must be 1) 
     unsigned short int bpp;             // number of bits per pixel (must be 24)
-    char temp;                          // temporary color storage for bgr-rgb conversion.
 
     // seek through the bmp header, up to the width/height:
     fseek(file, 18, SEEK_CUR);
@@ -82,9 +80,6 @@ int ImageLoad(FILE *file, Image *image) {
     if (!(image->sizeY = endianReadInt(file)))
 	   return -2;
     
-    // calculate the size (assuming 24 bits or 3 bytes per pixel).
-    size = image->sizeX * image->sizeY * 3;
-
     // read the planes
     if (!(planes=endianReadShort(file)))
 	   return -3;
@@ -102,21 +97,56 @@ int ImageLoad(FILE *file, Image *image) {
     // seek past the rest of the bitmap header.
     fseek(file, 24, SEEK_CUR);
 
+    return 1;
+}
+
+// Reads the pixel data after ImageHeader() into image->data, which the
+// caller provides; 1 on success.
+int ImageRead(FILE *file, Image *image) {
+    unsigned long size;                 // size of a row in bytes.
+    unsigned long stride;               // size of a row in the file.
+    unsigned long i, y;                 // standard counters.
+    char temp;                          // temporary color storage for bgr-rgb conversion.
+
+    // calculate the size (assuming 24 bits or 3 bytes per pixel); rows are
+    // padded to a multiple of 4 bytes in the file.
+    size = image->sizeX * 3;
+    stride = (size + 3) & ~3UL;
+
+    for (y=0; y<image->sizeY; y++) {
+        unsigned char *row = image->data + y * size;
+
+        if (fread(row, size, 1, file) != 1)
+	       return -8;
+        if (stride > size && fseek(file, stride - size, SEEK_CUR))
+	       return -8;
+
+        for (i=0; i<size; i+=3) { // reverse all of the colors. (bgr -> rgb)
+	       temp = row[i];
+	       row[i] = row[i+2];
+	       row[i+2] = temp;
+        }
+    }
+    
+    return 1;
+}
+
+int ImageLoad(FILE *file, Image *image) {
+    int res = ImageHeader(file, image);
+    if (res != 1)
+        return res;
+
     // read the data. 
-    image->data = (unsigned char *) malloc(size);
+    image->data = (unsigned char *) malloc(image->sizeX * image->sizeY * 3);
     if (!image->data) {
 	   printf("Error allocating memory for color-corrected image data");
 	   return -7;	
     }
 
-    if ((i = fread(image->data, size, 1, file)) != 1)
-	   return -8;
-
-    for (i=0; i<size; i+=3) { // reverse all of the colors. (bgr -> rgb)
-	   temp = image->data[i];
-	   image->data[i] = image->data[i+2];
-	   image->data[i+2] = temp;
+    res = ImageRead(file, image);
+    if (res != 1) {
+        free(image->data);
+        image->data = NULL;
     }
-    
-    return 1;
+    return res;
 }
@@ -53,6 +53,10 @@ int  bit_depth, color_type;
 uch  *image_data = NULL;
 
 
+uch *readpng_get_image_into(double display_exponent, uch *dest, int *pChannels,
+                            ulg *pRowbytes);
+
+
 /* return value = 0 for success, 1 for bad sig, 2 for bad IHDR, 4 for no mem */
 int readpng_init(FILE *infile, ulg *pWidth, ulg *pHeight)
 {
@@ -136,15 +140,20 @@ int readpng_get_bgcolor(uch *red, uch *green, uch *blue)
 }
 
 uch *readpng_get_image(double display_exponent, int *pChannels, ulg *pRowbytes)
+{
+    return readpng_get_image_into(display_exponent, NULL, pChannels, pRowbytes);
+}
+
+/* sets up the RGB output of readpng_get_image() and readpng_get_row();
+ * returns 0 for success, 2 for libpng problem */
+int readpng_setup(double display_exponent, int *pChannels, ulg *pRowbytes)
 {
     double  gamma;
-    png_uint_32  i, rowbytes;
-    png_bytepp  row_pointers = NULL;
 
 
     if (setjmp(png_jmpbuf(png_ptr))) {
         png_destroy_read_struct(&png_ptr, &info_ptr, NULL);
-        return NULL;
+        return 2;
     }
 
     if (color_type == PNG_COLOR_TYPE_PALETTE)
@@ -168,25 +177,74 @@ uch *readpng_get_image(double display_exponent, int *pChannels, ulg *pRowbytes)
     png_set_background(png_ptr, &black_bg, PNG_BACKGROUND_GAMMA_SCREEN, 0, 1.0);
     png_set_strip_alpha(png_ptr);
 
+    /* no-op for non-interlaced images */
+    png_set_interlace_handling(png_ptr);
+
 
     png_read_update_info(png_ptr, info_ptr);
 
-    *pRowbytes = rowbytes = png_get_rowbytes(png_ptr, info_ptr);
+    *pRowbytes = png_get_rowbytes(png_ptr, info_ptr);
     *pChannels = (int)png_get_channels(png_ptr, info_ptr);
 
-    if ((image_data = (uch *)malloc(rowbytes*height)) == NULL) {
+    return 0;
+}
+
+/* returns 1 if the image is interlaced: its rows are only final once the
+ * whole image is decoded, readpng_get_row() cannot be used */
+int readpng_interlaced(void)
+{
+    return png_get_interlace_type(png_ptr, info_ptr) != PNG_INTERLACE_NONE;
+}
+
+/* decodes the next row into dest after readpng_setup(); returns 0 for
+ * success, 2 for libpng problem */
+int readpng_get_row(uch *dest)
+{
+    if (setjmp(png_jmpbuf(png_ptr))) {
+        png_destroy_read_struct(&png_ptr, &info_ptr, NULL);
+        return 2;
+    }
+
+    png_read_row(png_ptr, dest, NULL);
+    return 0;
+}
+
+/* as readpng_get_image(), decoding into dest (height rows of width RGB
+ * pixels) when given instead of a new buffer */
+uch *readpng_get_image_into(double display_exponent, uch *dest, int *pChannels,
+                            ulg *pRowbytes)
+{
+    png_uint_32  i, rowbytes;
+    png_bytepp  row_pointers = NULL;
+
+
+    if (readpng_setup(display_exponent, pChannels, pRowbytes))
+        return NULL;
+    rowbytes = *pRowbytes;
+
+    if (setjmp(png_jmpbuf(png_ptr))) {
+        png_destroy_read_struct(&png_ptr, &info_ptr, NULL);
+        return NULL;
+    }
+
+    if (dest) {
+        if (rowbytes != 3*width)
+            return NULL;
+    } else if ((dest = image_data = (uch *)malloc(rowbytes*height)) == NULL) {
         png_destroy_read_struct(&png_ptr, &info_ptr, NULL);
         return NULL;
     }
     if ((row_pointers = (png_bytepp)malloc(height*sizeof(png_bytep))) == NULL) {
         png_destroy_read_struct(&png_ptr, &info_ptr, NULL);
-        free(image_data);
-        image_data = NULL;
+        if (dest == image_data) {
+            free(image_data);
+            image_data = NULL;
+        }
         return NULL;
     }
 
     for (i = 0;  i < height;  ++i)
-        row_pointers[i] = image_data + i*rowbytes;
+        row_pointers[i] = dest + i*rowbytes;
 
 
     png_read_image(png_ptr, row_pointers);
@@ -194,7 +252,7 @@ uch *readpng_get_image(double display_exponent, int *pChannels, ulg *pRowbytes)
     free(row_pointers);
     row_pointers = NULL;
 
-    return image_data;
+    return dest;
 }
 
 void readpng_cleanup(int free_image_data)
@@ -0,0 +1,126 @@
+/*
+  segments.c
+
+  Per-segment estimation over a frequency track. The track holds one value
+  per hop samples, entry j covering samples [t0 + j*hop, t0 + (j+1)*hop),
+  so a per-sample track is simply hop = 1. Every track entry counts with
+  the number of samples it overlaps the segment, which makes the result
+  the same as estimating over the equivalent per-sample track.
+*/
+
+#include <math.h>
+#include <stdint.h>
+#include <stdlib.h>
+
+#define SEG_MODE 0
+#define SEG_MEDIAN 1
+#define SEG_MEAN 2
+
+
+typedef struct {
+    double v;
+    double w;
+    long order;
+} seg_entry;
+
+static int seg_cmp(const void *a, const void *b) {
+    const seg_entry *x = a, *y = b;
+    if (x->v != y->v)
+        return x->v < y->v ? -1 : 1;
+    return x->order < y->order ? -1 : (x->order > y->order);
+}
+
+/* One value per segment [starts[i], ends[i]): the most common value after
+   rounding to binw Hz (ties go to the first seen), the weighted median or
+   the weighted mean. Segments with no track coverage give -1. */
+void track_segments(const double *track, long tlen, long t0, int hop,
+                    const long *starts, const long *ends, long n,
+                    int method, double binw, double *out) {
+    long cap = 64;
+    seg_entry *buf = malloc(cap * sizeof(seg_entry));
+
+    for (long i = 0; i < n; i++) {
+        long a = starts[i] > t0 ? starts[i] : t0;
+        long b = ends[i] < t0 + tlen * hop ? ends[i] : t0 + tlen * hop;
+        long m = 0;
+        double total = 0, sum = 0;
+
+        for (long j = (a - t0) / hop; a < b && j * hop + t0 < b; j++) {
+            long lo = t0 + j * hop, hi = lo + hop;
+            double w = (hi < b ? hi : b) - (lo > a ? lo : a);
+            double v = track[j];
+
+            if (method == SEG_MODE && binw > 0)
+                v = binw * round(v / binw);
+
+            total += w;
+            sum += w * v;
+
+            // Runs of equal values collapse into one entry
+            if (m && buf[m - 1].v == v) {
+                buf[m - 1].w += w;
+                continue;
+            }
+
+            if (m == cap) {
+                cap *= 2;
+                buf = realloc(buf, cap * sizeof(seg_entry));
+            }
+            buf[m].v = v;
+            buf[m].w = w;
+            buf[m].order = m;
+            m++;
+        }
+
+        if (!m) {
+            out[i] = -1;
+            continue;
+        }
+
+        if (method == SEG_MEAN) {
+            out[i] = sum / total;
+            continue;
+        }
+
+        qsort(buf, m, sizeof(seg_entry), seg_cmp);
+
+        if (method == SEG_MEDIAN) {
+            double acc = 0;
+            for (long k = 0; k < m; k++) {
+                acc += buf[k].w;
+                if (2 * acc >= total) {
+                    out[i] = buf[k].v;
+                    break;
+                }
+            }
+            continue;
+        }
+
+        double best_w = -1;
+        long best_order = 0;
+        for (long k = 0; k < m;) {
+            double w = 0;
+            long first = buf[k].order, e = k;
+
+            for (; e < m && buf[e].v == buf[k].v; e++)
+                w += buf[e].w;
+
+            if (w > best_w || (w == best_w && first < best_order)) {
+                best_w = w;
+                best_order = first;
+                out[i] = buf[k].v;
+            }
+            k = e;
+        }
+    }
+
+    free(buf);
+}
+
+/* Map tone frequencies to 0-255 luminance (1500 Hz black, 2300 Hz white). */
+void hz_to_lum(const double *freqs, long n, unsigned char *out) {
+    for (long i = 0; i < n; i++) {
+        double v = nearbyint((freqs[i] - 1500.0) / 3.1372549);
+        out[i] = v < 0 ? 0 : (v > 255 ? 255 : (unsigned char)v);
+    }
+}